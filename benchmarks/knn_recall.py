@@ -0,0 +1,105 @@
+"""
+Latency and recall@k of every Annoy metric against exact k-NN.
+
+Queries are the indication diffusion profiles, the items are the drug diffusion profiles,
+exactly as in get_drugs_for_disease. Recall is reported against the exact result for the
+same metric and against exact correlation distance, the comparison the MSI paper recommends.
+
+Run from the repository root:
+    python -m benchmarks.knn_recall --data ./data/ --output knn_recall.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from snapshot import load_snapshot
+from vector_database import ExactVectorDatabase
+
+ANNOY_METRICS = ['angular', 'euclidean', 'manhattan']
+
+
+def recall_at_k(approximate, exact):
+    # Fraction of the exact top-k found by the approximate search, averaged over queries
+    return float(np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approximate, exact)]))
+
+
+def latency_summary(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return {'mean_ms': float(milliseconds.mean()), 'p50_ms': float(np.percentile(milliseconds, 50)), 'p90_ms': float(np.percentile(milliseconds, 90)),
+            'p99_ms': float(np.percentile(milliseconds, 99)), 'max_ms': float(milliseconds.max())}
+
+
+def run_knn_benchmark(drug_diffusion_profiles, indication_diffusion_profiles, annoy_db, k=10, n_queries=None, seed=0):
+    """
+    Output:
+    - dict: Per backend/metric latency summary and recall@k, machine readable.
+    """
+    queries = np.asarray(indication_diffusion_profiles, dtype=np.float32)
+    if n_queries is not None and n_queries < len(queries):
+        queries = queries[np.random.default_rng(seed).choice(len(queries), n_queries, replace=False)]
+
+    exact_metrics = ['correlation'] + [metric for metric in ANNOY_METRICS if metric in annoy_db.metrics]
+    exact_db = ExactVectorDatabase(metrics=exact_metrics)
+    start = time.perf_counter()
+    exact_db.add_vectors(drug_diffusion_profiles)
+    results = {'k': k, 'n_queries': len(queries), 'n_items': len(drug_diffusion_profiles),
+               'exact_preprocessing_s': time.perf_counter() - start, 'backends': {}}
+
+    exact_neighbors = {}
+    for metric in exact_metrics:
+        timings = []
+        neighbors = []
+        for query in queries:
+            start = time.perf_counter()
+            neighbors.append(exact_db.nearest_neighbors(query, metric, k))
+            timings.append(time.perf_counter() - start)
+        exact_neighbors[metric] = neighbors
+
+        start = time.perf_counter()
+        exact_db.nearest_neighbors_batch(queries, metric, k)
+        batch_seconds = time.perf_counter() - start
+
+        results['backends'][f'exact/{metric}'] = {**latency_summary(timings), 'batch_total_s': batch_seconds,
+                                                  'recall_vs_exact_correlation': recall_at_k(neighbors, exact_neighbors['correlation'])}
+
+    for metric in annoy_db.metrics:
+        timings = []
+        neighbors = []
+        for query in queries:
+            start = time.perf_counter()
+            neighbors.append(annoy_db.nearest_neighbors(query, metric, k))
+            timings.append(time.perf_counter() - start)
+
+        results['backends'][f'annoy/{metric}'] = {**latency_summary(timings),
+                                                  'recall_vs_exact_same_metric': recall_at_k(neighbors, exact_neighbors[metric]),
+                                                  'recall_vs_exact_correlation': recall_at_k(neighbors, exact_neighbors['correlation'])}
+
+    return results
+
+
+def print_results(results):
+    print(f"k={results['k']}, {results['n_queries']} queries over {results['n_items']} items")
+    print(f"{'backend':<22}{'p50 ms':>10}{'p99 ms':>10}{'recall (same)':>15}{'recall (corr)':>15}")
+    for name, row in results['backends'].items():
+        same = row.get('recall_vs_exact_same_metric', 1.0)
+        print(f"{name:<22}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}{same:>15.3f}{row['recall_vs_exact_correlation']:>15.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='./data/')
+    parser.add_argument('--snapshots', default='./snapshots/')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=None, help='Sample this many indications (default: all)')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.data, args.snapshots)
+    results = run_knn_benchmark(snapshot.drug_diffusion_profiles, snapshot.indication_diffusion_profiles, snapshot.drug_vector_db, k=args.k, n_queries=args.queries)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
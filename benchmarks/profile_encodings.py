@@ -0,0 +1,119 @@
+"""
+Size and accuracy of every ProfileStore encoding against the float32 diffusion profiles.
+
+For each encoding the report gives the stored size, the recommendation overlap (top-k drugs of
+every indication by exact correlation distance, computed on the encoded profiles) and the
+top-k node overlap (the /graph node sets of every drug and indication profile), plus the
+latency of a batch and of a single k-NN query on the encoded store. Overlaps are averaged over
+all rows and count ties with the k-th float32 result as matches.
+
+The size includes the preprocessed exact k-NN matrices a snapshot stores next to float32
+profiles (one float32 copy of both profile matrices per exact metric); snapshots of the other
+encodings search the encoded store and store none.
+
+Run from the repository root:
+    python -m benchmarks.profile_encodings --data ./data/ --output profile_encodings.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from profile_store import ENCODINGS, ProfileStore, ProfileStoreDatabase
+from snapshot import load_snapshot
+from vector_database import ExactVectorDatabase
+
+
+def tie_aware_overlap(returned, baseline_scores, k):
+    """
+    Fraction of returned items that belong in the float32 top k, averaged over rows.
+
+    Many profiles share values (nodes reached the same way, drugs with the same targets), so an
+    item counts as correct when its float32 score is at least the k-th best float32 score.
+
+    Input:
+    - returned (n_rows, k): Item ids found on the encoded profiles.
+    - baseline_scores (n_rows, n_items): float32 scores, higher is better.
+    """
+    kth_best = -np.partition(-baseline_scores, k - 1, axis=1)[:, k - 1]
+    return float(np.mean(np.take_along_axis(baseline_scores, np.asarray(returned, dtype=np.int64), axis=1) >= kth_best[:, None]))
+
+
+def top_k_node_overlap(store, profiles, k):
+    return tie_aware_overlap(np.stack([store.top_k_nodes(row, k) for row in range(len(store))]), profiles, k)
+
+
+def run_encoding_benchmark(drug_diffusion_profiles, indication_diffusion_profiles, k=10, node_ks=(20, 100), top_n=1024, metric='correlation'):
+    """
+    Output:
+    - dict: Per encoding size, overlaps and latency, machine readable.
+    """
+    drug_profiles = np.asarray(drug_diffusion_profiles, dtype=np.float32)
+    indication_profiles = np.asarray(indication_diffusion_profiles, dtype=np.float32)
+
+    exact_db = ExactVectorDatabase(metrics=[metric])
+    exact_db.add_vectors(drug_profiles)
+    baseline_scores = -exact_db.distances(indication_profiles, metric)
+
+    results = {'k': k, 'metric': metric, 'top_n': top_n, 'float32_bytes': drug_profiles.nbytes + indication_profiles.nbytes, 'encodings': {}}
+    for encoding in ENCODINGS:
+        start = time.perf_counter()
+        drug_store = ProfileStore.encode(drug_profiles, encoding, top_n=top_n)
+        indication_store = ProfileStore.encode(indication_profiles, encoding, top_n=top_n)
+        encode_seconds = time.perf_counter() - start
+
+        # Both sides of the recommendation come from the encoded profiles, as they would when served
+        start = time.perf_counter()
+        recommended = drug_store.nearest_neighbors_batch(np.asarray(indication_store), metric, k)
+        knn_seconds = time.perf_counter() - start
+
+        # One query as a worker serves it: on the preprocessed matrices for float32, else on the store
+        if encoding == 'float32':
+            # The snapshot's drug and indication matrices for this metric
+            served_db, exact_bytes = exact_db, results['float32_bytes']
+        else:
+            served_db = ProfileStoreDatabase(drug_store, metrics=[metric])
+            exact_bytes = 0
+        start = time.perf_counter()
+        served_db.nearest_neighbors_batch(indication_store[0], metric, k)
+        query_seconds = time.perf_counter() - start
+
+        nbytes = drug_store.nbytes + indication_store.nbytes + exact_bytes
+        row = {'bytes': nbytes, 'store_bytes': drug_store.nbytes + indication_store.nbytes, 'exact_matrix_bytes': exact_bytes,
+               'compression': results['float32_bytes'] / nbytes, 'encode_s': encode_seconds, 'knn_batch_s': knn_seconds, 'knn_query_ms': 1000 * query_seconds,
+               'recommendation_overlap': tie_aware_overlap(recommended, baseline_scores, k)}
+        for node_k in node_ks:
+            if encoding == 'sparse' and node_k > top_n:
+                continue
+            row[f'drug_top{node_k}_node_overlap'] = top_k_node_overlap(drug_store, drug_profiles, node_k)
+            row[f'indication_top{node_k}_node_overlap'] = top_k_node_overlap(indication_store, indication_profiles, node_k)
+        results['encodings'][encoding] = row
+
+    return results
+
+
+def print_results(results):
+    print(f"{results['metric']} recommendations, k={results['k']}; float32 size {results['float32_bytes'] / 2**20:.1f} MB")
+    for encoding, row in results['encodings'].items():
+        overlaps = ', '.join(f"{name.replace('_node_overlap', '')} {value:.3f}" for name, value in row.items() if name.endswith('_node_overlap'))
+        print(f"{encoding:<8} {row['bytes'] / 2**20:8.1f} MB (exact matrices {row['exact_matrix_bytes'] / 2**20:.1f} MB)  x{row['compression']:<5.1f} "
+              f"recommendations {row['recommendation_overlap']:.3f}  k-NN {row['knn_batch_s']:.2f}s batch, {row['knn_query_ms']:.1f}ms query  nodes: {overlaps}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='./data/')
+    parser.add_argument('--snapshots', default='./snapshots/')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--top-n', type=int, default=1024, help='Values kept per row by the sparse encoding')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.data, args.snapshots)
+    results = run_encoding_benchmark(snapshot.drug_diffusion_profiles, snapshot.indication_diffusion_profiles, k=args.k, top_n=args.top_n)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
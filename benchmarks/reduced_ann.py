@@ -0,0 +1,107 @@
+"""
+Build time, query latency and recall@k of reduced-dimension Annoy indexes against the current
+full-dimension indexes.
+
+Every configuration indexes the drug diffusion profiles and is queried with the indication
+profiles, as in get_drugs_for_disease. Projected configurations over-fetch candidates and
+re-rank them exactly on the full profiles. Recall is measured against exact k-NN with the same
+metric.
+
+Run from the repository root:
+    python -m benchmarks.reduced_ann --data ./data/ --projections svd:128 svd:128:sqrt pca:256:sqrt --output reduced_ann.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.knn_recall import latency_summary, recall_at_k
+from snapshot import load_snapshot
+from vector_database import ExactVectorDatabase, MultiMetricDatabase
+
+
+def run_reduced_ann_benchmark(drug_diffusion_profiles, indication_diffusion_profiles, projections, metrics=['angular', 'manhattan'],
+                              n_trees=30, overfetch=10, k=10, n_queries=200, seed=0):
+    """
+    Input:
+    - projections (list of (str, int, str)): (method, dimensions, transform) triples; (None, None, None) is the
+      full-dimension baseline.
+
+    Output:
+    - dict: Per configuration and metric build time, latency summary and recall@k, machine readable.
+    """
+    vectors = np.asarray(drug_diffusion_profiles, dtype=np.float32)
+    queries = np.asarray(indication_diffusion_profiles, dtype=np.float32)
+    if n_queries is not None and n_queries < len(queries):
+        queries = queries[np.random.default_rng(seed).choice(len(queries), n_queries, replace=False)]
+    map_labels_to_indices = {index: index for index in range(len(vectors))}
+
+    exact_db = ExactVectorDatabase(metrics=metrics)
+    exact_db.add_vectors(vectors)
+    exact_neighbors = {metric: exact_db.nearest_neighbors_batch(queries, metric, k) for metric in metrics}
+
+    results = {'k': k, 'n_queries': len(queries), 'n_items': len(vectors), 'dimensions': vectors.shape[1],
+               'n_trees': n_trees, 'overfetch': overfetch, 'configurations': {}}
+    for method, dimensions, transform in projections:
+        name = 'full' if method is None else '/'.join(str(part) for part in [method, dimensions, transform] if part)
+        start = time.perf_counter()
+        db = MultiMetricDatabase(vectors.shape[1], metrics=metrics, n_trees=n_trees, projection=method,
+                                 projection_dimensions=dimensions, projection_transform=transform, overfetch=overfetch)
+        db.add_vectors(vectors, map_labels_to_indices)
+        configuration = {'fit_s': time.perf_counter() - start}
+
+        for metric in metrics:
+            start = time.perf_counter()
+            db.get_index(metric)
+            build_seconds = time.perf_counter() - start
+
+            timings = []
+            neighbors = []
+            for query in queries:
+                start = time.perf_counter()
+                neighbors.append(db.nearest_neighbors(query, metric, k))
+                timings.append(time.perf_counter() - start)
+            configuration[metric] = {'build_s': build_seconds, **latency_summary(timings), 'recall': recall_at_k(neighbors, exact_neighbors[metric])}
+        results['configurations'][name] = configuration
+
+    return results
+
+
+def print_results(results):
+    print(f"k={results['k']}, {results['n_queries']} queries over {results['n_items']} items of {results['dimensions']} dimensions")
+    print(f"{'configuration':<20}{'metric':<12}{'fit s':>8}{'build s':>9}{'p50 ms':>9}{'p99 ms':>9}{'recall':>9}")
+    for name, configuration in results['configurations'].items():
+        for metric, row in configuration.items():
+            if metric != 'fit_s':
+                print(f"{name:<20}{metric:<12}{configuration['fit_s']:>8.2f}{row['build_s']:>9.2f}{row['p50_ms']:>9.3f}{row['p99_ms']:>9.3f}{row['recall']:>9.3f}")
+
+
+def parse_projection(value):
+    # 'svd:128' -> ('svd', 128, None), 'svd:128:sqrt' -> ('svd', 128, 'sqrt')
+    method, dimensions, *transform = value.split(':')
+    return method, int(dimensions), (transform or [None])[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='./data/')
+    parser.add_argument('--snapshots', default='./snapshots/')
+    parser.add_argument('--projections', nargs='+', type=parse_projection, default=[('svd', 128, None), ('svd', 128, 'sqrt'), ('svd', 256, 'sqrt'), ('pca', 256, 'sqrt'), ('random', 256, 'sqrt')],
+                        help='method:dimensions[:transform] configurations, compared with the full-dimension index')
+    parser.add_argument('--metrics', nargs='+', default=['angular', 'manhattan'])
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--overfetch', type=int, default=10)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200, help='Sample this many indications')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.data, args.snapshots)
+    results = run_reduced_ann_benchmark(snapshot.drug_diffusion_profiles, snapshot.indication_diffusion_profiles, [(None, None, None)] + args.projections,
+                                        metrics=args.metrics, n_trees=args.n_trees, overfetch=args.overfetch, k=args.k, n_queries=args.queries)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
@@ -0,0 +1,248 @@
+"""
+End-to-end performance suite: startup stages, core functions and HTTP endpoints.
+
+Stages (one run each):
+    graph_manager_s     GraphManager built from the edge TSVs
+    profile_load_s      diffusion profiles and label maps read from the .npz / .pickle inputs
+    index_build_s       one Annoy index per metric over the drug profiles
+    snapshot_build_s    the full snapshot (snapshot.build_snapshot) in a fresh directory
+    snapshot_load_s     mapping that snapshot, as every worker does at startup
+    app_import_s        importing main, which loads the snapshot and derives the lookup tables
+Functions and endpoints (latency percentiles over sampled drug / indication pairs):
+    get_drugs_for_disease per backend, get_top_k_nodes and create_subgraph per k, and the
+    /drugs_for_disease and /graph routes through an in-process ASGI client (no network).
+
+The data can be ./data/ or a synthetic MSI of any scale (benchmarks/synthetic_msi.py). The
+results are JSON, tagged with the git commit, to compare between commits.
+
+Run from the repository root:
+    python -m benchmarks.suite --data ./data/ --output suite.json
+    python -m benchmarks.suite --synthetic-scale 2 --output suite_x2.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.knn_recall import latency_summary
+from benchmarks.synthetic_msi import DEFAULT_SIZES, generate_synthetic_msi, write_synthetic_msi
+from instrumentation import STAGE_SECONDS
+from manager import GraphManager
+from snapshot import DEFAULT_SNAPSHOT_PARAMS, build_snapshot, load_snapshot
+from utils import load_data_dict
+from vector_database import MultiMetricDatabase
+
+GRAPH_KS = [20, 100, 500]
+DRUG_BACKENDS = {'table': 'correlation', 'annoy': 'manhattan', 'exact': 'correlation'}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def time_calls(function, arguments):
+    # Latency summary of function(*args) over every args tuple
+    timings = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return latency_summary(timings)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stage_benchmarks(data_path, snapshot_root, params=None):
+    """
+    Output:
+    - dict: Seconds per startup stage.
+    - Snapshot: The snapshot built in snapshot_root.
+    """
+    params = params or DEFAULT_SNAPSHOT_PARAMS
+    stages = {}
+    _, stages['graph_manager_s'] = timed(GraphManager, data_path)
+
+    start = time.perf_counter()
+    with np.load(os.path.join(data_path, 'compressed_diffusion_profiles.npz')) as data:
+        drug_diffusion_profiles = data['arr1'].astype(np.float32)
+    map_drug_labels_to_indices = load_data_dict(os.path.join(data_path, 'map_drug_labels_to_indices'))
+    load_data_dict(os.path.join(data_path, 'map_indication_labels_to_indices'))
+    stages['profile_load_s'] = time.perf_counter() - start
+
+    stages['index_build_s'] = {}
+    for metric in params['metrics']:
+        start = time.perf_counter()
+        db = MultiMetricDatabase(drug_diffusion_profiles.shape[1], metrics=[metric], n_trees=params['n_trees'])
+        db.add_vectors(drug_diffusion_profiles, map_drug_labels_to_indices)
+        db.get_index(metric)
+        stages['index_build_s'][metric] = time.perf_counter() - start
+
+    _, stages['snapshot_build_s'] = timed(build_snapshot, data_path, snapshot_root, params)
+    snapshot, stages['snapshot_load_s'] = timed(load_snapshot, data_path, snapshot_root, params)
+    return stages, snapshot
+
+
+def run_function_benchmarks(main, pairs, graph_ks=GRAPH_KS):
+    """
+    Input:
+    - main (module): The imported app module.
+    - pairs (list of (str, str)): (indication label, drug label) queries.
+
+    Output:
+    - dict: Latency summary per function and parameter.
+    """
+    graph_manager = main.graph_manager
+    results = {}
+    for backend, metric in DRUG_BACKENDS.items():
+        results[f'get_drugs_for_disease/{backend}/{metric}'] = time_calls(main.get_drugs_for_disease, [(indication, metric, backend) for indication, _ in pairs])
+
+    profiles = [np.asarray(main.drug_diffusion_profiles[main.map_drug_diffusion_labels_to_indices[drug]]) for _, drug in pairs]
+    for k in graph_ks:
+        results[f'get_top_k_nodes/k={k}'] = time_calls(graph_manager.get_top_k_nodes, [(profile, k) for profile in profiles])
+        node_ids = [main.get_MOA_ranked_node_ids(indication, drug, k, k) for indication, drug in pairs]
+        results[f'create_subgraph/k={k}'] = time_calls(graph_manager.create_subgraph, [(ids,) for ids in node_ids])
+    return results
+
+
+async def time_requests(app, requests):
+    import httpx
+
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    timings = []
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        for url, body, headers in requests:
+            start = time.perf_counter()
+            response = await client.post(url, json=body, headers=headers)
+            await response.aread()
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, f"{url} returned {response.status_code}: {response.text[:200]}"
+    return latency_summary(timings)
+
+
+def run_endpoint_benchmarks(main, pairs, graph_ks=GRAPH_KS):
+    """
+    Output:
+    - dict: Latency summary per route and parameters, measured through the ASGI app.
+    """
+    results = {}
+    for backend, metric in DRUG_BACKENDS.items():
+        requests = [('/drugs_for_disease', {'disease_label': indication, 'metric': metric, 'backend': backend}, {}) for indication, _ in pairs]
+        results[f'/drugs_for_disease/{backend}/{metric}'] = asyncio.run(time_requests(main.app, requests))
+
+    for k in graph_ks:
+        for graph_format in ['json', main.GRAPH_BINARY]:
+            requests = [('/graph', {'disease_label': indication, 'drug_label': drug, 'k1': k, 'k2': k}, {'accept': graph_format}) for indication, drug in pairs]
+            results[f'/graph/k={k}/{graph_format.split("/")[-1]}'] = asyncio.run(time_requests(main.app, requests))
+    return results
+
+
+def run_suite(data_path, snapshot_root, n_queries=100, graph_ks=GRAPH_KS, seed=0):
+    """
+    Output:
+    - dict: Metadata, stage timings and function / endpoint latency summaries, machine readable.
+    """
+    stages, snapshot = run_stage_benchmarks(data_path, snapshot_root)
+
+    # main reads its data location from the environment at import
+    os.environ['MSI_DATA_PATH'] = data_path
+    os.environ['MSI_SNAPSHOT_ROOT'] = snapshot_root
+    start = time.perf_counter()
+    main = importlib.reload(sys.modules['main']) if 'main' in sys.modules else importlib.import_module('main')
+    stages['app_import_s'] = time.perf_counter() - start
+
+    rng = np.random.default_rng(seed)
+    indications = rng.choice(main.indication_labels_by_index, n_queries)
+    drugs = rng.choice(main.drug_labels_by_index, n_queries)
+    pairs = list(zip(indications.tolist(), drugs.tolist()))
+    graph_ks = [k for k in graph_ks if k <= main.graph_manager.MSI_size_graph]
+
+    functions = run_function_benchmarks(main, pairs, graph_ks)
+    endpoints = run_endpoint_benchmarks(main, pairs, graph_ks)
+
+    # Mean time per request stage, from the same histograms /metrics exposes
+    stage_means = {f'{endpoint or "direct"}/{name}': state[-2] / state[-1] * 1000 for (endpoint, name), state in sorted(STAGE_SECONDS.values.items())}
+
+    graph_manager = snapshot.graph_manager
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'data_path': data_path,
+            'snapshot_key': snapshot.key,
+            'n_queries': n_queries,
+        },
+        'data': {
+            'n_nodes': graph_manager.MSI_size_graph,
+            'n_edges': graph_manager.MSI.n_edges,
+            'n_drugs': len(snapshot.map_drug_diffusion_labels_to_indices),
+            'n_indications': len(snapshot.map_indication_diffusion_labels_to_indices),
+        },
+        'stages': stages,
+        'functions': functions,
+        'endpoints': endpoints,
+        'stage_mean_ms': stage_means,
+    }
+
+
+def print_results(results):
+    data = results['data']
+    print(f"{data['n_nodes']} nodes, {data['n_edges']} edges, {data['n_drugs']} drugs, {data['n_indications']} indications")
+    for stage, seconds in results['stages'].items():
+        if isinstance(seconds, dict):
+            seconds = sum(seconds.values())
+        print(f"{stage:<40}{seconds:>10.2f} s")
+    print(f"{'':<40}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for group in ['functions', 'endpoints']:
+        for name, row in results[group].items():
+            print(f"{name:<40}{row['p50_ms']:>10.3f}{row['p90_ms']:>10.3f}{row['p99_ms']:>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='./data/')
+    parser.add_argument('--synthetic-scale', type=float, default=None,
+                        help='Benchmark a synthetic MSI this many times the size of the bundled one instead of --data')
+    parser.add_argument('--snapshots', default=None, help='Snapshot directory to build into (default a temporary one)')
+    parser.add_argument('--queries', type=int, default=100, help='Sampled indication / drug pairs per measurement')
+    parser.add_argument('--graph-ks', type=int, nargs='+', default=GRAPH_KS, help='k1 = k2 values of the /graph measurements')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='msi-suite-') as directory:
+        data_path = args.data
+        if args.synthetic_scale is not None:
+            data_path = os.path.join(directory, 'data', '')
+            sizes = {node_type: max(1, int(round(size * args.synthetic_scale))) for node_type, size in DEFAULT_SIZES.items()}
+            write_synthetic_msi(data_path, generate_synthetic_msi(sizes, seed=args.seed))
+        snapshot_root = args.snapshots or os.path.join(directory, 'snapshots')
+
+        results = run_suite(data_path, snapshot_root, n_queries=args.queries, graph_ks=args.graph_ks, seed=args.seed)
+        if args.synthetic_scale is not None:
+            results['meta']['synthetic_scale'] = args.synthetic_scale
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
@@ -0,0 +1,178 @@
+"""
+Synthetic multiscale interactomes of any size, in the same layout as ./data/.
+
+Writes the five edge TSVs (node_1, node_2, node_1_type, node_2_type, node_1_name, node_2_name)
+and, unless --no-profiles, the diffusion profiles and label maps computed by diffusion.py, so
+the result can be served and benchmarked like the real data. The defaults are close to the
+bundled MSI; --scale multiplies every node count.
+
+Degrees follow the shape of the real files: the number of targets of a drug, indication or
+protein is log-normal, and the proteins and biological functions they attach to are drawn
+with power-law popularity, so a few hubs collect most edges. Biological functions form a DAG
+from specific terms to more general ones.
+
+Run from the repository root:
+    python -m benchmarks.synthetic_msi --output ./synthetic_data/ --scale 4
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from ingestion import EDGE_FILES
+
+# Node type names used in the TSVs, per node type of ingestion.EDGE_FILES
+TSV_NODE_TYPES = {'drug': 'drug', 'indication': 'indication', 'protein': 'protein', 'bio': 'biological_function'}
+
+DEFAULT_SIZES = {'drug': 1661, 'indication': 840, 'protein': 10000, 'bio': 10000}
+
+# Mean out-degree of each edge file, measured on the bundled MSI (no protein-protein edges ship with it)
+DEFAULT_MEAN_DEGREES = {'drug_to_protein': 5.2, 'indication_to_protein': 30.0, 'protein_to_protein': 0.0, 'protein_to_bio': 4.4, 'bio_to_bio': 2.3}
+
+
+def power_law_weights(n, exponent, rng):
+    # Popularity of n nodes, proportional to rank^-exponent, in random order
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+    return rng.permutation(weights / weights.sum())
+
+
+def log_normal_degrees(n, mean_degree, sigma, max_degree, rng):
+    # At least one edge per node, so every drug and indication has a profile
+    degrees = np.rint(rng.lognormal(np.log(mean_degree) - sigma ** 2 / 2, sigma, n))
+    return np.clip(degrees, 1, max_degree).astype(np.int64)
+
+
+def unique_pairs(sources, targets):
+    pairs = np.unique(np.stack([sources, targets], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def sample_bipartite_edges(n_sources, n_targets, mean_degree, sigma, target_weights, rng):
+    """
+    Output:
+    - numpy array, numpy array: Source and target positions of the edges, without duplicates.
+    """
+    degrees = log_normal_degrees(n_sources, mean_degree, sigma, n_targets, rng)
+    sources = np.repeat(np.arange(n_sources), degrees)
+    targets = rng.choice(n_targets, size=len(sources), p=target_weights)
+    return unique_pairs(sources, targets)
+
+
+def sample_hierarchy_edges(n_terms, mean_parents, n_roots, rng, bias=2.0):
+    """
+    Child -> parent edges of a DAG: every term but the roots gets parents among the terms before
+    it, skewed towards the first (most general) ones.
+    """
+    children = np.arange(n_roots, n_terms)
+    n_parents = 1 + rng.poisson(max(mean_parents - 1, 0), len(children))
+    children = np.repeat(children, n_parents)
+    parents = np.floor(children * rng.random(len(children)) ** bias).astype(np.int64)
+    return unique_pairs(children, parents)
+
+
+def node_labels(node_type, n):
+    if node_type == 'drug':
+        return np.char.add('DB', np.char.zfill(np.arange(n).astype(str), 5))
+    if node_type == 'indication':
+        return np.char.add('C', np.char.zfill(np.arange(n).astype(str), 7))
+    if node_type == 'bio':
+        return np.char.add('GO:', np.char.zfill(np.arange(n).astype(str), 7))
+    return (np.arange(n) + 1).astype(str)
+
+
+def node_names(node_type, n):
+    # Numbered like the labels, so protein 1 is called 'synthetic protein 1'
+    numbers = np.arange(n) + (node_type == 'protein')
+    return np.char.add(f'synthetic {TSV_NODE_TYPES[node_type].replace("_", " ")} ', numbers.astype(str))
+
+
+def generate_synthetic_msi(sizes=None, mean_degrees=None, exponent=1.0, sigma=0.8, seed=0):
+    """
+    Input:
+    - sizes (dict): Number of 'drug', 'indication', 'protein' and 'bio' nodes.
+    - mean_degrees (dict): Mean out-degree per edge type of ingestion.EDGE_FILES.
+    - exponent (float): Power-law exponent of protein and biological function popularity.
+    - sigma (float): Spread of the log-normal out-degrees.
+
+    Output:
+    - dict: Edge type -> DataFrame in the TSV schema.
+    """
+    sizes = {**DEFAULT_SIZES, **(sizes or {})}
+    mean_degrees = {**DEFAULT_MEAN_DEGREES, **(mean_degrees or {})}
+    rng = np.random.default_rng(seed)
+
+    # Drugs and indications share protein popularity, so they meet on the same hubs
+    protein_weights = power_law_weights(sizes['protein'], exponent, rng)
+    bio_weights = power_law_weights(sizes['bio'], exponent, rng)
+
+    edges = {}
+    for edge_type, _, source_type, target_type in EDGE_FILES:
+        mean_degree = mean_degrees[edge_type]
+        if mean_degree <= 0:
+            sources = targets = np.empty(0, dtype=np.int64)
+        elif edge_type == 'bio_to_bio':
+            sources, targets = sample_hierarchy_edges(sizes['bio'], mean_degree, n_roots=max(1, sizes['bio'] // 1000), rng=rng)
+        else:
+            target_weights = protein_weights if target_type == 'protein' else bio_weights
+            sources, targets = sample_bipartite_edges(sizes[source_type], sizes[target_type], mean_degree, sigma, target_weights, rng)
+            if source_type == target_type:
+                keep = sources != targets
+                sources, targets = sources[keep], targets[keep]
+
+        edges[edge_type] = pd.DataFrame({
+            'node_1': node_labels(source_type, sizes[source_type])[sources],
+            'node_2': node_labels(target_type, sizes[target_type])[targets],
+            'node_1_type': TSV_NODE_TYPES[source_type],
+            'node_2_type': TSV_NODE_TYPES[target_type],
+            'node_1_name': node_names(source_type, sizes[source_type])[sources],
+            'node_2_name': node_names(target_type, sizes[target_type])[targets],
+        })
+    return edges
+
+
+def write_synthetic_msi(output_path, edges, profiles=True, verbose=False):
+    """
+    Write the edge files and, if profiles, the diffusion profiles and label maps to output_path.
+
+    Output:
+    - dict: Edge and node counts and timings, machine readable.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    output_path = os.path.join(output_path, '')
+    start = time.perf_counter()
+    for edge_type, file_name, _, _ in EDGE_FILES:
+        edges[edge_type].to_csv(os.path.join(output_path, file_name), sep='\t', index=False)
+    summary = {'n_edges': {edge_type: len(data_frame) for edge_type, data_frame in edges.items()}, 'write_s': time.perf_counter() - start}
+
+    if profiles:
+        from diffusion import build_diffusion_profiles, save_diffusion_profiles
+        from manager import GraphManager
+
+        graph_manager = GraphManager(output_path)
+        summary['n_nodes'] = graph_manager.MSI_size_graph
+        start = time.perf_counter()
+        drug_profiles, map_drug_labels_to_indices, indication_profiles, map_indication_labels_to_indices = build_diffusion_profiles(graph_manager, verbose=verbose)
+        summary['diffusion_s'] = time.perf_counter() - start
+        save_diffusion_profiles(output_path, drug_profiles, map_drug_labels_to_indices, indication_profiles, map_indication_labels_to_indices)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='Directory to write the data files to')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply every node count')
+    for node_type, size in DEFAULT_SIZES.items():
+        parser.add_argument(f'--{node_type}s', type=int, default=None, help=f'Number of {TSV_NODE_TYPES[node_type]} nodes (default {size} x scale)')
+    parser.add_argument('--ppi-degree', type=float, default=DEFAULT_MEAN_DEGREES['protein_to_protein'], help='Mean protein-protein degree')
+    parser.add_argument('--exponent', type=float, default=1.0, help='Power-law exponent of target popularity')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-profiles', action='store_true', help='Only write the edge files')
+    args = parser.parse_args()
+
+    sizes = {node_type: getattr(args, f'{node_type}s') or max(1, int(round(size * args.scale))) for node_type, size in DEFAULT_SIZES.items()}
+    edges = generate_synthetic_msi(sizes, {'protein_to_protein': args.ppi_degree}, exponent=args.exponent, seed=args.seed)
+    summary = write_synthetic_msi(args.output, edges, profiles=not args.no_profiles, verbose=True)
+    print(json.dumps({'sizes': sizes, **summary}, indent=2))
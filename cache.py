@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from instrumentation import REGISTRY
+
+
+#===================================================================
+# In-process response caches
+#===================================================================
+# LRUCache holds computed results (encoded /graph bodies, drug candidate lists) bounded both by
+# entry count and by an estimate of their memory. Keys include the snapshot key, so results
+# computed from other data are never served.
+#
+# PreparedPayload holds a response body that only changes with the data (/diseases, /drugs),
+# serialized and compressed once, with a strong ETag per encoding for conditional requests.
+
+CACHE_REQUESTS = REGISTRY.counter('msi_cache_requests_total', 'Cache lookups by cache and result (hit or miss).', ['cache', 'result'])
+CACHE_EVICTIONS = REGISTRY.counter('msi_cache_evictions_total', 'Entries evicted to stay within the entry or memory bound.', ['cache'])
+
+
+def estimate_size(value):
+    """
+    Rough memory footprint of a cached value in bytes: exact for bytes and str payloads,
+    containers are summed recursively.
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    def __init__(self, name, max_entries=1024, max_bytes=64 << 20, sizeof=estimate_size):
+        """
+        Input:
+        - name (str): Label of the cache's counters in /metrics.
+        - max_entries (int), max_bytes (int): Least recently used entries are evicted beyond either bound.
+        - sizeof (function): Size in bytes of a value.
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        CACHE_REQUESTS.inc(self.name, 'miss' if entry is None else 'hit')
+        return default if entry is None else entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            evicted = 0
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            CACHE_EVICTIONS.inc(self.name, amount=evicted)
+
+    def keys(self):
+        # A copy, safe to iterate while other threads use the cache; does not count as lookups
+        with self.lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+#===================================================================
+# Pre-serialized payloads with HTTP caching
+#===================================================================
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses tied to a snapshot may be reused this long without asking; after that a conditional
+# request revalidates them with the ETag for a 304
+STATIC_CACHE_CONTROL = 'public, max-age=300, must-revalidate'
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Output:
+    - dict: q value of each coding named in an Accept-Encoding header, 1 when not given.
+    """
+    qualities = {}
+    for part in (accept_encoding or '').split(','):
+        coding, *parameters = [item.strip() for item in part.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+class PreparedPayload:
+    def __init__(self, body, version, media_type='application/json', cache_control=STATIC_CACHE_CONTROL):
+        """
+        Input:
+        - body (bytes): The uncompressed response body.
+        - version (str): Data version the body was built from (the snapshot key); part of the ETags.
+        """
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body)
+        # Strong ETags differ between encodings of the same body
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.etags = {encoding: f'"{version}-{digest}' + ('' if encoding == 'identity' else f'-{encoding}') + '"' for encoding in self.variants}
+
+    def select(self, accept_encoding=None, if_none_match=None):
+        """
+        Pick the response for a request's Accept-Encoding and If-None-Match headers.
+
+        Output:
+        - int: Status code, 200 or 304.
+        - bytes: Body, empty for 304.
+        - dict: Response headers.
+        """
+        qualities = parse_accept_encoding(accept_encoding)
+        # Highest q first, br before gzip on a tie; q=0 refuses a coding, and * stands for the unlisted ones
+        accepted = [encoding for encoding in ['br', 'gzip'] if encoding in self.variants and qualities.get(encoding, qualities.get('*', 0)) > 0]
+        encoding = max(accepted, key=lambda encoding: qualities.get(encoding, qualities.get('*', 0)), default='identity')
+
+        headers = {'ETag': self.etags[encoding], 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if '*' in tags or self.etags[encoding] in tags:
+                return 304, b'', headers
+        return 200, self.variants[encoding], headers
+
+
+def test_cache():
+    cache = LRUCache('test', max_entries=3, max_bytes=1 << 20, sizeof=len)
+    for key in 'abc':
+        cache.put(key, key * 10)
+    assert cache.get('a') == 'a' * 10
+    cache.put('d', 'd' * 10)
+    # b was the least recently used after a was read
+    assert cache.get('b') is None and cache.get('a') is not None and len(cache) == 3
+
+    # The memory bound evicts as many entries as needed
+    cache.put('e', 'e' * ((1 << 20) - 5))
+    assert list(cache.entries) == ['e'] and cache.nbytes == (1 << 20) - 5
+    cache.put('f', 'f' * ((1 << 20) + 1))
+    assert cache.get('f') is None and cache.stats()['evictions'] == 4
+
+    payload = PreparedPayload(b'[' + b'{"value": "C1", "name": "disease"},' * 100 + b'{}]', version='abc')
+    status, body, headers = payload.select('gzip, deflate')
+    assert status == 200 and gzip.decompress(body) == payload.variants['identity'] and headers['Content-Encoding'] == 'gzip'
+    status, body, headers = payload.select('gzip', if_none_match=headers['ETag'])
+    assert status == 304 and body == b''
+    # The ETag of the gzip body does not validate the identity one
+    status, _, headers = payload.select(None, if_none_match=payload.etags['gzip'])
+    assert status == 200 and 'Content-Encoding' not in headers and headers['ETag'].startswith('"abc-')
+    # q=0 refuses a coding, also through the wildcard
+    for accept_encoding in ['gzip;q=0, deflate', 'br;q=0, gzip; q=0', '*;q=0', 'identity']:
+        assert 'Content-Encoding' not in payload.select(accept_encoding)[2], accept_encoding
+    assert payload.select('br;q=0, gzip;q=0.5')[2]['Content-Encoding'] == 'gzip'
+    assert payload.select('*')[2]['Content-Encoding'] in ('br', 'gzip')
+
+    print("All tests passed.")
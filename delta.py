@@ -0,0 +1,334 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from diffusion import DiffusionEngine, create_transition_matrix
+from graph_core import NODE_TYPE_CODES
+from ingestion import COLUMNS, EDGE_FILES, EDGE_TYPE_CODES, MSITables, load_msi_tables, read_edge_file
+from manager import GraphManager
+from snapshot import compute_snapshot_key, load_snapshot, publish_current_key, publish_snapshot, snapshot_input_files, write_snapshot
+from utils import load_data_dict, save_data_dict
+
+
+#===================================================================
+# Incremental data updates
+#===================================================================
+# A delta is a directory with edge files named like the ones in data/:
+#
+#   <delta>/added/1_drug_to_protein.tsv      edges to add, same columns as the data files
+#   <delta>/removed/1_drug_to_protein.tsv    edges to remove, matched on (node_1, node_2)
+#
+# apply_delta derives the next snapshot from the one being served instead of rebuilding it:
+#   - node ids are kept and new labels appended, so existing profile columns stay valid
+#   - a profile only changes if its seed can reach a node whose transition row changed.
+#     Drugs and indications have no incoming edges, so a drug's new targets change its own
+#     profile only, while a protein or GO edge changes every profile that reaches it.
+#     Only those profiles are recomputed; new drugs and indications get a row appended. The
+#     others are taken from the float32 profiles in data/, never from the snapshot, whose
+#     profile encoding may be lossy (see profile_store.py)
+#   - the Annoy forests are extended (vector_database.extend_vector_indexes) and the drug
+#     ranking tables updated row by row (ranking.update_ranking_table); the exact indexes and
+#     node rank tables are recomputed from the profiles, which takes seconds
+# The updated edge files, profiles and label maps are written back to data/ (profile columns in
+# the order a full ingest numbers the nodes), so a full rebuild reproduces the same data and the
+# new snapshot carries the key of the updated data/. Finally CURRENT is pointed at it, and
+# serving workers switch over without a restart.
+#
+# Removing every edge of a node removes the node, which shifts ids; that needs a full rebuild.
+
+DELTA_KINDS = ['added', 'removed']
+
+
+def read_delta(delta_path):
+    """
+    Output:
+    - dict: (kind, edge type) -> DataFrame of the edges, for every edge file in the delta.
+    """
+    delta = {}
+    for kind in DELTA_KINDS:
+        for edge_type, file_name, _, _ in EDGE_FILES:
+            path = os.path.join(delta_path, kind, file_name)
+            if os.path.exists(path):
+                delta[kind, edge_type] = read_edge_file(path) if kind == 'added' else pd.read_csv(path, sep='\t', usecols=['node_1', 'node_2'], dtype=str, na_filter=False)
+    assert delta, f"No edge files found in {delta_path}/added or {delta_path}/removed."
+    return delta
+
+
+def update_tables(tables, delta):
+    """
+    Apply a delta to the columnar MSI. Existing nodes keep their ids; new labels are appended
+    in order of appearance, typed by the edge file they first appear in.
+
+    Output:
+    - MSITables
+    """
+    labels = tables.labels.tolist()
+    mapping_label_to_index = {label: index for index, label in enumerate(labels)}
+    names = np.asarray(tables.names, dtype=object).tolist()
+    node_types = np.asarray(tables.node_types).tolist()
+
+    def intern(label, name, node_type):
+        index = mapping_label_to_index.get(label)
+        if index is None:
+            index = mapping_label_to_index[label] = len(labels)
+            labels.append(label)
+            names.append(name or label)
+            node_types.append(NODE_TYPE_CODES[node_type])
+        elif name:
+            names[index] = name
+        return index
+
+    n_nodes = len(labels)
+    edge_keys = np.asarray(tables.edge_sources, dtype=np.int64) * n_nodes + np.asarray(tables.edge_targets, dtype=np.int64)
+    keep = np.ones(len(edge_keys), dtype=bool)
+    sources, targets, edge_types = [], [], []
+    for edge_type, _, node_type_1, node_type_2 in EDGE_FILES:
+        removed = delta.get(('removed', edge_type))
+        if removed is not None and len(removed):
+            known = removed['node_1'].isin(mapping_label_to_index) & removed['node_2'].isin(mapping_label_to_index)
+            removed_keys = [mapping_label_to_index[node_1] * n_nodes + mapping_label_to_index[node_2] for node_1, node_2 in removed[known][['node_1', 'node_2']].itertuples(index=False)]
+            matches = (np.asarray(tables.edge_types) == EDGE_TYPE_CODES[edge_type]) & np.isin(edge_keys, removed_keys)
+            if len(np.unique(edge_keys[matches])) < len(set(removed_keys)) or not known.all():
+                warnings.warn(f"Some removed {edge_type} edges are not in the MSI")
+            keep &= ~matches
+
+        added = delta.get(('added', edge_type))
+        if added is not None:
+            for node_1, node_2, node_1_name, node_2_name in added[COLUMNS].itertuples(index=False):
+                sources.append(intern(node_1, node_1_name, node_type_1))
+                targets.append(intern(node_2, node_2_name, node_type_2))
+                edge_types.append(EDGE_TYPE_CODES[edge_type])
+
+    edge_sources = np.concatenate([np.asarray(tables.edge_sources)[keep], np.array(sources, dtype=np.int32)])
+    edge_targets = np.concatenate([np.asarray(tables.edge_targets)[keep], np.array(targets, dtype=np.int32)])
+    isolated = np.flatnonzero(np.bincount(edge_sources, minlength=len(labels)) + np.bincount(edge_targets, minlength=len(labels)) == 0)
+    if len(isolated):
+        raise ValueError(f"The delta removes every edge of {[labels[index] for index in isolated[:10]]}; removing nodes needs a full rebuild")
+
+    return MSITables(
+        labels=np.array(labels, dtype=str),
+        names=np.array(names, dtype=str),
+        node_types=np.array(node_types, dtype=np.int8),
+        edge_sources=edge_sources,
+        edge_targets=edge_targets,
+        edge_types=np.concatenate([np.asarray(tables.edge_types)[keep], np.array(edge_types, dtype=np.int8)]),
+    )
+
+
+def affected_nodes(old_transition_matrix, new_transition_matrix):
+    """
+    Nodes whose diffusion profile differs between two transition matrices: those that can reach
+    a node whose row changed. Nodes appended to the new matrix have empty rows in the old one.
+
+    Output:
+    - numpy array (n_nodes,) of bool, over the nodes of the new matrix.
+    """
+    n_nodes, n_old_nodes = new_transition_matrix.shape[0], old_transition_matrix.shape[0]
+    indptr = np.concatenate([old_transition_matrix.indptr, np.full(n_nodes - n_old_nodes, old_transition_matrix.indptr[-1])])
+    old_transition_matrix = sp.csr_matrix((old_transition_matrix.data, old_transition_matrix.indices, indptr), shape=(n_nodes, n_nodes))
+
+    reached = np.zeros(n_nodes, dtype=bool)
+    reached[np.unique((new_transition_matrix != old_transition_matrix).nonzero()[0])] = True
+
+    # Walk the edges backwards from the changed rows
+    adjacency = sp.csr_matrix((np.ones(new_transition_matrix.nnz), new_transition_matrix.indices, new_transition_matrix.indptr), shape=(n_nodes, n_nodes))
+    frontier = reached.copy()
+    while frontier.any():
+        frontier = (adjacency @ frontier.astype(np.float64) > 0) & ~reached
+        reached |= frontier
+    return reached
+
+
+def load_source_profiles(data_path, base):
+    """
+    The float32 profiles in data/, with columns in the base snapshot's node order. After earlier
+    deltas that is not the order a full ingest of data/ gives, so columns are matched by label.
+
+    Output:
+    - dict: Kind -> float32 profiles, rows in the base snapshot's order.
+    """
+    ingested_labels = load_msi_tables(data_path).labels
+    columns = np.array([base.graph_manager.mapping_label_to_index[label] for label in ingested_labels.tolist()])
+    profiles = {}
+    with np.load(os.path.join(data_path, 'compressed_diffusion_profiles.npz')) as data:
+        for kind, name, stored in [('drug', 'arr1', base.drug_diffusion_profiles), ('indication', 'arr2', base.indication_diffusion_profiles)]:
+            source = data[name].astype(np.float32)
+            assert source.shape == stored.shape, f"The {kind} profiles in {data_path} do not match snapshot {base.key}."
+            profiles[kind] = np.empty_like(source)
+            profiles[kind][:, columns] = source
+    return profiles
+
+
+def update_profiles(base, graph_manager, affected, engine, source_profiles, verbose=False):
+    """
+    Profiles of the updated MSI from those of the base snapshot.
+
+    Input:
+    - source_profiles (dict): Kind -> float32 profiles of the base snapshot (load_source_profiles).
+
+    Output:
+    - dict: Kind -> float32 profiles, one column per node of graph_manager.
+    - dict: Kind -> label of every row; new drugs and indications are appended.
+    - dict: Kind -> rows that were recomputed or appended.
+    """
+    n_old_nodes, n_nodes = base.graph_manager.MSI_size_graph, graph_manager.MSI_size_graph
+    profiles, labels, changed_rows = {}, {}, {}
+    for kind, map_labels_to_indices in [('drug', base.map_drug_diffusion_labels_to_indices), ('indication', base.map_indication_diffusion_labels_to_indices)]:
+        old_profiles = source_profiles[kind]
+        new_nodes = np.flatnonzero(graph_manager.node_types[n_old_nodes:] == NODE_TYPE_CODES[kind]) + n_old_nodes
+        labels[kind] = np.concatenate([np.array(sorted(map_labels_to_indices, key=map_labels_to_indices.get), dtype=str), graph_manager.node_labels[new_nodes]])
+        seeds = np.array([graph_manager.mapping_label_to_index[label] for label in labels[kind].tolist()], dtype=np.int64)
+
+        # Columns of new nodes are zero in every profile that cannot reach them
+        profiles[kind] = np.zeros((len(labels[kind]), n_nodes), dtype=np.float32)
+        profiles[kind][:len(old_profiles), :n_old_nodes] = old_profiles
+        changed_rows[kind] = np.flatnonzero(affected[seeds])
+        if len(changed_rows[kind]):
+            profiles[kind][changed_rows[kind]] = engine.compute_profiles(seeds[changed_rows[kind]].tolist(), verbose=verbose)
+    return profiles, labels, changed_rows
+
+
+def stage_data_files(data_path, staging_path, delta, graph_manager, profiles, labels):
+    # The updated data/ inputs, written next to the current ones and moved into place once the snapshot exists
+    for edge_type, file_name, _, _ in EDGE_FILES:
+        path = os.path.join(data_path, file_name)
+        if ('added', edge_type) not in delta and ('removed', edge_type) not in delta:
+            if os.path.exists(path):
+                shutil.copy2(path, os.path.join(staging_path, file_name))
+            continue
+        edges = pd.read_csv(path, sep='\t', dtype=str, na_filter=False) if os.path.exists(path) else pd.DataFrame(columns=COLUMNS)
+        removed = delta.get(('removed', edge_type))
+        if removed is not None:
+            edges = edges[~pd.MultiIndex.from_frame(edges[['node_1', 'node_2']]).isin(pd.MultiIndex.from_frame(removed))]
+        if ('added', edge_type) in delta:
+            edges = pd.concat([edges, delta['added', edge_type]], ignore_index=True).fillna('')
+        edges.to_csv(os.path.join(staging_path, file_name), sep='\t', index=False)
+
+    # Profile columns follow the node order a full ingest of the updated files gives
+    ingested_labels = load_msi_tables(staging_path).labels
+    assert len(ingested_labels) == graph_manager.MSI_size_graph, "The updated edge files do not cover the updated MSI."
+    columns = np.array([graph_manager.mapping_label_to_index[label] for label in ingested_labels.tolist()])
+    np.savez_compressed(os.path.join(staging_path, 'compressed_diffusion_profiles.npz'), arr1=profiles['drug'][:, columns], arr2=profiles['indication'][:, columns])
+    for kind in ['drug', 'indication']:
+        save_data_dict(os.path.join(staging_path, f'map_{kind}_labels_to_indices'), {label: index for index, label in enumerate(labels[kind].tolist())})
+
+
+def apply_delta(delta_path, data_path='./data/', snapshot_root='./snapshots/', params=None, verbose=False):
+    """
+    Apply an edge delta to data/ and publish the snapshot of the result, derived from the
+    current one (see the section comment).
+
+    Output:
+    - str: Path of the new snapshot.
+    - dict: What changed and how long each step took, machine readable.
+    """
+    timings = {}
+    start = time.perf_counter()
+    base = load_snapshot(data_path, snapshot_root, params)
+    params = base.params
+    delta = read_delta(delta_path)
+    graph_manager = GraphManager(tables=update_tables(base.graph_manager.tables, delta))
+    timings['graph_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_transition_matrix = create_transition_matrix(graph_manager.create_H_graph())
+    affected = affected_nodes(create_transition_matrix(base.graph_manager.create_H_graph()), new_transition_matrix)
+    profiles, labels, changed_rows = update_profiles(base, graph_manager, affected, DiffusionEngine(new_transition_matrix), load_source_profiles(data_path, base), verbose=verbose)
+    timings['profiles_s'] = time.perf_counter() - start
+
+    summary = {
+        'base': base.key,
+        'edges': {f'{kind}/{edge_type}': len(edges) for (kind, edge_type), edges in delta.items()},
+        'new_nodes': graph_manager.MSI_size_graph - base.graph_manager.MSI_size_graph,
+        'recomputed_profiles': {kind: len(rows) for kind, rows in changed_rows.items()},
+        'timings': timings,
+    }
+
+    staging_path = tempfile.mkdtemp(prefix='.delta-', dir=data_path)
+    try:
+        start = time.perf_counter()
+        stage_data_files(data_path, staging_path, delta, graph_manager, profiles, labels)
+        # Same key as a full build from the updated data/ would have
+        key = compute_snapshot_key(staging_path, params)
+        timings['data_s'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        snapshot_path = publish_snapshot(snapshot_root, key, lambda build_path: write_snapshot(
+            build_path, key, params, graph_manager, profiles, labels, base_path=base.path, changed_rows=changed_rows,
+            manifest_extra={'delta': summary}))
+        timings['snapshot_s'] = time.perf_counter() - start
+
+        for path in snapshot_input_files(staging_path):
+            os.replace(path, os.path.join(data_path, os.path.basename(path)))
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    publish_current_key(snapshot_root, key)
+    return snapshot_path, {'key': key, **summary}
+
+
+def test_apply_delta():
+    from benchmarks.synthetic_msi import generate_synthetic_msi, write_synthetic_msi
+    from snapshot import DEFAULT_SNAPSHOT_PARAMS
+
+    def read_profiles(data_path):
+        # Kind -> {label: {column label: value}} of the data/ profiles
+        labels = load_msi_tables(data_path).labels
+        profiles = {}
+        with np.load(os.path.join(data_path, 'compressed_diffusion_profiles.npz')) as data:
+            for kind, name in [('drug', 'arr1'), ('indication', 'arr2')]:
+                map_labels_to_indices = load_data_dict(os.path.join(data_path, f'map_{kind}_labels_to_indices'))
+                profiles[kind] = {label: dict(zip(labels.tolist(), data[name][row].tolist())) for label, row in map_labels_to_indices.items()}
+        return profiles
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_path, snapshot_root = os.path.join(directory, 'data', ''), os.path.join(directory, 'snapshots', '')
+        edges = generate_synthetic_msi({'drug': 30, 'indication': 20, 'protein': 200, 'bio': 150}, seed=1)
+        write_synthetic_msi(data_path, edges)
+        # Served from lossy int8 profiles
+        params = {**DEFAULT_SNAPSHOT_PARAMS, 'profile_encoding': 'int8', 'n_trees': 2, 'ranking_top_n': 10, 'node_rank_top_n': 32}
+        load_snapshot(data_path, snapshot_root, params)
+
+        # Each delta gives one drug a new target and adds a drug, so only those two profiles change.
+        # The second applies to a snapshot derived by the first, whose node order is not data/'s.
+        drug_edges, protein = edges['drug_to_protein'], edges['protein_to_bio']['node_1'].iloc[0]
+        for step, (drug, new_drug) in enumerate([(drug_edges['node_1'].iloc[0], 'DB99998'), (drug_edges['node_1'].iloc[-1], 'DB99999')]):
+            before = read_profiles(data_path)
+            delta_path = os.path.join(directory, f'delta{step}', '')
+            os.makedirs(os.path.join(delta_path, 'added'))
+            added = pd.concat([drug_edges[drug_edges['node_1'] == drug].head(1).assign(node_2=protein), drug_edges.head(2).assign(node_1=new_drug, node_1_name='new drug')])
+            added.to_csv(os.path.join(delta_path, 'added', '1_drug_to_protein.tsv'), sep='\t', index=False)
+
+            snapshot_path, summary = apply_delta(delta_path, data_path, snapshot_root, params)
+            assert summary['recomputed_profiles'] == {'drug': 2, 'indication': 0}, summary
+            assert not [file_name for file_name in os.listdir(snapshot_path) if '_exact_' in file_name]
+            after = read_profiles(data_path)
+
+            # Every other profile in data/ is unchanged, bit for bit; none picked up int8 rounding,
+            # and the new drug's column is 0 in all of them
+            for kind in ['drug', 'indication']:
+                for label, profile in before[kind].items():
+                    if label != drug:
+                        assert {column: after[kind][label][column] for column in profile} == profile, f"The {kind} profile of {label} changed."
+                        assert after[kind][label][new_drug] == 0.0
+            assert after['drug'][drug] != before['drug'][drug] and new_drug in after['drug']
+
+    print("All tests passed.")
+
+
+if __name__ == '__main__':
+    delta_path = sys.argv[1]
+    data_path = sys.argv[2] if len(sys.argv) > 2 else './data/'
+    snapshot_root = sys.argv[3] if len(sys.argv) > 3 else './snapshots/'
+
+    snapshot_path, summary = apply_delta(delta_path, data_path, snapshot_root, verbose=True)
+    print(f'Snapshot {snapshot_path} published')
+    print(json.dumps(summary, indent=2))
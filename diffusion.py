@@ -0,0 +1,328 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import save_data_dict
+
+
+#===================================================================
+# Random walk with restart (RWR) engine
+#===================================================================
+# A diffusion profile r(s) is the stationary distribution of a walker that starts at the
+# seed node(s) s, follows an edge of the weighted MSI with probability alpha and jumps back
+# to the seed with probability 1 - alpha:
+#
+#     r = (1 - alpha) * e_s + alpha * P^T r
+#
+# Instead of simulating walks, every profile is computed exactly by power iteration, and many
+# seeds are solved together as one sparse-matrix x dense-matrix product per step.
+
+DEFAULT_ALPHA = 0.86
+DEFAULT_TOLERANCE = 1e-6
+DEFAULT_MAX_ITERATIONS = 200
+DEFAULT_BLOCK_SIZE = 256
+
+
+def create_transition_matrix(graph):
+    """
+    Build the row-normalized transition matrix of a weighted graph.
+
+    Input:
+    - graph (CSRGraph): Weighted graph, e.g. GraphManager.create_H_graph(). Rows and columns
+      follow its node ids, so the profiles line up with the MSI node ids.
+
+    Output:
+    - scipy.sparse.csr_matrix: P with P[i, j] = w(i, j) / sum_k w(i, k).
+      Rows of nodes without out-edges (dangling nodes) are all zero.
+    """
+    adjacency = sp.csr_matrix((graph.weights.astype(np.float64), graph.indices, graph.indptr), shape=(graph.n_nodes, graph.n_nodes))
+    return row_normalize(adjacency)
+
+
+def row_normalize(adjacency):
+    out_weight = np.asarray(adjacency.sum(axis=1)).ravel()
+    inverse_out_weight = np.divide(1.0, out_weight, out=np.zeros_like(out_weight), where=out_weight > 0)
+    return sp.csr_matrix(sp.diags(inverse_out_weight) @ adjacency)
+
+
+class DiffusionEngine:
+    def __init__(self, transition_matrix, alpha=DEFAULT_ALPHA, tol=DEFAULT_TOLERANCE, max_iter=DEFAULT_MAX_ITERATIONS, block_size=DEFAULT_BLOCK_SIZE, n_jobs=None):
+        """
+        Input:
+        - transition_matrix (scipy.sparse matrix): Row-normalized transition matrix P.
+        - alpha (float): Probability of following an edge rather than restarting.
+        - tol (float): Stop once the L1 change of every profile in a block falls below tol.
+        - max_iter (int): Hard cap on the number of power iterations per block.
+        - block_size (int): Number of seeds solved together in one sparse x dense product.
+        - n_jobs (int): Number of blocks solved in parallel. Defaults to all cores.
+        """
+        assert 0 < alpha < 1, "alpha must be in (0, 1)"
+        self.n_nodes = transition_matrix.shape[0]
+        # Propagating column vectors needs P^T; keep it in CSR so the product is a row-wise sweep
+        self.transition_matrix_T = sp.csr_matrix(transition_matrix.T, dtype=np.float64)
+        self.dangling = np.asarray(transition_matrix.sum(axis=1)).ravel() == 0
+        self.alpha = alpha
+        self.tol = tol
+        self.max_iter = max_iter
+        self.block_size = block_size
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+
+    def restart_matrix(self, seeds):
+        # One column per seed set, restart mass spread uniformly over the seed nodes
+        columns = np.repeat(np.arange(len(seeds)), [len(seed) for seed in seeds])
+        rows = np.concatenate([np.asarray(seed, dtype=np.int64) for seed in seeds])
+        values = np.concatenate([np.full(len(seed), 1.0 / len(seed)) for seed in seeds])
+        return sp.csr_matrix((values, (rows, columns)), shape=(self.n_nodes, len(seeds))).toarray()
+
+    def solve_block(self, seeds):
+        """
+        Power iteration for one block of seeds.
+
+        Input:
+        - seeds (list of lists of int): Node indices of each seed set.
+
+        Output:
+        - numpy array (len(seeds), n_nodes), float32: One diffusion profile per row.
+        - int: Number of iterations used.
+        """
+        restart = self.restart_matrix(seeds)
+        profiles = restart.copy()
+
+        for iteration in range(1, self.max_iter + 1):
+            walked = self.transition_matrix_T @ profiles
+            # Mass that reaches a dangling node has nowhere to go and restarts at the seed
+            lost_mass = profiles[self.dangling].sum(axis=0)
+            updated = self.alpha * walked + ((1 - self.alpha) + self.alpha * lost_mass) * restart
+
+            delta = np.abs(updated - profiles).sum(axis=0).max()
+            profiles = updated
+            if delta < self.tol:
+                break
+
+        return profiles.T.astype(np.float32), iteration
+
+    def solve(self, seed):
+        """
+        Diffusion profile of one seed set, e.g. the protein targets of a hypothetical compound.
+
+        Output:
+        - numpy array (n_nodes,), float32.
+        - int: Number of iterations used.
+        """
+        profiles, iterations = self.solve_block([list(seed)])
+        return profiles[0], iterations
+
+    def compute_profiles(self, seeds, verbose=False):
+        """
+        Compute the diffusion profiles of many seed sets, blockwise and in parallel.
+
+        Input:
+        - seeds (list): Each element is a node index or a list of node indices.
+
+        Output:
+        - numpy array (len(seeds), n_nodes), float32.
+        """
+        seeds = [[seed] if np.isscalar(seed) else list(seed) for seed in seeds]
+        profiles = np.empty((len(seeds), self.n_nodes), dtype=np.float32)
+        blocks = [(start, seeds[start:start + self.block_size]) for start in range(0, len(seeds), self.block_size)]
+
+        def run(block):
+            start, block_seeds = block
+            block_profiles, iterations = self.solve_block(block_seeds)
+            profiles[start:start + len(block_seeds)] = block_profiles
+            if verbose:
+                print(f'Block {start // self.block_size + 1}/{len(blocks)} converged in {iterations} iterations')
+
+        # scipy's sparse x dense kernel releases the GIL, so threads keep every core busy
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            list(executor.map(run, blocks))
+
+        return profiles
+
+
+#===================================================================
+# Online profiles of arbitrary seed sets
+#===================================================================
+# With the dangling mass sent back to the seed, the profile of seed set S solves
+#
+#     r_S = c_S * (1 - alpha P^T)^-1 e_S,    c_S = (1 - alpha) + alpha * sum(r_S[dangling])
+#
+# so for S split into disjoint parts S_i, r_S is proportional to sum_i |S_i| / c_i * r_i.
+# Seeds that are drugs or indications therefore combine their stored profiles exactly; only
+# the remaining seeds (proteins, biological functions) need one power iteration (tens of ms
+# on the MSI), solved together as a single seed set. A sparse LU factorization of
+# (I - alpha P^T) would make that a pair of triangular solves, but its fill-in on the MSI
+# makes both the factorization and each solve slower than iterating.
+
+def combine_profiles(profiles, sizes, dangling, alpha=DEFAULT_ALPHA):
+    """
+    Exact profile of the union of disjoint seed sets from the profiles of the parts.
+
+    Input:
+    - profiles (iterable of numpy arrays (n_nodes,)): Profile of each part.
+    - sizes (iterable of int): Number of seed nodes of each part.
+    - dangling (numpy array of bool): DiffusionEngine.dangling of the graph they were computed on.
+
+    Output:
+    - numpy array (n_nodes,), float32.
+    """
+    combined = np.zeros(len(dangling))
+    for profile, size in zip(profiles, sizes):
+        profile = np.asarray(profile, dtype=np.float64)
+        restart_weight = (1 - alpha) + alpha * profile[dangling].sum()
+        combined += size / restart_weight * profile
+    return (combined / combined.sum()).astype(np.float32)
+
+
+class SeedProfileSolver:
+    def __init__(self, engine, stored_profile=None, cache=None, version=()):
+        """
+        Input:
+        - engine (DiffusionEngine): Engine over the graph the stored profiles were computed on.
+        - stored_profile (function): Node id -> its precomputed single-node profile, or None.
+        - cache (cache.LRUCache): Profiles of recent seed sets, keyed by cache_key.
+        - version (tuple): Prefix of the cache keys, e.g. the snapshot key, so a cache shared
+          between solvers never serves a profile computed on another graph.
+        """
+        self.engine = engine
+        self.stored_profile = stored_profile or (lambda node_id: None)
+        self.cache = cache
+        self.version = tuple(version)
+
+    def cache_key(self, seed):
+        return self.version + tuple(sorted({int(node_id) for node_id in seed}))
+
+    def profile(self, seed, solved=None):
+        """
+        Diffusion profile of a seed set, restart mass spread uniformly over its nodes.
+
+        Input:
+        - seed (iterable of int): Node ids; duplicates and order do not matter.
+        - solved (dict): If given, the profiles computed here are added to it by cache key instead
+          of to the cache, for a caller whose cache is a copy (a worker process) to return them.
+
+        Output:
+        - numpy array (n_nodes,), float32.
+        """
+        key = self.cache_key(seed)
+        node_ids = key[len(self.version):]
+        assert node_ids, "The seed set is empty."
+        profile = self.cache.get(key) if self.cache is not None else None
+        if profile is not None:
+            return profile
+
+        stored = [self.stored_profile(node_id) for node_id in node_ids]
+        unknown = tuple(node_id for node_id, profile in zip(node_ids, stored) if profile is None)
+        if len(unknown) == len(node_ids):
+            profile, _ = self.engine.solve(node_ids)
+        else:
+            profiles = [profile for profile in stored if profile is not None]
+            sizes = [1] * len(profiles)
+            if unknown:
+                # Cached on its own too, so seed sets that add drugs to the same targets reuse it
+                profiles.append(self.profile(unknown, solved))
+                sizes.append(len(unknown))
+            profile = combine_profiles(profiles, sizes, self.engine.dangling, self.engine.alpha)
+
+        if solved is not None:
+            solved[key] = profile
+        elif self.cache is not None:
+            self.cache.put(key, profile)
+        return profile
+
+
+#===================================================================
+# Offline pipeline: data/*.tsv -> compressed_diffusion_profiles.npz
+#===================================================================
+
+def build_diffusion_profiles(graph_manager, alpha=DEFAULT_ALPHA, tol=DEFAULT_TOLERANCE, max_iter=DEFAULT_MAX_ITERATIONS, block_size=DEFAULT_BLOCK_SIZE, n_jobs=None, verbose=False):
+    """
+    Compute the diffusion profile of every drug and every indication of the MSI.
+
+    Output:
+    - numpy array: Drug diffusion profiles, one row per drug.
+    - dict: Drug label -> row index.
+    - numpy array: Indication diffusion profiles, one row per indication.
+    - dict: Indication label -> row index.
+    """
+    transition_matrix = create_transition_matrix(graph_manager.create_H_graph())
+    engine = DiffusionEngine(transition_matrix, alpha=alpha, tol=tol, max_iter=max_iter, block_size=block_size, n_jobs=n_jobs)
+
+    results = []
+    for label_to_name in [graph_manager.mapping_drug_label_to_name, graph_manager.mapping_indication_label_to_name]:
+        # Sorted, so the label -> index maps are reproducible between runs and machines
+        labels = sorted(label_to_name)
+        seeds = [graph_manager.mapping_label_to_index[label] for label in labels]
+        profiles = engine.compute_profiles(seeds, verbose=verbose)
+        results.extend([profiles, {label: index for index, label in enumerate(labels)}])
+
+    return tuple(results)
+
+
+def save_diffusion_profiles(data_path, drug_diffusion_profiles, map_drug_labels_to_indices, indication_diffusion_profiles, map_indication_labels_to_indices):
+    # Same layout main.py loads at startup
+    np.savez_compressed(f'{data_path}compressed_diffusion_profiles.npz', arr1=drug_diffusion_profiles, arr2=indication_diffusion_profiles)
+    save_data_dict(f'{data_path}map_drug_labels_to_indices', map_drug_labels_to_indices)
+    save_data_dict(f'{data_path}map_indication_labels_to_indices', map_indication_labels_to_indices)
+
+
+def test_diffusion_engine():
+    # Path graph 0 - 1 - 2 with a dangling node 3 hanging off node 2
+    adjacency = sp.csr_matrix(np.array([
+        [0, 1, 0, 0],
+        [1, 0, 1, 0],
+        [0, 1, 0, 1],
+        [0, 0, 0, 0],
+    ], dtype=np.float64))
+    transition_matrix = row_normalize(adjacency)
+    engine = DiffusionEngine(transition_matrix, alpha=0.86, tol=1e-12, max_iter=10000, block_size=2, n_jobs=2)
+
+    profiles = engine.compute_profiles([0, 1, [0, 2]])
+
+    # Profiles are probability distributions
+    assert np.allclose(profiles.sum(axis=1), 1.0, atol=1e-5), "Profiles do not sum to one."
+
+    # Compare against the closed-form solution, with dangling mass sent back to the seed
+    n_nodes = adjacency.shape[0]
+    for row, seed in enumerate([[0], [1], [0, 2]]):
+        restart = np.zeros(n_nodes)
+        restart[seed] = 1.0 / len(seed)
+        walk = transition_matrix.T.toarray() + np.outer(restart, engine.dangling)
+        expected = np.linalg.solve(np.eye(n_nodes) - 0.86 * walk, (1 - 0.86) * restart)
+        assert np.allclose(profiles[row], expected, atol=1e-5), f"Profile {row} does not match the exact solution."
+
+    # A seed set combined from stored single-node profiles matches solving it directly
+    solver = SeedProfileSolver(engine, stored_profile=lambda node_id: profiles[0] if node_id == 0 else None)
+    assert np.allclose(solver.profile([2, 0, 2]), profiles[2], atol=1e-5), "Combined profile does not match the exact solution."
+
+    # With solved, new profiles are returned to the caller rather than cached
+    from cache import LRUCache
+    solver = SeedProfileSolver(engine, stored_profile=lambda node_id: profiles[0] if node_id == 0 else None, cache=LRUCache('test'), version=('v1',))
+    solved = {}
+    solver.profile([2, 0], solved)
+    assert sorted(solved) == [('v1', 0, 2), ('v1', 2)] and len(solver.cache) == 0, "Solved profiles were not returned."
+    for key, profile in solved.items():
+        solver.cache.put(key, profile)
+    assert solver.profile([0, 2]) is solved[('v1', 0, 2)], "Returned profiles are not served from the cache."
+
+    print("All tests passed.")
+
+
+if __name__ == '__main__':
+    from manager import GraphManager
+
+    data_path = sys.argv[1] if len(sys.argv) > 1 else './data/'
+
+    start = time.time()
+    graph_manager = GraphManager(data_path)
+    print(f'Built MSI graph with {graph_manager.MSI_size_graph} nodes in {time.time() - start:.1f}s')
+
+    start = time.time()
+    profiles = build_diffusion_profiles(graph_manager, verbose=True)
+    print(f'Computed {len(profiles[1])} drug and {len(profiles[3])} indication profiles in {time.time() - start:.1f}s')
+
+    save_diffusion_profiles(data_path, *profiles)
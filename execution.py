@@ -0,0 +1,149 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from instrumentation import REGISTRY
+
+
+#===================================================================
+# Bounded execution of CPU-bound request work
+#===================================================================
+# Request handlers are async, so anything they compute inline (k-NN queries, top-k, subgraphs,
+# serialization) blocks the worker's event loop and every other request with it. ExecutionPool
+# runs that work on a bounded pool instead:
+#   - thread pool (default): numpy, Annoy and the CSR graph code release the GIL for most of the
+#     work, and stage timings (instrumentation.stage) carry over to the request
+#   - process pool: forked from the worker after the snapshot is loaded, so the mmapped arrays
+#     are shared; for work that holds the GIL. Functions must be module-level, arguments and
+#     results picklable.
+# At most max_workers tasks run and max_queued wait; beyond that run() raises PoolSaturated so
+# the caller can answer 503 instead of queueing without bound. Calls with the same key while one
+# is in flight share its result rather than computing it again.
+
+EXECUTOR_KINDS = ['thread', 'process']
+
+EXECUTIONS = REGISTRY.counter('msi_executor_total', 'Pooled calls by outcome: executed, coalesced with an identical call in flight, or rejected.', ['outcome'])
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class ExecutionPool:
+    def __init__(self, kind='thread', max_workers=4, max_queued=16):
+        assert kind in EXECUTOR_KINDS, f"Executor kind '{kind}' is not supported."
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        # Created on first use, so a process pool forks from the serving worker, not the gunicorn master
+        self.executor = None
+        # Submitted and not finished (running or queued)
+        self.pending = 0
+        self.in_flight = {}
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.kind == 'thread':
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='msi-compute')
+            else:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+        return self.executor
+
+    async def run(self, function, *args, key=None):
+        """
+        Run function(*args) on the pool and wait for its result. Must be called from the event loop.
+
+        Input:
+        - key (hashable): Identifies the call; while a call with the same key is in flight, its
+          result is shared instead of computing it again. None never coalesces.
+
+        Output:
+        - The return value of function(*args); its exception is raised to every caller sharing it.
+        """
+        if key is not None and key in self.in_flight:
+            EXECUTIONS.inc('coalesced')
+            return await asyncio.shield(self.in_flight[key])
+
+        if self.pending >= self.max_workers + self.max_queued:
+            EXECUTIONS.inc('rejected')
+            raise PoolSaturated(f"{self.pending} calls pending")
+
+        if self.kind == 'thread':
+            # Run in a copy of the request's context, so stage timings reach the request
+            call = functools.partial(contextvars.copy_context().run, function, *args)
+        else:
+            call = functools.partial(function, *args)
+        future = asyncio.get_running_loop().run_in_executor(self.get_executor(), call)
+        EXECUTIONS.inc('executed')
+
+        # The slot is freed when the work finishes, even if every caller has gone away
+        self.pending += 1
+        future.add_done_callback(self.finished)
+        if key is not None:
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded, so a cancelled caller does not cancel the result others are waiting for
+        return await asyncio.shield(future)
+
+    def finished(self, future):
+        self.pending -= 1
+        if not future.cancelled():
+            # Marks the exception as retrieved when nobody is left waiting for it
+            future.exception()
+
+    def recycle(self):
+        # Later calls run in new workers, forked from the current state of this process; calls
+        # already submitted finish in the old ones. Threads share the state, so need nothing.
+        if self.kind == 'process' and self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def execution_pool_from_environment():
+    """
+    ExecutionPool configured by MSI_EXECUTOR ('thread' or 'process'), MSI_EXECUTOR_WORKERS
+    (default 4) and MSI_EXECUTOR_QUEUE (calls allowed to wait, default 4 per worker).
+    """
+    max_workers = int(os.environ.get('MSI_EXECUTOR_WORKERS', 4))
+    return ExecutionPool(kind=os.environ.get('MSI_EXECUTOR', 'thread'), max_workers=max_workers,
+                         max_queued=int(os.environ.get('MSI_EXECUTOR_QUEUE', 4 * max_workers)))
+
+
+def test_execution_pool():
+    import threading
+    import time
+
+    calls = []
+
+    def work(value):
+        calls.append(value)
+        time.sleep(0.05)
+        return value * 2
+
+    async def scenario():
+        pool = ExecutionPool(max_workers=2, max_queued=1)
+
+        # Identical concurrent calls run once and all get the result
+        results = await asyncio.gather(*[pool.run(work, 21, key='same') for _ in range(10)])
+        assert results == [42] * 10 and calls == [21], "Identical calls were not coalesced."
+
+        # Two running and one queued fit; the rest are rejected
+        outcomes = await asyncio.gather(*[pool.run(work, value) for value in range(5)], return_exceptions=True)
+        assert outcomes[:3] == [0, 2, 4] and all(isinstance(outcome, PoolSaturated) for outcome in outcomes[3:])
+        assert pool.pending == 0 and not pool.in_flight
+
+        # Work runs off the event loop thread
+        assert await pool.run(threading.get_ident) != threading.get_ident()
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+    print("All tests passed.")
@@ -0,0 +1,226 @@
+import numpy as np
+
+
+#===================================================================
+# Compact CSR graph
+#===================================================================
+# Nodes are dense integer ids 0..n_nodes-1. Everything else is a flat array indexed by id:
+#   indptr  (int32, n_nodes + 1): out-edges of node i are indices[indptr[i]:indptr[i + 1]]
+#   indices (int32, n_edges):     target node ids, sorted within each row
+#   weights (float32, n_edges):   edge weights, aligned with indices
+#   node_types (int8, n_nodes):   codes into NODE_TYPES
+#   labels / names (str arrays):  the interned label table and display names
+
+NODE_TYPES = ['drug', 'indication', 'protein', 'bio']
+NODE_TYPE_CODES = {node_type: code for code, node_type in enumerate(NODE_TYPES)}
+
+
+class CSRGraph:
+    def __init__(self, indptr, indices, weights, node_types, labels, names=None, node_ids=None):
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.node_types = np.asarray(node_types, dtype=np.int8)
+        self.labels = np.asarray(labels, dtype=str)
+        self.names = self.labels if names is None else np.asarray(names, dtype=str)
+        # Ids of these nodes in the graph this one was cut from (None for a full graph)
+        self.node_ids = node_ids
+
+        assert len(self.indptr) == len(self.labels) + 1, "indptr must have one entry per node plus one."
+        assert len(self.indices) == len(self.weights) == self.indptr[-1], "indices and weights must have one entry per edge."
+
+    @classmethod
+    def from_edges(cls, sources, targets, weights, node_types, labels, names=None):
+        """
+        Build a graph from parallel edge arrays.
+        Duplicate (source, target) pairs are collapsed, keeping the weight of the last occurrence,
+        which matches adding the edges one by one to an nx.DiGraph.
+
+        Input:
+        - sources, targets (array of int): Node ids of each edge.
+        - weights (array of float): Weight of each edge.
+        - node_types (array of int): Type code of each node.
+        - labels (array of str): Label of each node.
+
+        Output:
+        - CSRGraph
+        """
+        n_nodes = len(labels)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float32)
+
+        # Encode each edge as one int64 key; np.unique sorts by (source, target), which is CSR order.
+        # Searching the reversed arrays makes the first hit the last occurrence.
+        keys = sources * n_nodes + targets
+        unique_keys, last_occurrence = np.unique(keys[::-1], return_index=True)
+        unique_weights = weights[::-1][last_occurrence]
+
+        unique_sources = unique_keys // n_nodes
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(unique_sources, minlength=n_nodes), out=indptr[1:])
+
+        return cls(indptr, unique_keys % n_nodes, unique_weights, node_types, labels, names)
+
+    @property
+    def n_nodes(self):
+        return len(self.labels)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def neighbors(self, node_id):
+        return self.indices[self.indptr[node_id]:self.indptr[node_id + 1]]
+
+    def edges(self):
+        """
+        Output:
+        - numpy array (int32): Source id of each edge.
+        - numpy array (int32): Target id of each edge.
+        """
+        sources = np.repeat(np.arange(self.n_nodes, dtype=np.int32), self.out_degree())
+        return sources, self.indices
+
+    def out_edge_positions(self, node_ids):
+        """
+        Positions in indices / weights of every out-edge of the given nodes, as one
+        vectorized concatenation of their CSR row ranges.
+
+        Output:
+        - numpy array (int64): Edge positions, node by node in the given order.
+        - numpy array: Number of out-edges of each node.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        starts = self.indptr[node_ids].astype(np.int64)
+        counts = self.indptr[node_ids + 1] - starts
+        offsets = np.cumsum(counts) - counts
+        return np.arange(counts.sum(), dtype=np.int64) + np.repeat(starts - offsets, counts), counts
+
+    def transpose(self):
+        """
+        The same graph with every edge reversed, so in-edges can be read as CSR rows.
+        """
+        sources, targets = self.edges()
+        order = np.argsort(targets, kind='stable')  # Stable keeps the new rows sorted by source
+        indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(targets, minlength=self.n_nodes), out=indptr[1:])
+        return CSRGraph(indptr, sources[order], self.weights[order], self.node_types, self.labels, self.names)
+
+    def subgraph(self, node_ids):
+        """
+        Induced subgraph on a set of nodes, extracted in one vectorized pass over the CSR arrays.
+
+        Input:
+        - node_ids (array of int): Ids of the nodes to keep. Duplicates are ignored, so several
+          top-k lists can simply be concatenated.
+
+        Output:
+        - CSRGraph: Nodes are renumbered 0..k-1 in ascending id order; subgraph.node_ids holds
+          their ids in this graph.
+        """
+        # The boolean mask de-duplicates the ids and sorts them in the same step
+        mask = np.zeros(self.n_nodes, dtype=bool)
+        mask[np.asarray(node_ids, dtype=np.int64)] = True
+        node_ids = np.flatnonzero(mask).astype(np.int32)
+        local_ids = np.full(self.n_nodes, -1, dtype=np.int32)
+        local_ids[node_ids] = np.arange(len(node_ids), dtype=np.int32)
+
+        # Out-edges of the kept nodes; keep those whose target is also kept.
+        # Rows stay in order, so this is already CSR
+        positions, counts = self.out_edge_positions(node_ids)
+        targets = local_ids[self.indices[positions]]
+        keep = targets >= 0
+        sources = np.repeat(np.arange(len(node_ids), dtype=np.int32), counts)[keep]
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+
+        return CSRGraph(indptr, targets[keep], self.weights[positions[keep]],
+                        self.node_types[node_ids], self.labels[node_ids], self.names[node_ids], node_ids=node_ids)
+
+    def iter_induced_subgraph_chunks(self, node_ids, chunk_size=64, transpose=None):
+        """
+        Grow the induced subgraph on node_ids chunk by chunk, in the given order.
+
+        Each chunk holds the next chunk_size new nodes and every induced edge that closes
+        against a node already sent, so the union of all chunks is exactly subgraph(node_ids).
+        The work per chunk depends only on the degrees of its own nodes, not on how many
+        nodes were requested in total.
+
+        Input:
+        - node_ids (array of int): Nodes in the order they should be sent; duplicates are skipped.
+        - chunk_size (int): New nodes per chunk.
+        - transpose (CSRGraph): self.transpose(), if already computed.
+
+        Output:
+        - generator of (numpy array, numpy array, numpy array): The chunk's node ids and the
+          source and target ids of its edges.
+        """
+        transpose = transpose if transpose is not None else self.transpose()
+        _, first = np.unique(np.asarray(node_ids, dtype=np.int64), return_index=True)
+        node_ids = np.asarray(node_ids, dtype=np.int64)[np.sort(first)]
+
+        # Chunk in which each node is sent, -1 for nodes outside the subgraph
+        chunk_of = np.full(self.n_nodes, -1, dtype=np.int64)
+        for chunk, start in enumerate(range(0, len(node_ids), chunk_size)):
+            chunk_nodes = node_ids[start:start + chunk_size]
+            chunk_of[chunk_nodes] = chunk
+
+            # Out-edges to nodes sent so far or in this chunk
+            positions, counts = self.out_edge_positions(chunk_nodes)
+            out_targets = self.indices[positions]
+            keep = chunk_of[out_targets] >= 0
+            out_sources = np.repeat(chunk_nodes, counts)[keep]
+
+            # In-edges from nodes of earlier chunks; edges within this chunk are already out-edges
+            positions, counts = transpose.out_edge_positions(chunk_nodes)
+            in_sources = transpose.indices[positions]
+            keep_in = (chunk_of[in_sources] >= 0) & (chunk_of[in_sources] < chunk)
+            in_targets = np.repeat(chunk_nodes, counts)[keep_in]
+
+            yield chunk_nodes, np.concatenate([out_sources, in_sources[keep_in]]), np.concatenate([out_targets[keep], in_targets])
+
+    def to_networkx(self):
+        """
+        Export to an nx.DiGraph keyed by node label, for plotting and ad-hoc analysis.
+        networkx is only needed when this is called.
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        for label, name, node_type in zip(self.labels.tolist(), self.names.tolist(), self.node_types.tolist()):
+            graph.add_node(label, name=name, node_type=NODE_TYPES[node_type])
+
+        sources, targets = self.edges()
+        graph.add_weighted_edges_from(zip(self.labels[sources].tolist(), self.labels[targets].tolist(), self.weights.tolist()))
+        return graph
+
+
+def test_csr_graph():
+    labels = ['DB1', 'C1', 'P1', 'P2', 'GO:1']
+    node_types = [NODE_TYPE_CODES[t] for t in ['drug', 'indication', 'protein', 'protein', 'bio']]
+    sources = [0, 1, 2, 3, 2, 0]
+    targets = [2, 3, 4, 4, 3, 2]
+    weights = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+    graph = CSRGraph.from_edges(sources, targets, weights, node_types, labels)
+
+    # The duplicate edge 0 -> 2 keeps its last weight
+    assert graph.n_edges == 5, "Duplicate edges were not collapsed."
+    assert graph.neighbors(0).tolist() == [2] and graph.weights[graph.indptr[0]] == 6.0, "Last weight of a duplicate edge was not kept."
+    assert graph.neighbors(2).tolist() == [3, 4], "Targets are not sorted within a row."
+
+    subgraph = graph.subgraph([4, 2, 3, 2])
+    assert subgraph.node_ids.tolist() == [2, 3, 4], "Subgraph nodes are not unique and sorted."
+    sources, targets = subgraph.edges()
+    assert sorted(zip(subgraph.node_ids[sources].tolist(), subgraph.node_ids[targets].tolist())) == [(2, 3), (2, 4), (3, 4)], "Induced edges are wrong."
+
+    # Streaming chunks add up to the induced subgraph, each edge once
+    chunk_edges = [(source, target) for _, sources, targets in graph.iter_induced_subgraph_chunks([4, 2, 3, 2, 1], chunk_size=1)
+                   for source, target in zip(sources.tolist(), targets.tolist())]
+    assert sorted(chunk_edges) == [(1, 3), (2, 3), (2, 4), (3, 4)], "Streamed edges differ from the induced subgraph."
+
+    print("All tests passed.")
@@ -0,0 +1,202 @@
+import json
+import struct
+
+import numpy as np
+
+from graph_core import NODE_TYPES
+from manager import NODE_COLORS, NODE_SHAPES, NODE_STYLES
+
+
+#===================================================================
+# /graph wire formats
+#===================================================================
+# The default /graph response has one object per node and edge, repeating the color, shape and
+# arrow style on every element. The columnar formats send each node's type code instead and the
+# styles once, in a small legend:
+#
+#   columnar JSON (GRAPH_COLUMNAR_JSON):
+#       {"legend": {...}, "nodes": {"id": [...], "label": [...], "type": [...]},
+#        "edges": {"from": [...], "to": [...]}}
+#   Edge endpoints are positions in the node columns, not node ids.
+#
+#   binary (GRAPH_BINARY), little endian:
+#       header         7 x uint32   magic b'MSIG', version, n_nodes, n_edges, n_label_bytes, n_legend_bytes, flags
+#       id             uint32[n_nodes]       MSI node ids
+#       from, to       uint32[n_edges] each  positions in the node columns
+#       label_offsets  uint32[n_nodes + 1]   byte offsets into the labels blob
+#       xy             float32[2 * n_nodes]  x, y of each node, only with GRAPH_BINARY_HAS_POSITIONS
+#       type           uint8[n_nodes]        codes into legend["node_types"]
+#       labels         UTF-8 bytes
+#       legend         UTF-8 JSON
+#   All 4-byte sections come first, so a client can view them as typed arrays without copying.
+#
+# With a server-side layout (layout.py), every format also carries the node positions in pixels:
+# "x" and "y" on each node object or node column, or the xy section.
+
+GRAPH_JSON = 'application/json'
+GRAPH_COLUMNAR_JSON = 'application/vnd.msi.graph+json'
+GRAPH_BINARY = 'application/vnd.msi.graph+binary'
+
+GRAPH_BINARY_MAGIC = b'MSIG'
+GRAPH_BINARY_VERSION = 2
+GRAPH_BINARY_HEADER = struct.Struct('<4s6I')
+GRAPH_BINARY_HAS_POSITIONS = 1
+
+EDGE_STYLE = {"arrows": "to"}
+
+
+def style_legend():
+    return {
+        "node_types": [{"name": node_type, "color": NODE_STYLES[node_type][0], "shape": NODE_STYLES[node_type][1]} for node_type in NODE_TYPES],
+        "edge": EDGE_STYLE,
+    }
+
+
+def negotiate_graph_format(accept):
+    """
+    Pick the /graph response format from an Accept header; anything else gets the default JSON.
+    """
+    accept = accept or ''
+    for media_type in [GRAPH_BINARY, GRAPH_COLUMNAR_JSON]:
+        if media_type in accept:
+            return media_type
+    return GRAPH_JSON
+
+
+def position_columns(positions):
+    # x and y columns in whole pixels, which is all a drawing needs
+    return {"x": np.rint(positions[:, 0]).astype(int).tolist(), "y": np.rint(positions[:, 1]).astype(int).tolist()}
+
+
+def vis_graph_columns(subgraph, positions=None):
+    """
+    Output:
+    - dict: Parallel node columns "id", "label", "color", "shape" (and "x", "y" with positions)
+      and edge columns "from", "to", with MSI node ids, for the default object-per-element response.
+    """
+    sources, targets = subgraph.edges()
+    columns = {
+        "id": subgraph.node_ids.tolist(),
+        "label": subgraph.names.tolist(),
+        "color": NODE_COLORS[subgraph.node_types].tolist(),
+        "shape": NODE_SHAPES[subgraph.node_types].tolist(),
+        "from": subgraph.node_ids[sources].tolist(),
+        "to": subgraph.node_ids[targets].tolist(),
+    }
+    if positions is not None:
+        columns.update(position_columns(positions))
+    return columns
+
+
+def vis_graph_chunk(graph, node_ids, sources, targets):
+    """
+    One chunk of a streamed subgraph (CSRGraph.iter_induced_subgraph_chunks) in the default
+    object-per-element format, ready to add to vis DataSets.
+    """
+    node_types = graph.node_types[node_ids]
+    nodes = [{"id": node_id, "label": label, "color": color, "shape": shape}
+             for node_id, label, color, shape in zip(node_ids.tolist(), graph.names[node_ids].tolist(),
+                                                     NODE_COLORS[node_types].tolist(), NODE_SHAPES[node_types].tolist())]
+    edges = [{"from": source, "to": target, **EDGE_STYLE} for source, target in zip(sources.tolist(), targets.tolist())]
+    return {"nodes": nodes, "edges": edges}
+
+
+def encode_graph_columnar_json(subgraph, positions=None):
+    sources, targets = subgraph.edges()
+    payload = {
+        "legend": style_legend(),
+        "nodes": {"id": subgraph.node_ids.tolist(), "label": subgraph.names.tolist(), "type": subgraph.node_types.tolist()},
+        "edges": {"from": sources.tolist(), "to": targets.tolist()},
+    }
+    if positions is not None:
+        payload["nodes"].update(position_columns(positions))
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def encode_graph_binary(subgraph, positions=None):
+    sources, targets = subgraph.edges()
+    encoded_labels = [label.encode() for label in subgraph.names.tolist()]
+    label_offsets = np.zeros(len(encoded_labels) + 1, dtype='<u4')
+    np.cumsum([len(label) for label in encoded_labels], out=label_offsets[1:])
+    labels = b''.join(encoded_labels)
+    legend = json.dumps(style_legend(), separators=(',', ':')).encode()
+
+    flags = 0 if positions is None else GRAPH_BINARY_HAS_POSITIONS
+    header = GRAPH_BINARY_HEADER.pack(GRAPH_BINARY_MAGIC, GRAPH_BINARY_VERSION, subgraph.n_nodes, subgraph.n_edges, len(labels), len(legend), flags)
+    return b''.join([
+        header,
+        subgraph.node_ids.astype('<u4').tobytes(),
+        sources.astype('<u4').tobytes(),
+        targets.astype('<u4').tobytes(),
+        label_offsets.tobytes(),
+        b'' if positions is None else np.asarray(positions, dtype='<f4').tobytes(),
+        subgraph.node_types.astype(np.uint8).tobytes(),
+        labels,
+        legend,
+    ])
+
+
+def decode_graph_binary(payload):
+    """
+    Inverse of encode_graph_binary, for Python clients and tests.
+
+    Output:
+    - dict: Same structure as the columnar JSON, with numpy arrays for the numeric columns.
+    """
+    magic, version, n_nodes, n_edges, n_label_bytes, n_legend_bytes, flags = GRAPH_BINARY_HEADER.unpack_from(payload)
+    assert magic == GRAPH_BINARY_MAGIC, "Not an MSI graph payload."
+    assert version == GRAPH_BINARY_VERSION, f"Unsupported graph payload version {version}"
+
+    offset = GRAPH_BINARY_HEADER.size
+
+    def read(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    node_ids, sources, targets = read('<u4', n_nodes), read('<u4', n_edges), read('<u4', n_edges)
+    label_offsets = read('<u4', n_nodes + 1)
+    positions = read('<f4', 2 * n_nodes).reshape(n_nodes, 2) if flags & GRAPH_BINARY_HAS_POSITIONS else None
+    node_types = read(np.uint8, n_nodes)
+    labels = payload[offset:offset + n_label_bytes]
+    legend = json.loads(payload[offset + n_label_bytes:offset + n_label_bytes + n_legend_bytes])
+
+    nodes = {"id": node_ids, "label": [labels[start:end].decode() for start, end in zip(label_offsets[:-1], label_offsets[1:])], "type": node_types}
+    if positions is not None:
+        nodes["x"], nodes["y"] = positions[:, 0], positions[:, 1]
+    return {"legend": legend, "nodes": nodes, "edges": {"from": sources, "to": targets}}
+
+
+def test_graph_encoding():
+    from graph_core import CSRGraph, NODE_TYPE_CODES
+
+    labels = ['DB1', 'C1', 'P1', 'P2', 'GO:1']
+    names = ['aspirin', 'fièvre', 'P1', 'P2', 'GO:1']
+    node_types = [NODE_TYPE_CODES[t] for t in ['drug', 'indication', 'protein', 'protein', 'bio']]
+    graph = CSRGraph.from_edges([0, 1, 2, 3, 2], [2, 3, 4, 4, 3], [1.0] * 5, node_types, labels, names)
+    subgraph = graph.subgraph([0, 1, 2, 4])
+
+    columnar = json.loads(encode_graph_columnar_json(subgraph))
+    decoded = decode_graph_binary(encode_graph_binary(subgraph))
+    rows = vis_graph_columns(subgraph)
+
+    for payload in [columnar, decoded]:
+        assert list(payload["nodes"]["id"]) == rows["id"] and payload["nodes"]["label"] == rows["label"], "Node columns differ."
+        node_types = payload["legend"]["node_types"]
+        assert [node_types[code]["color"] for code in payload["nodes"]["type"]] == rows["color"], "Type codes do not resolve to the colors."
+        node_ids = np.asarray(payload["nodes"]["id"])
+        assert node_ids[payload["edges"]["from"]].tolist() == rows["from"] and node_ids[payload["edges"]["to"]].tolist() == rows["to"], "Edges differ."
+
+    # Positions travel in every format
+    positions = np.array([[0.0, 1.0], [2.0, 3.0], [-4.0, 5.0], [6.0, -7.0]])
+    decoded = decode_graph_binary(encode_graph_binary(subgraph, positions))
+    columnar = json.loads(encode_graph_columnar_json(subgraph, positions))
+    rows = vis_graph_columns(subgraph, positions)
+    assert decoded["nodes"]["x"].tolist() == columnar["nodes"]["x"] == rows["x"] == [0, 2, -4, 6]
+    assert decoded["nodes"]["y"].tolist() == columnar["nodes"]["y"] == rows["y"] == [1, 3, 5, -7]
+    assert decoded["nodes"]["label"] == rows["label"], "Sections after the positions are misaligned."
+
+    assert negotiate_graph_format(None) == GRAPH_JSON and negotiate_graph_format(f'{GRAPH_BINARY}, */*') == GRAPH_BINARY
+
+    print("All tests passed.")
@@ -0,0 +1,97 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from graph_core import NODE_TYPE_CODES
+
+
+#===================================================================
+# MSI edge files
+#===================================================================
+# (edge type, file name, type of node_1, type of node_2)
+EDGE_FILES = [
+    ('drug_to_protein', '1_drug_to_protein.tsv', 'drug', 'protein'),
+    ('indication_to_protein', '2_indication_to_protein.tsv', 'indication', 'protein'),
+    ('protein_to_protein', '3_protein_to_protein.tsv', 'protein', 'protein'),
+    ('protein_to_bio', '4_protein_to_biological_function.tsv', 'protein', 'bio'),
+    ('bio_to_bio', '5_biological_function_to_biological_function.tsv', 'bio', 'bio'),
+]
+EDGE_TYPES = [edge_type for edge_type, _, _, _ in EDGE_FILES]
+EDGE_TYPE_CODES = {edge_type: code for code, edge_type in enumerate(EDGE_TYPES)}
+
+COLUMNS = ['node_1', 'node_2', 'node_1_name', 'node_2_name']
+
+
+class MSITables:
+    def __init__(self, labels, names, node_types, edge_sources, edge_targets, edge_types):
+        """
+        Columnar form of the multiscale interactome.
+
+        - labels (str array): Interned node labels; a node's id is its position.
+        - names (str array): Display name of each node, falling back to the label.
+        - node_types (int8 array): Codes into graph_core.NODE_TYPES.
+        - edge_sources, edge_targets (int32 arrays): Node ids of each edge, in file order.
+        - edge_types (int8 array): Codes into EDGE_TYPES, i.e. which file each edge came from.
+        """
+        self.labels = labels
+        self.names = names
+        self.node_types = node_types
+        self.edge_sources = edge_sources
+        self.edge_targets = edge_targets
+        self.edge_types = edge_types
+
+
+def read_edge_file(path):
+    # Everything is read as strings: protein ids are numbers in the files but labels everywhere else.
+    # na_filter=False turns missing names into '' instead of float NaN.
+    if not os.path.exists(path):
+        warnings.warn(f"{path} not found, continuing without these edges")
+        return pd.DataFrame({column: np.array([], dtype=object) for column in COLUMNS})
+    return pd.read_csv(path, sep='\t', usecols=COLUMNS, dtype=str, na_filter=False)
+
+
+def load_msi_tables(data_path):
+    """
+    Read all MSI edge files and dictionary-encode every node label to a dense int id.
+
+    Labels are numbered in order of first appearance (edge by edge, file by file), which is the
+    node order the diffusion profiles are computed with. A node keeps the type of its last
+    occurrence and the last non-empty name it was given.
+
+    Input:
+    - data_path (str): Directory containing the EDGE_FILES.
+
+    Output:
+    - MSITables
+    """
+    frames = [read_edge_file(os.path.join(data_path, file_name)) for _, file_name, _, _ in EDGE_FILES]
+    n_edges = np.array([len(data_frame) for data_frame in frames])
+
+    # Interleave node_1 and node_2 so occurrence 2i is the source and 2i + 1 the target of edge i
+    occurrence_labels = np.concatenate([data_frame[['node_1', 'node_2']].to_numpy(dtype=object).ravel() for data_frame in frames])
+    occurrence_names = np.concatenate([data_frame[['node_1_name', 'node_2_name']].to_numpy(dtype=object).ravel() for data_frame in frames])
+    occurrence_types = np.concatenate([np.tile([NODE_TYPE_CODES[node_type_1], NODE_TYPE_CODES[node_type_2]], n)
+                                       for (_, _, node_type_1, node_type_2), n in zip(EDGE_FILES, n_edges)]).astype(np.int8)
+
+    # One hash pass over every label occurrence
+    codes, labels = pd.factorize(occurrence_labels)
+    codes = codes.astype(np.int32)
+    labels = labels.astype(str)
+
+    node_types = np.zeros(len(labels), dtype=np.int8)
+    node_types[codes] = occurrence_types
+
+    names = labels.astype(object)
+    named = occurrence_names != ''
+    names[codes[named]] = occurrence_names[named]
+
+    return MSITables(
+        labels=labels,
+        names=names.astype(str),
+        node_types=node_types,
+        edge_sources=codes[0::2],
+        edge_targets=codes[1::2],
+        edge_types=np.repeat(np.arange(len(EDGE_FILES), dtype=np.int8), n_edges),
+    )
@@ -0,0 +1,326 @@
+import bisect
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('msi')
+
+
+#===================================================================
+# Request stage timing and Prometheus metrics
+#===================================================================
+# Code that serves a request wraps each step in stage(name): label_lookup, ann_query, top_k,
+# subgraph, vis_conversion, serialization. Inside a request (InstrumentationMiddleware) the
+# durations are summed per stage and observed once per request in msi_stage_seconds; outside
+# one (scripts, benchmarks) every call is observed directly. Startup work is timed with
+# startup_phase(name) into msi_startup_seconds.
+#
+# /metrics renders everything in the Prometheus text format. Gunicorn runs several workers and a
+# scrape reaches only one of them, so every worker regularly writes its metrics to
+# <MSI_METRICS_DIR>/<master pid>/<worker pid>.json and /metrics sums the files of all workers
+# under the same master. Counters of workers that exited are kept, as Prometheus expects.
+# Set MSI_METRICS_DIR to '' to only report the worker that answers.
+
+STAGE_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+STARTUP_BUCKETS = [0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0]
+# Bucket bounds of the k1 / k2 request labels
+K_BUCKETS = [10, 25, 50, 100, 250, 500, 1000]
+
+FLUSH_INTERVAL = 1.0
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> bucket counts (non-cumulative, last one +Inf), sum, count
+        self.values = {}
+
+    def observe(self, value, *labelvalues):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                state = self.values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[position] += 1
+            state[-2] += value
+            state[-1] += 1
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class MetricsRegistry:
+    def __init__(self, directory=None):
+        self.metrics = {}
+        self.directory = directory
+        self.last_flush = 0.0
+
+    def histogram(self, name, documentation, labelnames, buckets=STAGE_BUCKETS):
+        self.metrics[name] = Histogram(name, documentation, labelnames, buckets)
+        return self.metrics[name]
+
+    def counter(self, name, documentation, labelnames):
+        self.metrics[name] = Counter(name, documentation, labelnames)
+        return self.metrics[name]
+
+    def state(self):
+        """
+        Output:
+        - dict: JSON-serializable copy of every metric, keyed by the JSON-encoded label values.
+        """
+        state = {}
+        for name, metric in self.metrics.items():
+            with metric.lock:
+                values = {json.dumps(labelvalues): (list(value) if isinstance(value, list) else value) for labelvalues, value in metric.values.items()}
+            state[name] = {'values': values}
+        return state
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Multi-worker aggregation
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+
+    def flush(self, force=False):
+        # Write this worker's metrics for the others to aggregate, at most every FLUSH_INTERVAL seconds
+        now = time.monotonic()
+        if not self.directory or (not force and now - self.last_flush < FLUSH_INTERVAL):
+            return
+        self.last_flush = now
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False, suffix='.tmp') as handle:
+                json.dump(self.state(), handle)
+            os.replace(handle.name, os.path.join(self.directory, f'{os.getpid()}.json'))
+        except OSError:
+            logger.warning('metrics flush failed directory=%s', self.directory, exc_info=True)
+
+    def collect(self):
+        """
+        Output:
+        - dict: The state of every worker summed, this worker's taken from memory.
+        """
+        states = [self.state()]
+        if self.directory:
+            self.flush(force=True)
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if os.path.basename(path) == f'{os.getpid()}.json':
+                    continue
+                try:
+                    with open(path) as handle:
+                        states.append(json.load(handle))
+                except (OSError, ValueError):
+                    # A worker is replacing its file; it is read again on the next scrape
+                    continue
+        return merge_states(states)
+
+    def render(self):
+        """
+        Output:
+        - str: Every metric in the Prometheus text exposition format.
+        """
+        state = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+            lines += [f'# HELP {name} {metric.documentation}', f'# TYPE {name} {kind}']
+            for key, value in sorted(state.get(name, {}).get('values', {}).items()):
+                labels = [f'{labelname}="{escape_label(labelvalue)}"' for labelname, labelvalue in zip(metric.labelnames, json.loads(key))]
+                if kind == 'counter':
+                    lines.append(f'{name}{{{",".join(labels)}}} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ['+Inf'], value[:-2]):
+                    cumulative += count
+                    bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                    lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+                lines.append(f'{name}_sum{{{",".join(labels)}}} {value[-2]}')
+                lines.append(f'{name}_count{{{",".join(labels)}}} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def merge_states(states):
+    merged = {}
+    for state in states:
+        for name, metric in state.items():
+            values = merged.setdefault(name, {'values': {}})['values']
+            for key, value in metric['values'].items():
+                if key not in values:
+                    values[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    values[key] = [a + b for a, b in zip(values[key], value)]
+                else:
+                    values[key] += value
+    return merged
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def default_metrics_directory():
+    directory = os.environ.get('MSI_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'msi_metrics'))
+    # Workers of one gunicorn master share its pid as their parent; older runs are left out
+    return os.path.join(directory, str(os.getppid())) if directory else None
+
+
+REGISTRY = MetricsRegistry(default_metrics_directory())
+
+STAGE_SECONDS = REGISTRY.histogram('msi_stage_seconds', 'Time spent in each stage of a request.', ['endpoint', 'stage'])
+REQUEST_SECONDS = REGISTRY.histogram('msi_request_seconds', 'Time to serve a request, including streamed bodies.', ['endpoint'])
+REQUESTS = REGISTRY.counter('msi_requests_total', 'Requests by endpoint, status and k1 / k2 bucket.', ['endpoint', 'status', 'k1', 'k2'])
+STARTUP_SECONDS = REGISTRY.histogram('msi_startup_seconds', 'Time spent in each startup phase, once per process that ran it.', ['phase'], buckets=STARTUP_BUCKETS)
+
+
+#===================================================================
+# Timing stages
+#===================================================================
+
+class RequestTiming:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.k1 = self.k2 = ''
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        request = current_request.get()
+        if request is None:
+            STAGE_SECONDS.observe(elapsed, '', name)
+        else:
+            request.stages[name] = request.stages.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STARTUP_SECONDS.observe(elapsed, name)
+        logger.info('startup phase=%s seconds=%.3f', name, elapsed)
+
+
+def k_bucket(k):
+    # Upper bound of the K_BUCKETS bucket k falls in, as a label value
+    position = bisect.bisect_left(K_BUCKETS, k)
+    return str(K_BUCKETS[position]) if position < len(K_BUCKETS) else '+Inf'
+
+
+def record_k(k1=None, k2=None):
+    # Label the current request's count with its k1 / k2 buckets
+    request = current_request.get()
+    if request is not None:
+        request.k1 = k_bucket(k1) if k1 is not None else ''
+        request.k2 = k_bucket(k2) if k2 is not None else ''
+
+
+def server_timing_header(stages, total):
+    return ', '.join([f'{name};dur={seconds * 1000:.3f}' for name, seconds in stages.items()] + [f'total;dur={total * 1000:.3f}'])
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware that times every HTTP request, records its stages and count, and with
+    server_timing adds the stages finished before the response starts as a Server-Timing header.
+
+    Requests to paths that are not routes of the app are counted under endpoint "other", so
+    stray URLs cannot grow the number of series.
+    """
+
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+        self.endpoints = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        if self.endpoints is None:
+            self.endpoints = {getattr(route, 'path', None) for route in scope['app'].routes} - {None}
+        endpoint = scope['path'] if scope['path'] in self.endpoints else 'other'
+        request = RequestTiming(endpoint)
+        token = current_request.set(request)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self.server_timing:
+                    header = server_timing_header(request.stages, time.perf_counter() - start)
+                    message['headers'] = list(message.get('headers', [])) + [(b'server-timing', header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+            for name, seconds in request.stages.items():
+                STAGE_SECONDS.observe(seconds, endpoint, name)
+            REQUESTS.inc(endpoint, str(status), request.k1, request.k2)
+            REGISTRY.flush()
+
+
+def test_instrumentation():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('test_seconds', 'Test.', ['stage'], buckets=[0.1, 1.0])
+    counter = registry.counter('test_total', 'Test.', ['endpoint'])
+    for value in [0.05, 0.5, 5.0]:
+        histogram.observe(value, 'a')
+    counter.inc('/graph')
+
+    # Two workers with the same metrics add up
+    state = merge_states([registry.state(), registry.state()])
+    assert state['test_seconds']['values']['["a"]'] == [2, 2, 2, 11.1, 6]
+    assert state['test_total']['values']['["/graph"]'] == 2
+
+    text = registry.render()
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in text and 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text and 'test_total{endpoint="/graph"} 1' in text
+
+    assert [k_bucket(k) for k in [1, 10, 11, 1000, 1001]] == ['10', '10', '25', '1000', '+Inf']
+
+    # Within a request stage durations are summed per stage instead of observed
+    request = RequestTiming('/graph')
+    token = current_request.set(request)
+    with stage('top_k'):
+        pass
+    with stage('top_k'):
+        pass
+    current_request.reset(token)
+    assert list(request.stages) == ['top_k']
+
+    print("All tests passed.")
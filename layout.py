@@ -0,0 +1,255 @@
+import numpy as np
+
+
+#===================================================================
+# Force-directed layout of MOA subgraphs
+#===================================================================
+# Fruchterman-Reingold with the ideal edge length as the unit: edges pull their ends together
+# with d^2, every pair of nodes pushes apart with 1/d, and a linear pull towards the center
+# keeps disconnected parts in view. Each iteration moves every node along its net force, at
+# most by a temperature that cools to zero.
+#
+# Repulsion is every pair of nodes, computed exactly up to EXACT_REPULSION_NODES nodes. Larger
+# graphs use a hierarchy of grids over the layout (a Barnes-Hut scheme with cells instead of a
+# tree): a node feels the nodes of its own and adjacent finest cells exactly, and every other
+# node through the centroid of the largest cell that is not adjacent to its own, so each
+# iteration costs O(n log n).
+#
+# Layouts are seeded, so the same subgraph always gets the same positions. A layout can start
+# from the positions of an overlapping one (the same pair at a nearby k): the shared nodes stay
+# where the user saw them and the new ones start next to their neighbours, which also needs
+# fewer iterations.
+
+DEFAULT_ITERATIONS = 100
+WARM_START_ITERATIONS = 30
+# Largest first step of a warm start, in edge lengths
+WARM_START_TEMPERATURE = 1.0
+DEFAULT_GRAVITY = 0.5
+DEFAULT_LAYOUT_SEED = 0
+EXACT_REPULSION_NODES = 500
+# Average nodes per finest cell of the grid hierarchy
+NODES_PER_CELL = 8
+MAX_GRID_LEVELS = 16
+# Pixels per ideal edge length, about the spring length of vis.js
+LAYOUT_SCALE = 100.0
+
+
+def undirected_edges(sources, targets):
+    # Each connected pair once, without self loops
+    sources, targets = np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+    pairs = np.unique(np.stack([np.minimum(sources, targets), np.maximum(sources, targets)], axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return pairs[:, 0], pairs[:, 1]
+
+
+def exact_repulsion(positions, block_size=256):
+    """
+    Output:
+    - numpy array of float (n, 2): Sum over every other node of delta / |delta|^2, the 1/d
+      repulsion along the direction away from it.
+    """
+    forces = np.zeros_like(positions)
+    for start in range(0, len(positions), block_size):
+        delta = positions[start:start + block_size, None, :] - positions[None, :, :]
+        squared = np.einsum('ijk,ijk->ij', delta, delta)
+        # The node itself, and coincident nodes, push with nothing
+        squared[squared == 0] = np.inf
+        forces[start:start + block_size] = np.einsum('ijk,ij->ik', delta, 1 / squared)
+    return forces
+
+
+def expand_ranges(starts, counts):
+    # Concatenation of range(start, start + count) for each start, count
+    offsets = np.cumsum(counts) - counts
+    return np.arange(counts.sum(), dtype=np.int64) + np.repeat(starts - offsets, counts)
+
+
+def grid_repulsion(positions, nodes_per_cell=NODES_PER_CELL):
+    """
+    exact_repulsion approximated through a hierarchy of grids, in O(n log n).
+
+    The grid at level l splits the bounding square into 2^l x 2^l cells. A cell is in the
+    interaction list of a node at level l if it is not adjacent to the node's cell while its
+    parent is adjacent to the node's parent cell, so every other node is counted once: through
+    such a cell's centroid, or exactly if it is in the finest cells adjacent to the node's.
+    """
+    n = len(positions)
+    lower = positions.min(axis=0)
+    side = max(float((positions.max(axis=0) - lower).max()), 1e-9) * (1 + 1e-9)
+    deepest = np.minimum(((positions - lower) / side * (1 << MAX_GRID_LEVELS)).astype(np.int64), (1 << MAX_GRID_LEVELS) - 1)
+    # Layouts are dense in the middle, so the depth follows the occupancy rather than n: refine
+    # until the exact pairs within cells are about nodes_per_cell per node
+    levels = 2
+    while levels < MAX_GRID_LEVELS:
+        cells = deepest >> (MAX_GRID_LEVELS - levels)
+        occupancy = np.unique(cells[:, 0] << MAX_GRID_LEVELS | cells[:, 1], return_counts=True)[1]
+        if np.dot(occupancy, occupancy) <= nodes_per_cell * n:
+            break
+        levels += 1
+    finest = deepest >> (MAX_GRID_LEVELS - levels)
+
+    forces = np.zeros_like(positions)
+    # Children of the parent cell's 3 x 3 neighbourhood, as offsets from twice the parent cell
+    child_offsets = np.arange(-2, 4)
+    for level in range(2, levels + 1):
+        width = 1 << level
+        cells = finest >> (levels - level)
+        cell_ids = cells[:, 0] * width + cells[:, 1]
+        mass = np.bincount(cell_ids, minlength=width * width)
+        centroids = np.stack([np.bincount(cell_ids, positions[:, axis], minlength=width * width) for axis in range(2)], axis=1)
+        centroids /= np.maximum(mass, 1)[:, None]
+
+        # The 36 candidate cells of every node at once, weighted 0 unless in its interaction list
+        x = (2 * (cells[:, 0] >> 1))[:, None, None] + child_offsets[None, :, None]
+        y = (2 * (cells[:, 1] >> 1))[:, None, None] + child_offsets[None, None, :]
+        far = (np.abs(x - cells[:, 0, None, None]) > 1) | (np.abs(y - cells[:, 1, None, None]) > 1)
+        valid = far & (x >= 0) & (x < width) & (y >= 0) & (y < width)
+        ids = np.where(valid, x * width + y, 0).reshape(len(positions), -1)
+        delta = positions[:, None, :] - centroids[ids]
+        squared = np.maximum(np.einsum('ijk,ijk->ij', delta, delta), 1e-12)
+        forces += np.einsum('ijk,ij->ik', delta, valid.reshape(len(positions), -1) * mass[ids] / squared)
+
+    # Exact interactions with the nodes of the adjacent finest cells, found in cell order
+    width = 1 << levels
+    cell_ids = finest[:, 0] * width + finest[:, 1]
+    order = np.argsort(cell_ids, kind='stable')
+    cell_starts = np.searchsorted(cell_ids[order], np.arange(width * width + 1))
+    offsets = np.array([-1, 0, 1])
+    x = (finest[:, 0, None] + offsets[None, :])[:, :, None].repeat(3, axis=2).reshape(n, -1)
+    y = (finest[:, 1, None] + offsets[None, :])[:, None, :].repeat(3, axis=1).reshape(n, -1)
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < width)
+    nodes = np.nonzero(inside)[0]
+    neighbour_cells = (x * width + y)[inside]
+    counts = cell_starts[neighbour_cells + 1] - cell_starts[neighbour_cells]
+    partners = order[expand_ranges(cell_starts[neighbour_cells], counts)]
+    nodes = np.repeat(nodes, counts)
+    delta = positions[nodes] - positions[partners]
+    squared = np.einsum('ij,ij->i', delta, delta)
+    squared[squared == 0] = np.inf
+    contributions = delta / squared[:, None]
+    for axis in range(2):
+        forces[:, axis] += np.bincount(nodes, contributions[:, axis], minlength=n)
+    return forces
+
+
+def force_layout(n_nodes, sources, targets, initial=None, iterations=DEFAULT_ITERATIONS, temperature=None,
+                 gravity=DEFAULT_GRAVITY, seed=DEFAULT_LAYOUT_SEED):
+    """
+    Input:
+    - n_nodes (int): Nodes of the graph, numbered 0..n_nodes-1.
+    - sources, targets (arrays of int): Edges; direction and duplicates are ignored.
+    - initial (numpy array of float (n_nodes, 2)): Starting positions in edge lengths; random
+      (from seed) if None.
+    - iterations (int): Force steps.
+    - temperature (float): Largest step of the first iteration; by default a tenth of the
+      expected diameter, less is enough when starting from a good layout.
+
+    Output:
+    - numpy array of float (n_nodes, 2): Positions in edge lengths, centered on 0.
+    """
+    rng = np.random.default_rng(seed)
+    radius = np.sqrt(n_nodes / gravity)
+    positions = rng.uniform(-radius, radius, (n_nodes, 2)) if initial is None else np.array(initial, dtype=np.float64)
+    if n_nodes < 2:
+        return positions * 0
+    sources, targets = undirected_edges(sources, targets)
+    temperature = 0.2 * radius if temperature is None else temperature
+    repulsion = exact_repulsion if n_nodes <= EXACT_REPULSION_NODES else grid_repulsion
+
+    for iteration in range(iterations):
+        forces = repulsion(positions) - gravity * (positions - positions.mean(axis=0))
+        delta = positions[sources] - positions[targets]
+        pull = delta * np.sqrt(np.einsum('ij,ij->i', delta, delta))[:, None]
+        for axis in range(2):
+            forces[:, axis] += np.bincount(targets, pull[:, axis], minlength=n_nodes) - np.bincount(sources, pull[:, axis], minlength=n_nodes)
+
+        # Move along the force, by at most the current temperature
+        length = np.sqrt(np.einsum('ij,ij->i', forces, forces))
+        step = np.minimum(length, temperature * (1 - iteration / iterations)) / np.maximum(length, 1e-12)
+        positions += forces * step[:, None]
+
+    return positions - positions.mean(axis=0)
+
+
+def warm_start_positions(node_ids, sources, targets, previous_node_ids, previous_positions, seed=DEFAULT_LAYOUT_SEED):
+    """
+    Starting positions for a subgraph from the layout of an overlapping one.
+
+    Input:
+    - node_ids (array of int): MSI ids of the subgraph's nodes.
+    - sources, targets (arrays of int): Its edges, as positions in node_ids.
+    - previous_node_ids, previous_positions: The earlier layout.
+
+    Output:
+    - numpy array of float (n, 2): Shared nodes keep their positions; new ones start at the
+      mean of their placed neighbours, or at random within the earlier layout if they have none.
+    """
+    rng = np.random.default_rng(seed)
+    node_ids = np.asarray(node_ids)
+    positions = np.zeros((len(node_ids), 2))
+    order = np.argsort(previous_node_ids)
+    found = np.searchsorted(previous_node_ids, node_ids, sorter=order)
+    found = np.minimum(found, len(order) - 1)
+    placed = previous_node_ids[order[found]] == node_ids
+    positions[placed] = previous_positions[order[found[placed]]]
+
+    # Sum and count of placed neighbours of every node
+    sources, targets = undirected_edges(sources, targets)
+    ends = np.concatenate([sources, targets])
+    others = np.concatenate([targets, sources])
+    from_placed = placed[others]
+    counts = np.bincount(ends[from_placed], minlength=len(node_ids))
+    sums = np.stack([np.bincount(ends[from_placed], positions[others[from_placed], axis], minlength=len(node_ids)) for axis in range(2)], axis=1)
+
+    new = ~placed
+    attached = new & (counts > 0)
+    # Jitter keeps nodes with the same neighbours apart
+    positions[attached] = sums[attached] / counts[attached][:, None] + rng.normal(0, 0.5, (attached.sum(), 2))
+    radius = np.abs(previous_positions).max() if len(previous_positions) else 1.0
+    positions[new & ~attached] = rng.uniform(-radius, radius, ((new & ~attached).sum(), 2))
+    return positions
+
+
+def layout_subgraph(subgraph, previous=None):
+    """
+    Input:
+    - subgraph (CSRGraph): An induced subgraph, with its MSI node ids.
+    - previous ((numpy array, numpy array)): Node ids and pixel positions of an overlapping
+      layout to start from, or None.
+
+    Output:
+    - numpy array of float32 (n, 2): Pixel positions of the subgraph's nodes.
+    """
+    sources, targets = subgraph.edges()
+    if previous is None:
+        positions = force_layout(subgraph.n_nodes, sources, targets)
+    else:
+        initial = warm_start_positions(subgraph.node_ids, sources, targets, previous[0], previous[1] / LAYOUT_SCALE)
+        positions = force_layout(subgraph.n_nodes, sources, targets, initial, iterations=WARM_START_ITERATIONS, temperature=WARM_START_TEMPERATURE)
+    return (positions * LAYOUT_SCALE).astype(np.float32)
+
+
+def test_layout():
+    rng = np.random.default_rng(1)
+
+    # The grid hierarchy counts every other node once and stays close to the exact forces
+    positions = rng.normal(0, 10, (3000, 2))
+    exact = exact_repulsion(positions)
+    approximate = grid_repulsion(positions)
+    error = np.linalg.norm(approximate - exact, axis=1) / np.linalg.norm(exact, axis=1)
+    assert np.median(error) < 0.05, f"Grid repulsion is off by {np.median(error):.3f}."
+
+    # Two triangles joined by one edge: linked nodes end up closer than unlinked ones
+    sources, targets = np.array([0, 1, 2, 3, 4, 5, 2]), np.array([1, 2, 0, 4, 5, 3, 3])
+    layout = force_layout(6, sources, targets)
+    assert np.array_equal(layout, force_layout(6, sources, targets)), "Layouts are not deterministic."
+    distances = np.linalg.norm(layout[:, None] - layout[None], axis=2)
+    assert distances[0, 1] < distances[0, 4] and distances[1, 2] < distances[1, 5]
+
+    # A warm start keeps the shared nodes and places new ones next to their neighbours
+    initial = warm_start_positions(np.array([10, 11, 12, 13]), np.array([0, 3]), np.array([1, 2]),
+                                   np.array([12, 10, 11]), np.array([[0.0, 0.0], [5.0, 5.0], [-5.0, 5.0]]))
+    assert np.array_equal(initial[:3], [[5.0, 5.0], [-5.0, 5.0], [0.0, 0.0]])
+    assert np.linalg.norm(initial[3]) < 3
+
+    print("All tests passed.")
@@ -1,21 +1,38 @@
 # Import necessary libraries
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request, Header
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
+import asyncio
+import json
+import logging
+import os
+import weakref
 
 # Import personalised modules
 from vector_database import *
 from utils import *
 from manager import *
+from snapshot import Snapshot, load_snapshot, read_current_key
+from diffusion import DiffusionEngine, SeedProfileSolver, create_transition_matrix
+from cache import LRUCache, PreparedPayload
+from execution import PoolSaturated, execution_pool_from_environment
+from instrumentation import REGISTRY, InstrumentationMiddleware, record_k, stage, startup_phase
+from graph_encoding import GRAPH_BINARY, GRAPH_COLUMNAR_JSON, GRAPH_JSON, encode_graph_binary, encode_graph_columnar_json, negotiate_graph_format, position_columns, vis_graph_chunk, vis_graph_columns
+from layout import layout_subgraph
+from paths import PathFinder
 
 #===================================================================
 #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 #===================================================================
 
+# Structured key=value logs; MSI_LOG_LEVEL=DEBUG also logs every /graph request
+logging.basicConfig(level=os.environ.get('MSI_LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s pid=%(process)d %(message)s')
+logger = logging.getLogger('msi')
+
 # Initialize the FastAPI application
 app = FastAPI()
 
@@ -36,36 +53,172 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Stage timings and request counts for /metrics (see instrumentation.py);
+# MSI_SERVER_TIMING=1 also returns the stage timings of each request in a Server-Timing header
+app.add_middleware(InstrumentationMiddleware, server_timing=os.environ.get('MSI_SERVER_TIMING') == '1')
+
 # Initialize Jinja2 templates with the "templates" directory
 templates = Jinja2Templates(directory="templates")
 
 # Instantiate and initialize necessary components for the application
-data_path = './data/'
-graph_manager = GraphManager(data_path)
-
-# Load diffusion profiles
-with np.load(f'{data_path}compressed_diffusion_profiles.npz') as data:
-    drug_diffusion_profiles = data['arr1']
-    indication_diffusion_profiles = data['arr2']
-
-map_drug_diffusion_labels_to_indices = load_data_dict(f'{data_path}map_drug_labels_to_indices')
-map_drug_diffusion_indices_to_labels = {v: k for k, v in map_drug_diffusion_labels_to_indices.items()}
-map_indication_diffusion_labels_to_indices = load_data_dict(f'{data_path}map_indication_labels_to_indices')
-map_indication_diffusion_indices_to_labels = {v: k for k, v in map_indication_diffusion_labels_to_indices.items()}
-
-drug_vector_db = MultiMetricDatabase(dimensions=drug_diffusion_profiles.shape[1], metrics=['angular', 'euclidean', 'manhattan'], n_trees=30)
-drug_vector_db.add_vectors(drug_diffusion_profiles, map_drug_diffusion_labels_to_indices)
+# Everything is memory-mapped from a prebuilt snapshot (python snapshot.py ./data/), which is
+# rebuilt here only if the data or build parameters changed since it was written.
+# MSI_DATA_PATH and MSI_SNAPSHOT_ROOT point the app at other data, e.g. a synthetic MSI
+# (benchmarks/synthetic_msi.py). When <MSI_SNAPSHOT_ROOT>/CURRENT moves to another snapshot, e.g.
+# after python delta.py <delta>, every worker switches to it while serving.
+data_path = os.environ.get('MSI_DATA_PATH', './data/')
+snapshot_root = os.environ.get('MSI_SNAPSHOT_ROOT', './snapshots/')
+
+# Profiles of recent /profile seed sets, keyed by snapshot key and node ids (see SeedProfileSolver)
+profile_cache = LRUCache('profile', max_entries=int(os.environ.get('MSI_PROFILE_CACHE_ENTRIES', 256)), max_bytes=64 << 20, sizeof=lambda profile: profile.nbytes)
+
+
+class ServingState:
+    def __init__(self, snapshot):
+        """
+        The lookup tables, indexes and payloads the routes use, derived from one snapshot.
+
+        A state is never modified once built. The one being served is serving_state: replaced
+        with a single assignment when a new snapshot is published (see watch_current_snapshot),
+        and read once by each request, which passes it to everything it calls.
+        """
+        self.snapshot = snapshot
+        self.key = snapshot.key
+        self.graph_manager = graph_manager = snapshot.graph_manager
+
+        # Load diffusion profiles
+        self.drug_diffusion_profiles = snapshot.drug_diffusion_profiles
+        self.indication_diffusion_profiles = snapshot.indication_diffusion_profiles
+
+        self.map_drug_diffusion_labels_to_indices = snapshot.map_drug_diffusion_labels_to_indices
+        self.map_drug_diffusion_indices_to_labels = {v: k for k, v in self.map_drug_diffusion_labels_to_indices.items()}
+        self.map_indication_diffusion_labels_to_indices = snapshot.map_indication_diffusion_labels_to_indices
+        self.map_indication_diffusion_indices_to_labels = {v: k for k, v in self.map_indication_diffusion_labels_to_indices.items()}
+
+        self.drug_vector_db = snapshot.drug_vector_db
+        self.drug_exact_db = snapshot.drug_exact_db
+
+        # Approximate (Annoy) and exact k-NN backends share the nearest_neighbors interface.
+        # benchmarks/knn_recall.py reports the latency and recall of each to choose between them.
+        self.drug_vector_dbs = {'annoy': self.drug_vector_db, 'exact': self.drug_exact_db}
+
+        # Precomputed exact indication -> top-N drug rankings per metric (see ranking.py).
+        # Serving from these is a slice, independent of index quality or tree count.
+        self.drug_ranking_tables = snapshot.drug_ranking_tables
+
+        # Drug label and name of every profile row, for turning k-NN results into responses
+        self.drug_labels_by_index = [self.map_drug_diffusion_indices_to_labels[index] for index in range(len(self.map_drug_diffusion_indices_to_labels))]
+        self.drug_names_by_index = [graph_manager.get_node_name(label) for label in self.drug_labels_by_index]
+        self.indication_labels_by_index = [self.map_indication_diffusion_indices_to_labels[index] for index in range(len(self.map_indication_diffusion_indices_to_labels))]
+        self.indication_names_by_index = [graph_manager.get_node_name(label) for label in self.indication_labels_by_index]
+
+        # Drugs and indications indexed symmetrically, for the reverse (drug -> diseases) and drug -> drug queries
+        self.similarity_engine = snapshot.similarity_engine
+        self.map_labels_to_indices_by_kind = {'drug': self.map_drug_diffusion_labels_to_indices, 'indication': self.map_indication_diffusion_labels_to_indices}
+        self.labels_by_index_by_kind = {'drug': self.drug_labels_by_index, 'indication': self.indication_labels_by_index}
+        self.names_by_index_by_kind = {'drug': self.drug_names_by_index, 'indication': self.indication_names_by_index}
+
+        # Diffusion profiles of user-supplied seed sets (/profile). Drug and indication seeds reuse
+        # their stored profiles; other seeds are solved online on the graph they were computed on.
+        self.stored_profile_rows = {graph_manager.mapping_label_to_index[label]: (kind, row)
+                                    for kind, labels_to_indices in self.map_labels_to_indices_by_kind.items() for label, row in labels_to_indices.items()}
+        walk_graph = graph_manager.create_H_graph()
+        with startup_phase('profile_solver'):
+            self.profile_solver = SeedProfileSolver(DiffusionEngine(create_transition_matrix(walk_graph)), self.get_stored_profile, profile_cache, version=(self.key,))
+
+        # Drug -> disease mechanism paths over the same graph (/graph with paths)
+        with startup_phase('path_finder'):
+            self.path_finder = PathFinder(walk_graph)
+
+        # The disease and drug lists only change with the data: serialized and compressed once, with ETags
+        list_of_diseases = [
+            {"value": graph_manager.mapping_indication_name_to_label[name], "name": name}
+            for name in graph_manager.indication_names_sorted
+        ]
+        list_of_drugs = [
+            {"value": graph_manager.mapping_drug_name_to_label[name], "name": name}
+            for name in graph_manager.drug_names_sorted if name in graph_manager.mapping_drug_name_to_label
+        ]
+        self.diseases_payload = PreparedPayload(json.dumps(list_of_diseases, ensure_ascii=False, separators=(",", ":")).encode(), version=self.key)
+        self.drugs_payload = PreparedPayload(json.dumps(list_of_drugs, ensure_ascii=False, separators=(",", ":")).encode(), version=self.key)
+
+    def get_stored_profile(self, node_id):
+        kind, row = self.stored_profile_rows.get(node_id, (None, None))
+        return None if kind is None else self.similarity_engine.profiles[kind][row]
+
+    def __reduce__(self):
+        # Process workers are forked with every state still in use (see execution.py), so a state
+        # sent to one is sent as its key
+        return serving_state_by_key, (self.key,)
+
+
+# States still referenced by a request, by snapshot key
+serving_states = weakref.WeakValueDictionary()
+
+
+def serving_state_by_key(key):
+    return serving_states[key]
+
+
+def activate_snapshot(state):
+    """
+    Serve a ServingState: at startup, and again whenever a new snapshot is published. Requests
+    already running keep the state they started with.
+    """
+    global serving_state
+    serving_states[state.key] = state
+    # Profiles computed on the graph of the previous snapshot are never served again
+    profile_cache.clear()
+    serving_state = state
+
+with startup_phase('snapshot_load'):
+    activate_snapshot(ServingState(load_snapshot(data_path, snapshot_root=snapshot_root)))
+
+# k-NN queries and subgraph builds run on a bounded pool, off the event loop (see execution.py)
+execution_pool = execution_pool_from_environment()
+
+# Computed responses, keyed on the snapshot they were computed from (see cache.py)
+graph_cache = LRUCache('graph', max_entries=int(os.environ.get('MSI_GRAPH_CACHE_ENTRIES', 1024)),
+                       max_bytes=int(os.environ.get('MSI_GRAPH_CACHE_MB', 128)) << 20, sizeof=lambda value: len(value[0]))
+# Node positions of laid out MOA subgraphs: (node ids, pixel positions)
+layout_cache = LRUCache('layout', max_entries=int(os.environ.get('MSI_LAYOUT_CACHE_ENTRIES', 1024)), max_bytes=32 << 20,
+                        sizeof=lambda value: value[0].nbytes + value[1].nbytes)
+# Mechanism paths per disease / drug pair: list of (node ids, score)
+paths_cache = LRUCache('paths', max_entries=int(os.environ.get('MSI_PATHS_CACHE_ENTRIES', 1024)), max_bytes=8 << 20)
+drug_candidates_cache = LRUCache('drugs_for_disease', max_entries=int(os.environ.get('MSI_DRUG_CACHE_ENTRIES', 4096)), max_bytes=16 << 20)
+
+
+async def cached_run_in_pool(state, cache, function, *args, key):
+    # run_in_pool(function, state, *args) through an LRU cache; the snapshot key keeps results of other data out
+    key = (state.key,) + key
+    result = cache.get(key)
+    if result is None:
+        result = await run_in_pool(function, state, *args, key=key)
+        cache.put(key, result)
+    return result
+
+
+async def run_in_pool(function, *args, key=None):
+    """
+    Run CPU-bound request work on the execution pool; identical calls in flight (same key) share one result.
+    Answers 503 when the pool is saturated.
+    """
+    try:
+        return await execution_pool.run(function, *args, key=key)
+    except PoolSaturated:
+        raise HTTPException(status_code=503, detail="Server busy, retry shortly", headers={"Retry-After": "1"})
 
 #====================================================================================================================
 # Define core recommendation function
 #====================================================================================================================
 
-def get_drugs_for_disease(chosen_indication_label, distance_metric='manhattan'):
+def get_drugs_for_disease(state, chosen_indication_label, distance_metric='manhattan', backend='table'):
     
     # Translate indication name to index in indication diffusion profiles, to retrieve diffusion profile
     #chosen_indication_label = graph_manager.mapping_indication_name_to_label[chosen_indication_name]
-    chosen_indication_index = map_indication_diffusion_labels_to_indices[chosen_indication_label]
-    chosen_indication_diffusion_profile = indication_diffusion_profiles[chosen_indication_index]
+    with stage('label_lookup'):
+        chosen_indication_index = state.map_indication_diffusion_labels_to_indices[chosen_indication_label]
+        chosen_indication_diffusion_profile = state.indication_diffusion_profiles[chosen_indication_index]
 
     #====================================
     # Querying Vector Database to return drug candidates
@@ -74,16 +227,122 @@ def get_drugs_for_disease(chosen_indication_label, distance_metric='manhattan'):
 
     query = chosen_indication_diffusion_profile
 
-    drug_candidates_indices = drug_vector_db.nearest_neighbors(query, distance_metric, num_recommendations)
+    with stage('ann_query'):
+        if backend == 'table' and distance_metric in state.drug_ranking_tables:
+            drug_candidates_indices = state.drug_ranking_tables[distance_metric].lookup(chosen_indication_index, num_recommendations)[0].tolist()
+        else:
+            # No table for this metric: fall back to a live k-NN query
+            if backend == 'table':
+                backend = 'annoy' if distance_metric in state.drug_vector_db.metrics else 'exact'
+            drug_candidates_indices = state.drug_vector_dbs[backend].nearest_neighbors(query, distance_metric, num_recommendations)
 
-    drug_candidates_labels = [map_drug_diffusion_indices_to_labels[index] for index in drug_candidates_indices]
-    #drug_candidates_names = [graph_manager.mapping_drug_label_to_name[i] for i in drug_candidates_labels]
-    drug_candidates_names = [graph_manager.mapping_all_labels_to_names[label] for label in drug_candidates_labels]
+    with stage('label_lookup'):
+        drug_candidates_labels = [state.map_drug_diffusion_indices_to_labels[index] for index in drug_candidates_indices]
+        #drug_candidates_names = [graph_manager.mapping_drug_label_to_name[i] for i in drug_candidates_labels]
+        drug_candidates_names = [state.graph_manager.get_node_name(label) for label in drug_candidates_labels]
 
 
     return drug_candidates_names # List
 
 
+def get_drugs_for_diseases_block(state, chosen_indication_labels, k=10, distance_metric='correlation'):
+    """
+    Top-k drugs for a block of indications, computed as one matrix product (see iter_drugs_for_diseases).
+
+    Input:
+    - chosen_indication_labels (list of str): Indications to screen.
+    - k (int): Number of drugs per indication.
+    - distance_metric (str): One of drug_ranking_tables (served from the table when k fits) or drug_exact_db.metrics.
+
+    Output:
+    - list of dict: One result per indication, in input order.
+    """
+    known_labels = [label for label in chosen_indication_labels if label in state.map_indication_diffusion_labels_to_indices]
+    rows = [state.map_indication_diffusion_labels_to_indices[label] for label in known_labels]
+
+    results = {}
+    if rows:
+        with stage('ann_query'):
+            if distance_metric in state.drug_ranking_tables and k <= state.drug_ranking_tables[distance_metric].top_n:
+                indices, distances = state.drug_ranking_tables[distance_metric].lookup_batch(rows, k)
+            else:
+                indices, distances = state.drug_exact_db.nearest_neighbors_batch(state.indication_diffusion_profiles[rows], distance_metric, k, return_distances=True)
+        for label, drug_indices, drug_distances in zip(known_labels, indices.tolist(), distances.tolist()):
+            results[label] = [{"value": state.drug_labels_by_index[index], "name": state.drug_names_by_index[index], "distance": distance}
+                              for index, distance in zip(drug_indices, drug_distances)]
+
+    return [{"disease_label": label, "drugs": results[label]} if label in results else {"disease_label": label, "error": "unknown disease label"}
+            for label in chosen_indication_labels]
+
+
+async def iter_drugs_for_diseases(state, chosen_indication_labels, k=10, distance_metric='correlation', block_size=256):
+    """
+    Top-k drugs for many indications as NDJSON, each block computed on the execution pool as the
+    previous one is sent.
+
+    Input:
+    - block_size (int): Indications per block; bounds the (block_size x n_drugs) distance matrix.
+
+    Output:
+    - async generator of str: The lines of one block at a time, one per indication, in input order.
+      A saturated pool raises PoolSaturated for the first block; after that the response has
+      started, so the remaining indications get a "server busy" error line to retry them with.
+    """
+    for start in range(0, len(chosen_indication_labels), block_size):
+        block_labels = chosen_indication_labels[start:start + block_size]
+        try:
+            results = await execution_pool.run(get_drugs_for_diseases_block, state, block_labels, k, distance_metric,
+                                               key=(state.key, 'drugs_for_diseases', tuple(block_labels), k, distance_metric))
+        except PoolSaturated:
+            if start == 0:
+                raise
+            yield "".join(json.dumps({"disease_label": label, "error": "server busy"}) + "\n" for label in chosen_indication_labels[start:])
+            return
+        yield "".join(json.dumps(result) + "\n" for result in results)
+
+
+async def prepend(first, rest):
+    yield first
+    async for item in rest:
+        yield item
+
+
+def get_fused_drugs_for_disease(state, chosen_indication_label, k=10, distance_metrics=None):
+    """
+    Drug candidates from every Annoy metric at once, re-ranked exactly and combined by reciprocal-rank fusion.
+
+    Output:
+    - list of dict: {"value", "name", "score", "ranks"} per drug, best fused score first;
+      ranks holds the drug's exact rank under each fused metric.
+    """
+    with stage('label_lookup'):
+        query = state.indication_diffusion_profiles[state.map_indication_diffusion_labels_to_indices[chosen_indication_label]]
+    with stage('ann_query'):
+        indices, scores, ranks = state.drug_vector_db.fused_nearest_neighbors(query, k, metrics=distance_metrics)
+    return [{"value": state.drug_labels_by_index[index], "name": state.drug_names_by_index[index], "score": float(score),
+             "ranks": {metric: int(metric_ranks[position]) for metric, metric_ranks in ranks.items()}}
+            for position, (index, score) in enumerate(zip(indices.tolist(), scores))]
+
+
+def get_similar(state, source_kind, source_label, target_kind, k=10, distance_metric='correlation'):
+    """
+    Rank drugs or indications by exact distance to one drug or indication.
+
+    Input:
+    - source_kind, target_kind (str): 'drug' or 'indication'.
+    - source_label (str): Label of the query drug/indication.
+
+    Output:
+    - list of dict: {"value": label, "name": name} of the k closest, closest first.
+    """
+    with stage('label_lookup'):
+        source_row = state.map_labels_to_indices_by_kind[source_kind][source_label]
+    with stage('ann_query'):
+        indices, _ = state.similarity_engine.nearest(source_kind, source_row, target_kind, k, distance_metric)
+    return [{"value": state.labels_by_index_by_kind[target_kind][index], "name": state.names_by_index_by_kind[target_kind][index]}
+            for index in indices.tolist()]
+
+
 #===================================================================
 #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 #===================================================================
@@ -97,14 +356,45 @@ class Drug(BaseModel):
     value: str
     name: str
 
+class ScoredDrug(BaseModel):
+    value: str
+    name: str
+    score: Optional[float] = None  # Only set by the fusion backend
+    ranks: Optional[Dict[str, int]] = None
+
 class DiseaseDrugCandidatesRequest(BaseModel):
     disease_label: str
+    metric: str = 'manhattan'
+    backend: str = 'table'  # 'table', 'annoy', 'exact' or 'fusion'
+    metrics: Optional[List[str]] = None  # Metrics fused by the fusion backend, default all Annoy metrics
+
+class DiseasesDrugCandidatesRequest(BaseModel):
+    disease_labels: Optional[List[str]] = None  # None screens every indication
+    k: int = 10
+    metric: str = 'correlation'
+
+class DrugSimilarityRequest(BaseModel):
+    drug_label: str
+    k: int = 10
+    metric: str = 'correlation'
 
 class GraphRequest(BaseModel):
     disease_label: str
     drug_label: str
     k1: int
     k2: int
+    layout: bool = False  # Also return node positions (layout.py), to draw without physics
+    paths: int = 0  # If positive, this many drug -> disease paths (paths.py) instead of the top-k subgraph
+
+class GraphStreamRequest(GraphRequest):
+    chunk_size: int = 64
+
+class ProfileRequest(BaseModel):
+    seeds: List[str]  # Node labels: proteins, biological functions, drugs or indications
+    k: int = 10
+    metric: str = 'correlation'
+    num_nodes: int = 20
+    disease_label: Optional[str] = None  # Also return the MOA network between the seeds and this disease
 
 #====================================================================================================================
 # Define application routes
@@ -115,110 +405,505 @@ async def read_items(request: Request):
     """Serve the index.html page"""
     return templates.TemplateResponse("index.html", {"request": request})
 
+def prepared_response(payload, accept_encoding, if_none_match):
+    status_code, body, headers = payload.select(accept_encoding, if_none_match)
+    return Response(content=body, status_code=status_code, headers=headers, media_type=payload.media_type)
+
 @app.get("/diseases", response_model= List[Disease])
-async def get_diseases():
+async def get_diseases(accept_encoding: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None)):
     """Return a list of diseases"""
-    list_of_diseases = [
-        {"value": graph_manager.mapping_indication_name_to_label[name], "name": name}
-        for name in graph_manager.indication_names_sorted
-    ]
-    return list_of_diseases
+    return prepared_response(serving_state.diseases_payload, accept_encoding, if_none_match)
 
 @app.get("/drugs", response_model= List[Drug])
-async def get_diseases():
-    """Return a list of diseases"""
-    list_of_drugs = [
-        {"value": graph_manager.mapping_drug_name_to_label[name], "name": name}
-        for name in graph_manager.drug_names_sorted if name in graph_manager.mapping_drug_name_to_label
-    ]
-    return list_of_drugs
+async def get_drugs(accept_encoding: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None)):
+    """Return a list of drugs"""
+    return prepared_response(serving_state.drugs_payload, accept_encoding, if_none_match)
 
-@app.post("/drugs_for_disease", response_model= List[Drug])
+@app.post("/drugs_for_disease", response_model= List[ScoredDrug], response_model_exclude_none=True)
 async def get_drugs_for_selected_disease(disease_drug_candidates_request: DiseaseDrugCandidatesRequest):
     """Return a list of drugs based on the selected disease"""
 
     assert isinstance(disease_drug_candidates_request.disease_label, str)
 
-    drug_candidates = get_drugs_for_disease(disease_drug_candidates_request.disease_label)
+    state = serving_state
+    backend = disease_drug_candidates_request.backend
+    metric = disease_drug_candidates_request.metric
+    if backend == 'fusion':
+        metrics = disease_drug_candidates_request.metrics
+        if metrics is not None and (not metrics or not set(metrics) <= set(state.drug_vector_db.metrics)):
+            raise HTTPException(status_code=400, detail=f"Fusion metrics must be a subset of {state.drug_vector_db.metrics}")
+        return await run_in_pool(get_fused_drugs_for_disease, state, disease_drug_candidates_request.disease_label, 10, metrics,
+                                 key=(state.key, 'fusion', disease_drug_candidates_request.disease_label, tuple(metrics or ())))
+
+    supported = {'table': set(state.drug_ranking_tables) | set(state.drug_vector_db.metrics) | set(state.drug_exact_db.metrics),
+                 'annoy': set(state.drug_vector_db.metrics), 'exact': set(state.drug_exact_db.metrics)}
+    if metric not in supported.get(backend, set()):
+        raise HTTPException(status_code=400, detail=f"Unsupported backend/metric: {backend}/{disease_drug_candidates_request.metric}")
+
+    drug_candidates = await cached_run_in_pool(state, drug_candidates_cache, get_drugs_for_disease, disease_drug_candidates_request.disease_label, metric, backend,
+                                               key=('drugs_for_disease', disease_drug_candidates_request.disease_label, metric, backend))
     list_of_drug_candidates = [
-        {"value": graph_manager.mapping_drug_name_to_label[name], "name": name}
+        {"value": state.graph_manager.mapping_drug_name_to_label[name], "name": name}
         for name in drug_candidates
     ]
     return list_of_drug_candidates
 
+@app.post("/drugs_for_diseases")
+async def get_drugs_for_selected_diseases(request: DiseasesDrugCandidatesRequest):
+    """Stream the top-k drugs of many diseases as NDJSON, one line per disease"""
+
+    state = serving_state
+    metrics = sorted(set(state.drug_ranking_tables) | set(state.drug_exact_db.metrics))
+    if request.metric not in metrics:
+        raise HTTPException(status_code=400, detail=f"Unsupported metric: {request.metric}. Choose from {metrics}")
+    if request.metric not in state.drug_exact_db.metrics and request.k > state.drug_ranking_tables[request.metric].top_n:
+        raise HTTPException(status_code=400, detail=f"k must be at most {state.drug_ranking_tables[request.metric].top_n} for metric {request.metric}")
+    if not 1 <= request.k <= len(state.drug_labels_by_index):
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {len(state.drug_labels_by_index)}")
+
+    disease_labels = request.disease_labels
+    if disease_labels is None:
+        disease_labels = sorted(state.map_indication_diffusion_labels_to_indices, key=state.map_indication_diffusion_labels_to_indices.get)
+
+    blocks = iter_drugs_for_diseases(state, disease_labels, request.k, request.metric)
+    try:
+        # Computed before the response starts, so a saturated pool still answers 503
+        first_block = await anext(blocks, "")
+    except PoolSaturated:
+        raise HTTPException(status_code=503, detail="Server busy, retry shortly", headers={"Retry-After": "1"})
+    return StreamingResponse(prepend(first_block, blocks), media_type="application/x-ndjson")
+
+def check_similarity_request(state, request, target_kind):
+    if request.drug_label not in state.map_drug_diffusion_labels_to_indices:
+        raise HTTPException(status_code=404, detail=f"Unknown drug label: {request.drug_label}")
+    if request.metric not in state.similarity_engine.metrics:
+        raise HTTPException(status_code=400, detail=f"Unsupported metric: {request.metric}. Choose from {state.similarity_engine.metrics}")
+    n_targets = len(state.labels_by_index_by_kind[target_kind]) - int(target_kind == 'drug')
+    if not 1 <= request.k <= n_targets:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {n_targets}")
+
+@app.post("/diseases_for_drug", response_model= List[Disease])
+async def get_diseases_for_selected_drug(request: DrugSimilarityRequest):
+    """Return the diseases whose diffusion profiles are closest to the selected drug"""
+    state = serving_state
+    check_similarity_request(state, request, 'indication')
+    return await run_in_pool(get_similar, state, 'drug', request.drug_label, 'indication', request.k, request.metric,
+                             key=(state.key, 'diseases_for_drug', request.drug_label, request.k, request.metric))
+
+@app.post("/similar_drugs", response_model= List[Drug])
+async def get_similar_drugs(request: DrugSimilarityRequest):
+    """Return the drugs whose diffusion profiles are closest to the selected drug, excluding itself"""
+    state = serving_state
+    check_similarity_request(state, request, 'drug')
+    return await run_in_pool(get_similar, state, 'drug', request.drug_label, 'drug', request.k, request.metric,
+                             key=(state.key, 'similar_drugs', request.drug_label, request.k, request.metric))
+
 
 #============================================================================
 # Visualise MOA network using vis.js
 #============================================================================
 
 
-def generate_MOA_nx_subgraph_adding_together_label(chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes):
-
-    chosen_indication_index = map_indication_diffusion_labels_to_indices[chosen_indication_label]
-    chosen_indication_diffusion_profile = indication_diffusion_profiles[chosen_indication_index]
+def get_MOA_ranked_node_ids(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes):
+    """
+    Top nodes of the drug and the indication diffusion profiles, interleaved by rank:
+    drug #1, indication #1, drug #2, ... Nodes in both lists appear twice.
+    """
+    with stage('label_lookup'):
+        chosen_indication_index = state.map_indication_diffusion_labels_to_indices[chosen_indication_label]
+        chosen_indication_diffusion_profile = state.indication_diffusion_profiles[chosen_indication_index]
 
-    chosen_drug_index = map_drug_diffusion_labels_to_indices[chosen_drug_label]
-    chosen_drug_diffusion_profile = drug_diffusion_profiles[chosen_drug_index]
+        chosen_drug_index = state.map_drug_diffusion_labels_to_indices[chosen_drug_label]
+        chosen_drug_diffusion_profile = state.drug_diffusion_profiles[chosen_drug_index]
 
     # Find top_k_nodes from diffusion profile
-    top_k_nodes_drug_subgraph = graph_manager.get_top_k_nodes(chosen_drug_diffusion_profile, num_drug_nodes)
-    top_k_nodes_indication_subgraph = graph_manager.get_top_k_nodes(chosen_indication_diffusion_profile, num_indication_nodes)
+    with stage('top_k'):
+        top_k_nodes_drug_subgraph = state.graph_manager.get_top_k_profile_nodes('drug', chosen_drug_index, chosen_drug_diffusion_profile, num_drug_nodes)
+        top_k_nodes_indication_subgraph = state.graph_manager.get_top_k_profile_nodes('indication', chosen_indication_index, chosen_indication_diffusion_profile, num_indication_nodes)
 
-    
-    #chosen_MOA_diffusion_profile = chosen_indication_diffusion_profile + chosen_drug_diffusion_profile
+        return interleave_by_rank(top_k_nodes_drug_subgraph, top_k_nodes_indication_subgraph)
 
-    # Find top_k_nodes from diffusion profile
-    #top_k_nodes_MOA_subgraph = graph_manager.get_top_k_nodes(chosen_MOA_diffusion_profile, num_nodes_subgraph)
-    top_k_nodes_MOA_subgraph = top_k_nodes_drug_subgraph + top_k_nodes_indication_subgraph
 
-    # Make subgraph
-    MOA_subgraph, MOA_subgraph_node_colors, MOA_subgraph_node_shapes = graph_manager.create_subgraph(top_k_nodes_MOA_subgraph)
+def interleave_by_rank(first_node_ids, second_node_ids):
+    # first #1, second #1, first #2, ...
+    ranks = np.concatenate([np.arange(len(first_node_ids)), np.arange(len(second_node_ids))])
+    return np.concatenate([first_node_ids, second_node_ids])[np.argsort(ranks, kind='stable')]
 
-    return MOA_subgraph, MOA_subgraph_node_colors, MOA_subgraph_node_shapes
 
+def generate_MOA_subgraph_adding_together_label(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes):
 
-def convert_networkx_to_vis_graph_data(graph, node_colors, node_shapes):
-    # Create a list of nodes and edges
-    nodes = [{"id": graph_manager.mapping_label_to_index[node_label], 
-              "label": f'{graph_manager.mapping_all_labels_to_names[node_label]}',
-              "color": node_colors[node_label],
-              "shape": node_shapes[node_label]
-             } 
-             for node_label in graph.nodes]
-    
-    #edges = [{"from": graph_manager.mapping_label_to_index[edge[0]], "to": graph_manager.mapping_label_to_index[edge[1]]} for edge in graph.edges]
+    #chosen_MOA_diffusion_profile = chosen_indication_diffusion_profile + chosen_drug_diffusion_profile
 
-    edges = [{"from": graph_manager.mapping_label_to_index[edge[0]], 
-              "to": graph_manager.mapping_label_to_index[edge[1]],
-              "arrows": "to"} for edge in graph.edges]
+    # Find top_k_nodes from diffusion profile
+    #top_k_nodes_MOA_subgraph = graph_manager.get_top_k_nodes(chosen_MOA_diffusion_profile, num_nodes_subgraph)
+    top_k_nodes_MOA_subgraph = get_MOA_ranked_node_ids(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+
+    # Induced subgraph; nodes in both top-k lists appear once
+    with stage('subgraph'):
+        return state.graph_manager.MSI.subgraph(top_k_nodes_MOA_subgraph)
+
+
+# Node positions of MOA subgraphs are cached per disease, drug and k. A layout that is not cached
+# starts from the cached one of the same pair with the nearest k, so moving a slider keeps the
+# nodes already on screen in place. layout_cache lives in this process: work on the pool returns
+# the layouts it computes, and they are put here.
+
+def previous_MOA_layout(key):
+    # Cached (node ids, positions) of the same pair with the nearest k, or None
+    _, _, _, num_drug_nodes, num_indication_nodes = key
+    nearby = [other for other in layout_cache.keys() if other[:3] == key[:3]]
+    nearest = min(nearby, key=lambda other: abs(other[3] - num_drug_nodes) + abs(other[4] - num_indication_nodes), default=None)
+    return layout_cache.get(nearest) if nearest is not None else None
+
+
+def lay_out_MOA_subgraph(MOA_subgraph, previous):
+    with stage('layout'):
+        return MOA_subgraph.node_ids, layout_subgraph(MOA_subgraph, previous)
+
+
+def lay_out_MOA_pair(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes, previous):
+    # On the pool; the subgraph is cheaper to build again there than to send
+    MOA_subgraph = generate_MOA_subgraph_adding_together_label(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+    return lay_out_MOA_subgraph(MOA_subgraph, previous)
+
+
+async def get_MOA_layout(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes):
+    """
+    Output:
+    - numpy array of float32 (n, 2): Pixel positions of the MOA subgraph's nodes, in node id order.
+    """
+    key = (state.key, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+    layout = layout_cache.get(key)
+    if layout is None:
+        layout = await run_in_pool(lay_out_MOA_pair, state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes,
+                                   previous_MOA_layout(key), key=('layout',) + key)
+        layout_cache.put(key, layout)
+    return layout[1]
+
+
+def iter_MOA_subgraph_chunks(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes, chunk_size=64, layout=False):
+    """
+    The MOA subgraph in diffusion rank order, as vis.js chunks: the highest ranked nodes first,
+    each chunk with the edges that close against nodes already sent. With layout, the last chunk
+    also holds the positions of every node, laid out once the whole subgraph is known.
+    """
+    graph_manager = state.graph_manager
+    ranked_node_ids = get_MOA_ranked_node_ids(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+    n_nodes = n_edges = 0
+    chunks = graph_manager.MSI.iter_induced_subgraph_chunks(ranked_node_ids, chunk_size, graph_manager.MSI_transpose)
+    while True:
+        # Each chunk's subgraph is built as it is requested
+        with stage('subgraph'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        node_ids, sources, targets = chunk
+        n_nodes += len(node_ids)
+        n_edges += len(sources)
+        with stage('vis_conversion'):
+            vis_chunk = vis_graph_chunk(graph_manager.MSI, node_ids, sources, targets)
+        yield vis_chunk
+
+    done = {"done": True, "n_nodes": n_nodes, "n_edges": n_edges}
+    if layout:
+        # The response iterates this in a thread of this process, so it uses layout_cache directly
+        key = (state.key, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+        cached = layout_cache.get(key)
+        if cached is None:
+            with stage('subgraph'):
+                MOA_subgraph = graph_manager.MSI.subgraph(ranked_node_ids)
+            cached = lay_out_MOA_subgraph(MOA_subgraph, previous_MOA_layout(key))
+            layout_cache.put(key, cached)
+        node_ids, positions = cached
+        done["positions"] = {"id": node_ids.tolist(), **position_columns(positions)}
+    yield done
+
+
+def convert_vis_graph_columns_to_vis_graph_data(columns):
+    # One object per node and edge, the format vis.DataSet takes
+    nodes = [{"id": node_id, "label": label, "color": color, "shape": shape}
+             for node_id, label, color, shape in zip(columns["id"], columns["label"], columns["color"], columns["shape"])]
+    if "x" in columns:
+        for node, x, y in zip(nodes, columns["x"], columns["y"]):
+            node["x"], node["y"] = x, y
+    edges = [{"from": source, "to": target, "arrows": "to"} for source, target in zip(columns["from"], columns["to"])]
 
     # Return the graph data
     return {"nodes": nodes, "edges": edges}
 
+def encode_MOA_graph(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes, graph_format, positions=None):
+    """
+    The MOA subgraph encoded for a /graph response, with the node positions if given (see get_MOA_layout).
+
+    Output:
+    - bytes: The response body.
+    - str: Its media type.
+    """
+    # Generate MOA graph data
+    MOA_subgraph = generate_MOA_subgraph_adding_together_label(state, chosen_indication_label, chosen_drug_label, num_drug_nodes, num_indication_nodes)
+
+    if graph_format == GRAPH_BINARY:
+        with stage('serialization'):
+            return encode_graph_binary(MOA_subgraph, positions), GRAPH_BINARY
+    if graph_format == GRAPH_COLUMNAR_JSON:
+        with stage('serialization'):
+            return encode_graph_columnar_json(MOA_subgraph, positions), GRAPH_COLUMNAR_JSON
+
+    # Convert graph data into a format that vis.js can handle
+    with stage('vis_conversion'):
+        graph_data = convert_vis_graph_columns_to_vis_graph_data(vis_graph_columns(MOA_subgraph, positions))
+
+    # Rendered as JSONResponse does; the content is plain lists and dicts, so it does not need
+    # FastAPI's jsonable_encoder
+    with stage('serialization'):
+        return json.dumps({"MOA_network": graph_data}, ensure_ascii=False, separators=(",", ":")).encode(), GRAPH_JSON
+
+# Paths of one /graph request in paths mode
+MAX_PATHS = 50
+
+
+def find_MOA_paths(state, chosen_indication_label, chosen_drug_label, num_paths):
+    """
+    Best drug -> disease paths through proteins and biological functions, scored by the edge
+    weights and by the diffusion mass of both profiles on their nodes. Run on the pool, cached
+    per pair in paths_cache by the caller (see get_graph_data).
+
+    Output:
+    - list of (list of int, float): MSI node ids of each path and its score, best first.
+    """
+    with stage('label_lookup'):
+        source = state.graph_manager.mapping_label_to_index[chosen_drug_label]
+        target = state.graph_manager.mapping_label_to_index[chosen_indication_label]
+        mass = np.asarray(state.drug_diffusion_profiles[state.map_drug_diffusion_labels_to_indices[chosen_drug_label]], dtype=np.float64) \
+            + state.indication_diffusion_profiles[state.map_indication_diffusion_labels_to_indices[chosen_indication_label]]
+    with stage('paths'):
+        return state.path_finder.find_paths(source, target, mass, num_paths)
+
+
+def encode_MOA_paths(state, paths, layout=False):
+    """
+    The /graph response in paths mode: the subgraph induced by the nodes of the best paths
+    (see find_MOA_paths), in the default JSON format, and
+    "paths": [{"nodes": [...], "labels": [...], "score": ...}, ...].
+    """
+    with stage('subgraph'):
+        node_ids = np.array([node_id for path, _ in paths for node_id in path], dtype=np.int64)
+        MOA_subgraph = state.graph_manager.MSI.subgraph(node_ids)
+    positions = None
+    if layout and MOA_subgraph.n_nodes:
+        with stage('layout'):
+            positions = layout_subgraph(MOA_subgraph)
+
+    with stage('vis_conversion'):
+        graph_data = convert_vis_graph_columns_to_vis_graph_data(vis_graph_columns(MOA_subgraph, positions))
+        path_data = [{"nodes": path, "labels": state.graph_manager.node_labels[path].tolist(), "score": score} for path, score in paths]
+    with stage('serialization'):
+        return json.dumps({"MOA_network": graph_data, "paths": path_data}, ensure_ascii=False, separators=(",", ":")).encode(), GRAPH_JSON
+
+def check_MOA_k(state, k1, k2):
+    n_nodes = state.graph_manager.MSI_size_graph
+    if not (1 <= k1 <= n_nodes and 1 <= k2 <= n_nodes):
+        raise HTTPException(status_code=400, detail=f"k1 and k2 must be between 1 and {n_nodes}")
+
 @app.post("/graph", response_class=JSONResponse)
-async def get_graph_data(request: GraphRequest):
+async def get_graph_data(request: GraphRequest, accept: Optional[str] = Header(None)):
+    """
+    MOA subgraph of a disease / drug pair. The Accept header selects the format (see graph_encoding.py):
+    object-per-element JSON by default, or GRAPH_COLUMNAR_JSON / GRAPH_BINARY. With layout, the
+    nodes come with x, y positions (see layout.py).
+
+    With paths, k1 and k2 are ignored: the response is the connected explanation subgraph of
+    the best drug -> disease paths, with their scores, always as JSON (see encode_MOA_paths).
+    """
     # Extract parameters from request
+    state = serving_state
     disease_label = request.disease_label
     drug_label = request.drug_label
     k1 = request.k1
     k2 = request.k2
 
-    print(f'disease_label: {disease_label}')
-    print(f'drug_label: {drug_label}')
-    print(f'k1: {k1}')
-    print(f'k2: {k2}')
+    record_k(k1, k2)
+    logger.debug('graph disease_label=%s drug_label=%s k1=%d k2=%d', disease_label, drug_label, k1, k2)
+
+    if disease_label not in state.map_indication_diffusion_labels_to_indices or drug_label not in state.map_drug_diffusion_labels_to_indices:
+        raise HTTPException(status_code=404, detail="Unknown disease or drug label")
+    if request.paths:
+        if not 1 <= request.paths <= MAX_PATHS:
+            raise HTTPException(status_code=400, detail=f"paths must be between 1 and {MAX_PATHS}")
+        # Paths are cached apart from their encoding, so toggling layout does not search again
+        paths = await cached_run_in_pool(state, paths_cache, find_MOA_paths, disease_label, drug_label, request.paths,
+                                         key=('mechanism_paths', disease_label, drug_label, request.paths))
+        content, media_type = await cached_run_in_pool(state, graph_cache, encode_MOA_paths, paths, request.layout,
+                                                       key=('paths', disease_label, drug_label, request.paths, request.layout))
+        return Response(content=content, media_type=media_type)
+
+    check_MOA_k(state, k1, k2)
+
+    # A burst of identical slider events is computed once, and revisited subgraphs come from the cache
+    graph_format = negotiate_graph_format(accept)
+    positions = await get_MOA_layout(state, disease_label, drug_label, k2, k1) if request.layout else None
+    content, media_type = await cached_run_in_pool(state, graph_cache, encode_MOA_graph, disease_label, drug_label, k2, k1, graph_format, positions,
+                                                   key=('graph', disease_label, drug_label, k1, k2, graph_format, request.layout))
+    return Response(content=content, media_type=media_type, headers={"Vary": "Accept"})
+
+
+@app.post("/graph_stream")
+async def stream_graph_data(request: GraphStreamRequest, accept: Optional[str] = Header(None)):
+    """
+    Stream the MOA subgraph in diffusion rank order, so the first nodes can be drawn before the
+    whole subgraph is built. Each chunk is {"nodes": [...], "edges": [...]} in the default /graph
+    element format; the last one is {"done": true, "n_nodes": ..., "n_edges": ...}, with layout
+    also "positions": {"id": [...], "x": [...], "y": [...]}.
+    NDJSON by default, server-sent events if the client accepts text/event-stream.
+    """
+    state = serving_state
+    if request.disease_label not in state.map_indication_diffusion_labels_to_indices or request.drug_label not in state.map_drug_diffusion_labels_to_indices:
+        raise HTTPException(status_code=404, detail="Unknown disease or drug label")
+    check_MOA_k(state, request.k1, request.k2)
+    if request.chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be positive")
+
+    record_k(request.k1, request.k2)
+    chunks = iter_MOA_subgraph_chunks(state, request.disease_label, request.drug_label, num_drug_nodes=request.k2, num_indication_nodes=request.k1, chunk_size=request.chunk_size, layout=request.layout)
+    if accept and 'text/event-stream' in accept:
+        return StreamingResponse((f"data: {json.dumps(chunk)}\n\n" for chunk in chunks), media_type="text/event-stream")
+    return StreamingResponse((json.dumps(chunk) + "\n" for chunk in chunks), media_type="application/x-ndjson")
 
-    # Generate MOA graph data
-    MOA_subgraph, MOA_subgraph_node_colors, MOA_subgraph_node_shapes = generate_MOA_nx_subgraph_adding_together_label(chosen_indication_label=disease_label, chosen_drug_label=drug_label, num_drug_nodes=k2, num_indication_nodes=k1)
 
-    # Convert graph data into a format that vis.js can handle
-    graph_data = convert_networkx_to_vis_graph_data(graph=MOA_subgraph, node_colors=MOA_subgraph_node_colors, node_shapes=MOA_subgraph_node_shapes)
+#============================================================================
+# Ad-hoc diffusion of user-supplied seed sets
+#============================================================================
 
-    # Create the response
-    response = {
-        "MOA_network": graph_data,
-    }
+# Seeds of one /profile request
+MAX_PROFILE_SEEDS = 1000
+
+
+def encode_seed_profile_results(state, seed_ids, k, distance_metric, num_nodes, chosen_indication_label=None, profile=None):
+    """
+    Drugs and indications closest to the diffusion profile of a seed set, e.g. the targets of a
+    hypothetical compound or the drugs of a combination therapy, and the top nodes of that profile.
+
+    Input:
+    - seed_ids (list of int): MSI node ids of the seeds.
+    - chosen_indication_label (str): If given, also the MOA network between the seeds and this
+      indication, built as /graph builds it for a drug.
+    - profile (numpy array): The profile of the seeds, if the caller found it in profile_cache.
+
+    Output:
+    - bytes: The /profile response body.
+    - dict: Profiles solved for the request, by profile_cache key. Worker processes only have a
+      copy of the cache, so the caller puts them.
+    """
+    graph_manager = state.graph_manager
+    solved = {}
+    if profile is None:
+        with stage('diffusion'):
+            profile = state.profile_solver.profile(seed_ids, solved)
+
+    results = {}
+    with stage('ann_query'):
+        for target_kind, field in [('drug', 'drugs'), ('indication', 'indications')]:
+            indices, distances = state.similarity_engine.nearest_to_profile(profile, target_kind, min(k, len(state.labels_by_index_by_kind[target_kind])), distance_metric)
+            results[field] = [{"value": state.labels_by_index_by_kind[target_kind][index], "name": state.names_by_index_by_kind[target_kind][index], "distance": float(distance)}
+                              for index, distance in zip(indices.tolist(), distances.tolist())]
+
+    with stage('top_k'):
+        top_node_ids = graph_manager.get_top_k_nodes(profile, num_nodes)
+    results["top_nodes"] = [{"id": node_id, "label": str(graph_manager.node_labels[node_id]), "name": str(graph_manager.node_names[node_id]), "score": float(profile[node_id])}
+                            for node_id in top_node_ids.tolist()]
+
+    if chosen_indication_label is not None:
+        with stage('top_k'):
+            chosen_indication_index = state.map_indication_diffusion_labels_to_indices[chosen_indication_label]
+            top_k_nodes_indication_subgraph = graph_manager.get_top_k_profile_nodes('indication', chosen_indication_index, state.indication_diffusion_profiles[chosen_indication_index], num_nodes)
+        with stage('subgraph'):
+            MOA_subgraph = graph_manager.MSI.subgraph(interleave_by_rank(top_node_ids, top_k_nodes_indication_subgraph))
+        with stage('vis_conversion'):
+            results["MOA_network"] = convert_vis_graph_columns_to_vis_graph_data(vis_graph_columns(MOA_subgraph))
+
+    with stage('serialization'):
+        return json.dumps(results, ensure_ascii=False, separators=(",", ":")).encode(), solved
+
+@app.post("/profile")
+async def get_seed_profile(request: ProfileRequest):
+    """
+    Diffusion profile of a set of seed nodes computed online, and the drugs, indications and
+    nodes it ranks highest: {"drugs": [...], "indications": [...], "top_nodes": [...]}, plus
+    "MOA_network" in the /graph format when disease_label is given
+    """
+    state = serving_state
+    graph_manager = state.graph_manager
+    if not 1 <= len(request.seeds) <= MAX_PROFILE_SEEDS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {MAX_PROFILE_SEEDS} seeds are required")
+    unknown_seeds = [label for label in request.seeds if label not in graph_manager.mapping_label_to_index]
+    if unknown_seeds:
+        raise HTTPException(status_code=404, detail=f"Unknown seed labels: {unknown_seeds[:10]}")
+    if request.disease_label is not None and request.disease_label not in state.map_indication_diffusion_labels_to_indices:
+        raise HTTPException(status_code=404, detail=f"Unknown disease label: {request.disease_label}")
+    if request.metric not in state.similarity_engine.metrics:
+        raise HTTPException(status_code=400, detail=f"Unsupported metric: {request.metric}. Choose from {state.similarity_engine.metrics}")
+    if request.k < 1:
+        raise HTTPException(status_code=400, detail="k must be positive")
+    if not 1 <= request.num_nodes <= graph_manager.MSI_size_graph:
+        raise HTTPException(status_code=400, detail=f"num_nodes must be between 1 and {graph_manager.MSI_size_graph}")
+
+    record_k(request.num_nodes)
+    seed_ids = sorted({graph_manager.mapping_label_to_index[label] for label in request.seeds})
+    profile = profile_cache.get(state.profile_solver.cache_key(seed_ids))
+    content, solved = await run_in_pool(encode_seed_profile_results, state, seed_ids, request.k, request.metric, request.num_nodes, request.disease_label, profile,
+                                        key=(state.key, 'profile', tuple(seed_ids), request.k, request.metric, request.num_nodes, request.disease_label))
+    for key, solved_profile in solved.items():
+        profile_cache.put(key, solved_profile)
+    return Response(content=content, media_type="application/json")
 
-    return response
 
+#============================================================================
+# Monitoring
+#============================================================================
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latency histograms, request counts and startup phases of all workers, in the Prometheus text format"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+#============================================================================
+# Switching snapshots while serving
+#============================================================================
 
+# Seconds between checks of <MSI_SNAPSHOT_ROOT>/CURRENT; 0 never switches
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('MSI_SNAPSHOT_POLL', 5))
+
+def load_serving_state(path):
+    with startup_phase('snapshot_switch'):
+        return ServingState(Snapshot(path))
+
+async def watch_current_snapshot():
+    failed_key = None
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        key = read_current_key(snapshot_root)
+        if key is None or key == serving_state.key or key == failed_key:
+            continue
+        try:
+            # Mapping a snapshot and building its lookups, solver and payloads all happen off the
+            # event loop; requests see either the old state or the new one, never a mix
+            new_state = await asyncio.to_thread(load_serving_state, os.path.join(snapshot_root, key))
+        except Exception:
+            logger.exception('snapshot switch failed key=%s', key)
+            failed_key = key
+            continue
+        activate_snapshot(new_state)
+        # Process workers forked from the old state are replaced once their calls finish
+        execution_pool.recycle()
+        logger.info('snapshot switched key=%s', key)
+
+@app.on_event("startup")
+async def start_snapshot_watcher():
+    if SNAPSHOT_POLL_SECONDS > 0:
+        app.state.snapshot_watcher = asyncio.create_task(watch_current_snapshot())
+
+@app.on_event("shutdown")
+def shutdown():
+    execution_pool.shutdown()
+    # Keep the last requests of this worker in the aggregated metrics
+    REGISTRY.flush(force=True)
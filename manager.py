@@ -1,73 +1,69 @@
 
-import pandas as pd
 import numpy as np
-import networkx as nx
-import matplotlib.pyplot as plt
+
+from graph_core import CSRGraph, NODE_TYPES, NODE_TYPE_CODES
+from ingestion import EDGE_TYPES, EDGE_TYPE_CODES, load_msi_tables
+from layout import force_layout
+from vector_database import top_k_smallest
+
+
+# Color and vis.js shape of each node type
+NODE_STYLES = {
+    'protein': ('#7F8C8D ', 'ellipse'),  # dark grey, circle for proteins
+    'bio': ('#2ECC71', 'box'),  # green, square for biological functions
+    'drug': ('#439AD9', 'triangle'),  # blue, #03A9F4, triangle for drugs
+    'indication': ('#DD614A', 'triangleDown'),  # red, #F44336, #DD614A, triangle for indications
+}
+
+# The same styles as lookup tables indexed by node type code
+NODE_COLORS = np.array([NODE_STYLES[node_type][0] for node_type in NODE_TYPES])
+NODE_SHAPES = np.array([NODE_STYLES[node_type][1] for node_type in NODE_TYPES])
 
 
 class GraphManager:
-    def __init__(self, data_path):
+    def __init__(self, data_path=None, tables=None, MSI=None):
+        """
+        Either pass data_path to build everything from the edge files, or pass the prebuilt
+        tables (and optionally the MSI graph) loaded from a snapshot (see snapshot.py).
+        """
 
         #=====================
         # Load and transform data
         #=====================
-        self.drug_to_protein, self.indication_to_protein, self.protein_to_protein, self.protein_to_bio, self.bio_to_bio = self.load_data(data_path)
+        # All edge files are read in columnar form and every node label is interned once to a
+        # dense integer id. The ids index the CSR arrays of the graph and the columns of the
+        # diffusion profiles.
+        self.tables = tables if tables is not None else self.load_data(data_path)
+
+        self.node_labels = self.tables.labels
+        self.node_names = self.tables.names
+        self.node_types = self.tables.node_types
+        self.mapping_label_to_index = {label: index for index, label in enumerate(self.node_labels.tolist())}
 
         #=====================
         # Label Graph
         #=====================
         # Create the self.MSI graph
-        self.MSI = self.create_MSI_graph()
+        self.MSI = MSI if MSI is not None else self.create_MSI_graph()
 
-        self.MSI_node_labels = np.array(self.MSI.nodes()).tolist()
-        self.MSI_size_graph = len(self.MSI_node_labels)
+        self.MSI_node_labels = self.MSI.labels
+        self.MSI_size_graph = self.MSI.n_nodes
+        # Reversed edges, so in-edges of a node are a CSR row (used when streaming subgraphs)
+        self.MSI_transpose = self.MSI.transpose()
+
+        # Optional precomputed top-N nodes per drug / indication profile (ranking.TopNTable),
+        # attached by snapshot.py; see get_top_k_profile_nodes
+        self.node_rank_tables = {}
 
         # Create node mappings and sort names
         self.create_node_dictionaries_and_sort_names()
 
-        
-        #=====================
-        # Index Graph
-        #=====================
-        # Create an MSI graph where nodes are numbered, rather than labelled.
-        # This is necessary for the walker library to perform random walks and make a diffusion profile.
-
-        # Create a mapping from the old labels to new labels
-        self.mapping_original_to_index = {node: i for i, node in enumerate(self.MSI.nodes)}
-        self.mapping_index_to_original = {v: k for k, v in self.mapping_original_to_index.items()}
-        
-        self.H = self.create_relabelled_graph(self.MSI, self.mapping_original_to_index)
-
-        self.H_node_labels = np.array(self.H.nodes()).tolist()
-        self.H_size_graph = len(self.H_node_labels)
-
-        #=====================
-        # Names Graph
-        #=====================
-        # Create an MSI graph where nodes are full names, rather than labelled.
-        # This is necessary for displaying the graph in an interpretable way
-
-        # Create a mapping from the old labels to new labels
-        self.mapping_all_labels_to_names = self.create_label_to_name_dictionaries()
-        #self.mapping_all_names_to_labels = {v: k for k, v in self.mapping_all_labels_to_names.items()}
-        
-        #self.MSI_names = self.create_relabelled_graph(self.MSI, self.mapping_all_labels_to_names)
-
-        #self.MSI_node_names = np.array(self.MSI_names.nodes()).tolist()
-        #self.MSI_size_graph = len(self.MSI_node_names)
-
         #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
         # Build MSI Graph
-        #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+        #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 
     def load_data(self, data_path):
-        drug_to_protein = pd.read_csv(data_path + '1_drug_to_protein.tsv', sep='\t')
-        indication_to_protein = pd.read_csv(data_path + '2_indication_to_protein.tsv', sep='\t')
-        protein_to_protein = pd.read_csv(data_path + '3_protein_to_protein.tsv', sep='\t')
-        protein_to_bio = pd.read_csv(data_path + '4_protein_to_biological_function.tsv', sep='\t')
-        bio_to_bio = pd.read_csv(data_path + '5_biological_function_to_biological_function.tsv', sep='\t')
-        
-        return drug_to_protein, indication_to_protein, protein_to_protein, protein_to_bio, bio_to_bio
+        return load_msi_tables(data_path)
 
     def create_MSI_graph(self):
         """
@@ -83,140 +79,124 @@ class GraphManager:
         """
         
         
-        MSI = nx.DiGraph()
-        self.node_types = {}
-        self.add_nodes_to_graph(self.drug_to_protein, 'drug', 'protein', 3.2, MSI)
-        self.add_nodes_to_graph(self.indication_to_protein, 'indication', 'protein', 3.5, MSI)
-        self.add_nodes_to_graph(self.protein_to_protein, 'protein', 'protein', 4.4, MSI)
-        self.add_nodes_to_graph(self.protein_to_bio, 'protein', 'bio', 4.5, MSI)
-        self.add_nodes_to_graph(self.bio_to_bio, 'bio', 'bio', 6.5, MSI)
-        return MSI
+        edge_weights = {
+            'drug_to_protein': 3.2,
+            'indication_to_protein': 3.5,
+            'protein_to_protein': 4.4,
+            'protein_to_bio': 4.5,
+            'bio_to_bio': 6.5,
+        }
+        return self.create_graph_from_edges(edge_weights)
     
     def create_H_graph(self):
-        'The optimal weights for the multiscale interactome are '
-        'wdrug = 3.21, wdisease = 3.54, wprotein = 4.40,'
-        ' whigher-level biological function = 2.10, wlower-level biological function = 4.49, wbiological function = 6.58'
-        'α = 0.860'
-        'use the correlation distance to compare r(c) and r(d) (Fig. 2b, c).'
-        
-        
-        H = nx.DiGraph()
-        self.node_types = {}
-        self.add_nodes_to_graph(self.drug_to_protein, 'drug', 'protein', 3.2, H)
-        self.add_nodes_to_graph(self.indication_to_protein, 'indication', 'protein', 3.5, H)
-        self.add_bidirectional_nodes_to_graph(self.protein_to_protein, 'protein', 'protein', 4.4, H)
-        self.add_bidirectional_nodes_to_graph(self.protein_to_bio, 'protein', 'bio', 4.5, H)
-        self.add_bidirectional_nodes_to_graph(self.bio_to_bio, 'bio', 'bio', 6, H)
-        return H
-
-    def add_nodes_to_graph(self, data_frame, node_type_1, node_type_2, weight, MSI):
-        #for i in range(len(data_frame)):
-        for i, (node_1, node_2) in enumerate(zip(data_frame['node_1'], data_frame['node_2'])):
-            node_1 = data_frame['node_1'].iloc[i]
-            node_2 = data_frame['node_2'].iloc[i]
-            MSI.add_edge(node_1, node_2, weight= weight)
-            self.node_types[node_1] = node_type_1
-            self.node_types[node_2] = node_type_2
-
-    def add_bidirectional_nodes_to_graph(self, data_frame, node_type_1, node_type_2, weight, MSI):
-        #for i in range(len(data_frame)):
-        for i, (node_1, node_2) in enumerate(zip(data_frame['node_1'], data_frame['node_2'])):
-            node_1 = data_frame['node_1'].iloc[i]
-            node_2 = data_frame['node_2'].iloc[i]
-            MSI.add_edge(node_1, node_2, weight= weight)
-            MSI.add_edge(node_2, node_1, weight= weight)
-            self.node_types[node_1] = node_type_1
-            self.node_types[node_2] = node_type_2
+        """
+        Weighted graph the diffusion profiles are computed on (see diffusion.py).
+        Protein and biological function edges can be walked in both directions, and edge weights
+        follow the optimal multiscale interactome weights listed in create_MSI_graph:
+        going up the GO hierarchy uses whigher-level, going down uses wlower-level.
+        Node ids are shared with self.MSI.
+        """
+        edge_weights = {
+            'drug_to_protein': 3.21,
+            'indication_to_protein': 3.54,
+            'protein_to_protein': 4.40,
+            'protein_to_bio': 6.58,
+            'bio_to_bio': 2.10,
+        }
+        reverse_edge_weights = {
+            'protein_to_protein': 4.40,
+            'protein_to_bio': 4.40,
+            'bio_to_bio': 4.49,
+        }
+        return self.create_graph_from_edges(edge_weights, reverse_edge_weights)
+
+    def create_graph_from_edges(self, edge_weights, reverse_edge_weights=None):
+        """
+        Build a CSRGraph over the interned node ids.
+
+        Input:
+        - edge_weights (dict): Edge type (see ingestion.EDGE_TYPES) -> weight of its edges.
+        - reverse_edge_weights (dict): Edge type -> weight of the added reverse edges,
+          for the edge types that can be walked in both directions.
+
+        Output:
+        - CSRGraph
+        """
+        reverse_edge_weights = reverse_edge_weights or {}
+        edge_types = self.tables.edge_types
+        forward_weights = np.array([edge_weights[edge_type] for edge_type in EDGE_TYPES], dtype=np.float32)[edge_types]
+
+        reverse_codes = [EDGE_TYPE_CODES[edge_type] for edge_type in reverse_edge_weights]
+        reverse = np.isin(edge_types, reverse_codes)
+        reverse_lookup = np.zeros(len(EDGE_TYPES), dtype=np.float32)
+        reverse_lookup[reverse_codes] = list(reverse_edge_weights.values())
+
+        sources = np.concatenate([self.tables.edge_sources, self.tables.edge_targets[reverse]])
+        targets = np.concatenate([self.tables.edge_targets, self.tables.edge_sources[reverse]])
+        weights = np.concatenate([forward_weights, reverse_lookup[edge_types[reverse]]])
+
+        return CSRGraph.from_edges(sources, targets, weights, self.node_types, self.node_labels, self.node_names)
 
         #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
         # Create Dictionaries and Mappings
         #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 
-    def test_node_order_preservation(self, num_walks, walk_length, alpha, starting_nodes):
+    def create_diffusion_profile(self, starting_nodes, alpha=0.86, tol=1e-6, max_iter=200):
+        """
+        Compute the random walk with restart diffusion profile of a set of starting nodes.
+
+        Input:
+        - starting_nodes (list of str): Labels of the nodes the walker restarts at.
+        - alpha (float): Probability of following an edge rather than restarting.
+
+        Output:
+        - numpy array: Diffusion value of every node, indexed by node id.
+        """
+        from diffusion import DiffusionEngine, create_transition_matrix
+
+        transition_matrix = create_transition_matrix(self.create_H_graph())
+        engine = DiffusionEngine(transition_matrix, alpha=alpha, tol=tol, max_iter=max_iter)
+        seed = [self.mapping_label_to_index[label] for label in starting_nodes]
+        return engine.compute_profiles([seed])[0]
+
+    def test_node_order_preservation(self, alpha, starting_nodes):
         # Save the node labels before creating the diffusion profile
-        original_node_labels = self.H_node_labels.copy()
+        original_node_labels = self.MSI_node_labels.copy()
 
         # Create the diffusion profile
-        self.create_diffusion_profile(num_walks, walk_length, alpha, starting_nodes)
+        self.create_diffusion_profile(starting_nodes, alpha)
 
         # Check if the node labels after creating the diffusion profile are the same as before
-        assert (original_node_labels == self.H_node_labels), "The node order was changed during the creation of the diffusion profile."
+        assert (original_node_labels == self.MSI_node_labels).all(), "The node order was changed during the creation of the diffusion profile."
 
         print("Test passed. The node order was preserved during the creation of the diffusion profile.")
 
 
     def create_node_dictionaries_and_sort_names(self):
-        mapping_label_to_name, mapping_name_to_label, self.mapping_label_to_index, self.mapping_index_to_label, names_sorted = self.create_node_dictionaries(self.drug_to_protein, self.indication_to_protein)
+        mapping_label_to_name, mapping_name_to_label, names_sorted = self.create_node_dictionaries()
 
         # Unpack
         self.mapping_drug_label_to_name, self.mapping_indication_label_to_name = mapping_label_to_name 
         self.mapping_drug_name_to_label, self.mapping_indication_name_to_label = mapping_name_to_label
         self.drug_names_sorted, self.indication_names_sorted = names_sorted
 
-    def create_node_dictionaries(self, drug_to_protein, indication_to_protein):
-        # Get unique combinations of node_1 and node_1_name
-        unique_drug_label_and_name = drug_to_protein[['node_1', 'node_1_name']].drop_duplicates()
-        unique_indication_label_and_name = indication_to_protein[['node_1', 'node_1_name']].drop_duplicates()
+    def create_node_dictionaries(self):
+        mapping_label_to_name = []
+        mapping_name_to_label = []
+        names_sorted = []
 
-        # Convert to dictionaries
-        mapping_drug_label_to_name = unique_drug_label_and_name.set_index('node_1')['node_1_name'].to_dict()
-        mapping_indication_label_to_name = unique_indication_label_and_name.set_index('node_1')['node_1_name'].to_dict()
+        # Read the drug and indication entries straight out of the label and name tables
+        for node_type in ['drug', 'indication']:
+            mask = self.node_types == NODE_TYPE_CODES[node_type]
+            labels = self.node_labels[mask].tolist()
+            names = self.node_names[mask].tolist()
 
-        # Make flipped dictionaries
-        mapping_drug_name_to_label = {v: k for k, v in mapping_drug_label_to_name.items()}
-        mapping_indication_name_to_label = {v: k for k, v in mapping_indication_label_to_name.items()}
+            mapping_label_to_name.append(dict(zip(labels, names)))
+            mapping_name_to_label.append(dict(zip(names, labels)))
+            # Get all unique names sorted alphabetically
+            names_sorted.append(sorted(set(names)))
 
-        # Create dictionary mapping old label to new labels
-        mapping_label_to_index = {old_label:new_label for new_label, old_label in enumerate(self.MSI.nodes())}
-        mapping_index_to_label = {v: k for k, v in mapping_label_to_index.items()}
-
-        # Get all unique drug names sorted alphabetically
-        drug_names_sorted = sorted(unique_drug_label_and_name.astype(str)['node_1_name'].unique())
-        indication_names_sorted = sorted(unique_indication_label_and_name.astype(str)['node_1_name'].unique())
-
-        mapping_label_to_name = [mapping_drug_label_to_name, mapping_indication_label_to_name]
-        mapping_name_to_label = [mapping_drug_name_to_label, mapping_indication_name_to_label]
-        
-        names_sorted = [drug_names_sorted, indication_names_sorted]
-
-        return mapping_label_to_name, mapping_name_to_label, mapping_label_to_index, mapping_index_to_label, names_sorted
-
-    def create_label_to_name_dictionaries(self):
-        combined_dict_all_labels_to_names = {}
-
-        # Get unique combinations of node_1 and node_1_name
-        unique_drug_label_and_name = self.drug_to_protein[['node_1', 'node_1_name']].drop_duplicates()
-        unique_indication_label_and_name = self.indication_to_protein[['node_1', 'node_1_name']].drop_duplicates()
-        unique_protein_label_and_name_1 = self.protein_to_protein[['node_1', 'node_1_name']].drop_duplicates()
-        unique_protein_label_and_name_2 = self.protein_to_protein[['node_2', 'node_2_name']].drop_duplicates()
-        unique_bio_label_and_name_1 = self.bio_to_bio[['node_1', 'node_1_name']].drop_duplicates()
-        unique_bio_label_and_name_2 = self.bio_to_bio[['node_2', 'node_2_name']].drop_duplicates()
-
-        # Convert to dictionaries
-        mapping_drug_label_to_name = unique_drug_label_and_name.set_index('node_1')['node_1_name'].to_dict()
-        mapping_indication_label_to_name = unique_indication_label_and_name.set_index('node_1')['node_1_name'].to_dict()
-        mapping_protein_label_to_name_1 = unique_protein_label_and_name_1.set_index('node_1')['node_1_name'].to_dict()
-        mapping_protein_label_to_name_2 = unique_protein_label_and_name_2.set_index('node_2')['node_2_name'].to_dict()
-        mapping_bio_label_to_name_1 = unique_bio_label_and_name_1.set_index('node_1')['node_1_name'].to_dict()
-        mapping_bio_label_to_name_2 = unique_bio_label_and_name_2.set_index('node_2')['node_2_name'].to_dict()
-
-        # Combining dictionaries
-        combined_dict_all_labels_to_names.update(mapping_drug_label_to_name)
-        combined_dict_all_labels_to_names.update(mapping_indication_label_to_name)
-        combined_dict_all_labels_to_names.update(mapping_protein_label_to_name_1)
-        combined_dict_all_labels_to_names.update(mapping_protein_label_to_name_2)
-        combined_dict_all_labels_to_names.update(mapping_bio_label_to_name_1)
-        combined_dict_all_labels_to_names.update(mapping_bio_label_to_name_2)
-
-        return combined_dict_all_labels_to_names
-
-    def create_relabelled_graph(self, MSI, mapping):
-        H = nx.DiGraph()
-        H.add_nodes_from(mapping[node] for node in MSI.nodes)
-        H.add_edges_from((mapping[u], mapping[v]) for u, v in MSI.edges)
-
-        #H = nx.relabel_nodes(MSI, mapping)
-        return H
+        return mapping_label_to_name, mapping_name_to_label, names_sorted
 
         #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
         # Subgraph
@@ -227,110 +207,110 @@ class GraphManager:
         Get the top k nodes from a diffusion profile.
         Input: 
         - diffusion_profile (numpy array): The diffusion values for each node in the graph.
-        The array index corresponds to the node index in the graph.
+        The array index corresponds to the node id in the graph.
         - k (int): The number of nodes to return.
         
         Output: 
-        - list of str: The labels of the top k nodes.
+        - numpy array of int: The ids of the top k nodes, highest diffusion value first and equal
+          values by node id, the order of the node rank tables (ranking.build_node_rank_table).
         """
         # Check if inputs are valid
         assert isinstance(diffusion_profile, np.ndarray), "diffusion_profile must be a numpy array"
         assert isinstance(k, int), "k must be an integer"
         assert k <= len(diffusion_profile), "k cannot be greater than the number of nodes in the graph"
         
-        # Get the indices of the top k nodes
-        top_k_indices = np.argsort(diffusion_profile)[-k:]
-        
-        #print(f'Top-K indices: {top_k_indices}')
-        #for index in top_k_indices:
-        #    print(f'Index: {index}, val: {diffusion_profile[index]}')
+        # Partition out the top k nodes, then sort only those
+        return top_k_smallest(-np.asarray(diffusion_profile, dtype=np.float32)[np.newaxis], k)[0][0]
 
-        # Convert indices to labels
-        top_k_labels = [self.mapping_index_to_label[i] for i in top_k_indices]
-        
-        return top_k_labels
+    def get_top_k_profile_nodes(self, kind, row, diffusion_profile, k):
+        """
+        Top k nodes of a stored drug or indication profile.
 
-    def create_subgraph(self, top_k_node_labels):
+        Input:
+        - kind (str): 'drug' or 'indication'.
+        - row (int): Row of the profile in its diffusion profile matrix.
+        - diffusion_profile (numpy array): That profile, used when k exceeds the precomputed table.
+        - k (int): The number of nodes to return.
+
+        Output:
+        - numpy array of int: The ids of the top k nodes, highest diffusion value first. The top k
+          for a smaller k is always a prefix, whether or not k fits in the table.
+        """
+        table = self.node_rank_tables.get(kind)
+        if table is None:
+            return self.get_top_k_nodes(diffusion_profile, k)
+        top_node_ids = np.asarray(table.lookup(row, min(k, table.top_n))[0], dtype=np.int64)
+        if k <= table.top_n:
+            return top_node_ids
+        # Beyond the table, the next nodes of the profile. The table was ranked on the exact
+        # profiles, which a lossy profile encoding may order differently, so it is extended
+        # rather than ranked again.
+        rest = np.array(diffusion_profile, dtype=np.float32)
+        rest[top_node_ids] = -np.inf
+        return np.concatenate([top_node_ids, self.get_top_k_nodes(rest, k - table.top_n)])
+
+    def get_node_labels(self, node_ids):
+        return self.node_labels[node_ids].tolist()
+
+    def get_node_name(self, label):
+        return str(self.node_names[self.mapping_label_to_index[label]])
+
+    def create_subgraph(self, top_k_node_ids):
         """
         Create a subgraph from the top k nodes and draw it.
         
         Input: 
-        - top_k_node_labels (list of str): The labels of the nodes to include in the subgraph.
+        - top_k_node_ids (numpy array of int): The ids of the nodes to include in the subgraph.
 
         Output:
-        - nx.Graph: The subgraph containing only the top k nodes.
-        - dict: A dictionary mapping node labels to colors.
+        - CSRGraph: The subgraph containing only the top k nodes.
+        - list of str: The color of each subgraph node.
+        - list of str: The vis.js shape of each subgraph node.
         """
         # Check if input is valid
-        assert isinstance(top_k_node_labels, list), "top_k_node_labels must be a list"
-        #assert all(isinstance(node, (str, int)) for node in top_k_node_labels), "All elements in top_k_node_labels must be strings or integers"
+        assert isinstance(top_k_node_ids, np.ndarray), "top_k_node_ids must be a numpy array"
     
         # Create a subgraph from the top k nodes
-        subgraph = self.MSI.subgraph(top_k_node_labels)
-        
-        # Remove isolated nodes... frozen graph cannot be modified!
-        #subgraph.remove_nodes_from(list(nx.isolates(subgraph)))
-
-        # Create a dictionary for node colors
-        node_colors = {}
-        node_shapes = {}
-        for node in subgraph.nodes():
-            if self.node_types[node] == 'protein':
-                node_colors[node] = '#7F8C8D '  # dark grey color for proteins
-                node_shapes[node] = 'ellipse'  # circle for proteins
-            elif self.node_types[node] == 'bio':
-                node_colors[node] = '#2ECC71'  # green, #2ECC71 color for biological functions
-                node_shapes[node] = 'box'  # square for biological functions
-            elif self.node_types[node] == 'drug':
-                node_colors[node] = '#439AD9'  # blue, #03A9F4 color for drugs
-                node_shapes[node] = 'triangle'  # triangle for drugs
-            elif self.node_types[node] == 'indication':
-                node_colors[node] = '#DD614A'  # red, #F44336, #DD614A color for indications
-                node_shapes[node] = 'triangleDown'  # triangle for indications
+        subgraph = self.MSI.subgraph(top_k_node_ids)
+
+        # Look up colors and shapes by node type
+        node_colors = NODE_COLORS[subgraph.node_types].tolist()
+        node_shapes = NODE_SHAPES[subgraph.node_types].tolist()
 
         return subgraph, node_colors, node_shapes
     
     def draw_subgraph(self, subgraph, node_colors, node_shapes):
         
-        # Create a new figure and set the size
-        fig, ax = plt.subplots(figsize=(6, 6))
-
-        # Create a layout for our nodes 
-        layout = nx.spring_layout(subgraph)
-
-        # Draw nodes
-        for node_type in set(node_shapes.values()):
-            # Gather a list of nodes with the same shape
-            nodelist = [node for node, shape in node_shapes.items() if shape == node_type]
-            nx.draw_networkx_nodes(subgraph, layout, ax=ax, nodelist=nodelist, node_color=[node_colors[node] for node in nodelist], node_shape=node_type)
-
-        # Draw edges
-        nx.draw_networkx_edges(subgraph, layout, ax=ax)
-
-        # Draw labels
-        nx.draw_networkx_labels(subgraph, layout, ax=ax)
+        self.create_subgraph_figure(subgraph, node_colors, node_shapes)
 
         pass
 
     def create_subgraph_figure(self, subgraph, node_colors, node_shapes):
+        # networkx and matplotlib are only needed for plotting
+        import networkx as nx
+        import matplotlib.pyplot as plt
+
+        nx_subgraph = subgraph.to_networkx()
+        node_colors = dict(zip(subgraph.labels.tolist(), node_colors))
+        node_shapes = dict(zip(subgraph.labels.tolist(), node_shapes))
         
         # Create a new figure and set the size
         fig, ax = plt.subplots(figsize=(6, 6))
 
-        # Create a layout for our nodes 
-        layout = nx.spring_layout(subgraph)
+        # The same seeded layout the web app draws (layout.py)
+        layout = dict(zip(subgraph.labels.tolist(), force_layout(subgraph.n_nodes, *subgraph.edges())))
 
         # Draw nodes
         for node_type in set(node_shapes.values()):
             # Gather a list of nodes with the same shape
             nodelist = [node for node, shape in node_shapes.items() if shape == node_type]
-            nx.draw_networkx_nodes(subgraph, layout, ax=ax, nodelist=nodelist, node_color=[node_colors[node] for node in nodelist], node_shape=node_type)
+            nx.draw_networkx_nodes(nx_subgraph, layout, ax=ax, nodelist=nodelist, node_color=[node_colors[node] for node in nodelist], node_shape=node_type)
 
         # Draw edges
-        nx.draw_networkx_edges(subgraph, layout, ax=ax)
+        nx.draw_networkx_edges(nx_subgraph, layout, ax=ax)
 
         # Draw labels
-        nx.draw_networkx_labels(subgraph, layout, ax=ax)
+        nx.draw_networkx_labels(nx_subgraph, layout, ax=ax)
 
         return fig
 
@@ -343,3 +323,43 @@ class GraphManager:
         self.draw_subgraph(subgraph, node_colors, node_shapes)
 
         pass
+
+
+def test_top_k_profile_nodes():
+    import os
+    import tempfile
+
+    from benchmarks.synthetic_msi import generate_synthetic_msi, write_synthetic_msi
+    from ranking import build_node_rank_table
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_path = os.path.join(directory, 'data', '')
+        write_synthetic_msi(data_path, generate_synthetic_msi({'drug': 10, 'indication': 10, 'protein': 150, 'bio': 100}, seed=2), profiles=False)
+        graph_manager = GraphManager(data_path)
+        n_nodes = graph_manager.MSI_size_graph
+
+        # Few distinct values, so most ranks are ties, and a served copy with a lossy encoding's error
+        rng = np.random.default_rng(0)
+        profiles = rng.integers(0, 6, (4, n_nodes)).astype(np.float32)
+        served = profiles + rng.normal(0, 0.3, profiles.shape).astype(np.float32)
+        top_n = 40
+        expected = np.lexsort((np.broadcast_to(np.arange(n_nodes), profiles.shape), -profiles), axis=1)
+
+        for row in range(len(profiles)):
+            # Without a table: highest value first, equal values by node id
+            for k in [1, 7, top_n, n_nodes]:
+                assert np.array_equal(graph_manager.get_top_k_profile_nodes('drug', row, profiles[row], k), expected[row, :k]), (row, k)
+
+        graph_manager.node_rank_tables['drug'] = build_node_rank_table(profiles, top_n, directory, 'drug_node_ranks', block_size=3)
+        for row in range(len(profiles)):
+            # The same nodes from the table, and past it
+            for k in [1, 7, top_n, top_n + 1, n_nodes]:
+                top_node_ids = graph_manager.get_top_k_profile_nodes('drug', row, profiles[row], k)
+                assert top_node_ids.dtype == np.int64 and np.array_equal(top_node_ids, expected[row, :k]), (row, k)
+
+            # With a served profile ranked differently, going past the table still extends it
+            top_node_ids = graph_manager.get_top_k_profile_nodes('drug', row, served[row], top_n + 20)
+            assert np.array_equal(top_node_ids[:top_n], expected[row, :top_n]) and len(np.unique(top_node_ids)) == top_n + 20, row
+        del graph_manager.node_rank_tables['drug']
+
+    print("All tests passed.")
@@ -0,0 +1,307 @@
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from vector_database import ExactVectorDatabase, normalize_rows, top_k_smallest
+
+
+#===================================================================
+# Encoded diffusion profile storage
+#===================================================================
+# A diffusion profile has one value per MSI node, so the dense float32 profile matrices are the
+# largest arrays we serve. A ProfileStore keeps them in one of these encodings:
+#   float32   dense, exact                                  <name>_values.npy
+#   float16   dense, half the size                          <name>_values.npy
+#   int8      dense, a quarter of the size; row i is        <name>_values.npy, <name>_scales.npy
+#             values[i] * scales[i], scales[i] = max |row i| / 127
+#   sparse    the top_n largest values of each row, the     <name>_ids.npy, <name>_values.npy
+#             rest taken as 0. Diffusion mass is concentrated near the source, so a few hundred
+#             nodes out of tens of thousands hold most of it.
+# plus <name>.json with the encoding and shape. Indexing a store returns decoded float32 rows,
+# so it can stand in for the dense matrix wherever rows are read.
+#
+# benchmarks/profile_encodings.py reports the recommendation and top-k node overlap of each
+# encoding with float32.
+#
+# Snapshots of an encoded store serve exact k-NN on it through ProfileStoreDatabase, so no dense
+# float32 copy of the profiles is kept for k-NN; only float32 snapshots store the preprocessed
+# ExactVectorDatabase matrices, which make a query one matrix product.
+
+ENCODINGS = ['float32', 'float16', 'int8', 'sparse']
+
+# Diffusion values are mostly float16 subnormals, which numpy converts on a slow path; a table of
+# all 2^16 float16 bit patterns converts them as fast as any other
+FLOAT16_TO_FLOAT32 = np.arange(1 << 16, dtype=np.uint16).view(np.float16).astype(np.float32)
+
+
+def as_float32(values):
+    values = np.asarray(values)
+    if values.dtype == np.float16:
+        return FLOAT16_TO_FLOAT32[values.view(np.uint16)]
+    return values.astype(np.float32, copy=False)
+
+
+class ProfileStore:
+    def __init__(self, encoding, arrays, shape, top_n=None):
+        assert encoding in ENCODINGS, f"Encoding '{encoding}' is not supported."
+        self.encoding = encoding
+        self.arrays = arrays
+        self.shape = tuple(shape)
+        self.top_n = top_n
+
+    @classmethod
+    def encode(cls, profiles, encoding='float32', top_n=256, block_size=256):
+        """
+        Input:
+        - profiles (numpy array): Dense profiles, one row per drug / indication.
+        - encoding (str): One of ENCODINGS.
+        - top_n (int): Values kept per row by the sparse encoding.
+
+        Output:
+        - ProfileStore
+        """
+        shape = profiles.shape
+        if encoding in ['float32', 'float16']:
+            return cls(encoding, {'values': np.asarray(profiles, dtype=encoding)}, shape)
+
+        if encoding == 'int8':
+            scales = np.abs(profiles).max(axis=1).astype(np.float32) / 127
+            values = np.empty(shape, dtype=np.int8)
+            for start in range(0, shape[0], block_size):
+                block_scales = scales[start:start + block_size, None]
+                values[start:start + block_size] = np.rint(profiles[start:start + block_size] / np.where(block_scales > 0, block_scales, 1))
+            return cls(encoding, {'values': values, 'scales': scales}, shape)
+
+        top_n = min(top_n, shape[1])
+        ids = np.empty((shape[0], top_n), dtype=np.uint32)
+        values = np.empty((shape[0], top_n), dtype=np.float32)
+        for start in range(0, shape[0], block_size):
+            block_ids, block_values = top_k_smallest(-np.asarray(profiles[start:start + block_size], dtype=np.float32), top_n)
+            ids[start:start + len(block_ids)] = block_ids
+            values[start:start + len(block_ids)] = -block_values
+        return cls(encoding, {'ids': ids, 'values': values}, shape, top_n=top_n)
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Reading rows
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def decode(self, rows):
+        """
+        Input:
+        - rows: Anything that selects rows of a numpy array (slice, int array, list).
+
+        Output:
+        - numpy array (n_rows, n_nodes), float32: The decoded profiles.
+        """
+        if self.encoding in ['float32', 'float16']:
+            return as_float32(self.arrays['values'][rows])
+        if self.encoding == 'int8':
+            return self.arrays['values'][rows].astype(np.float32) * self.arrays['scales'][rows][:, None]
+
+        ids = self.arrays['ids'][rows]
+        decoded = np.zeros((len(ids), self.shape[1]), dtype=np.float32)
+        np.put_along_axis(decoded, ids.astype(np.int64), self.arrays['values'][rows], axis=1)
+        return decoded
+
+    def __getitem__(self, key):
+        # An int gives one profile (n_nodes,), anything else a (n_rows, n_nodes) block
+        if isinstance(key, (int, np.integer)):
+            return self.decode(slice(key, key + 1 if key != -1 else None))[0]
+        return self.decode(key)
+
+    def __array__(self, dtype=None):
+        decoded = self.decode(slice(None))
+        return decoded if dtype is None else decoded.astype(dtype, copy=False)
+
+    def iter_blocks(self, block_size=256):
+        for start in range(0, len(self), block_size):
+            yield start, self.decode(slice(start, start + block_size))
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Queries on the encoded profiles
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+
+    def top_k_nodes(self, row, k):
+        """
+        Output:
+        - numpy array of int: Ids of the k nodes with the highest value in a profile, highest first.
+        """
+        if self.encoding == 'sparse':
+            assert k <= self.top_n, f"The sparse encoding only keeps the top {self.top_n} nodes per profile"
+            return self.arrays['ids'][row, :k].astype(np.int64)
+        profile = self[row]
+        top_k = np.argpartition(profile, len(profile) - k)[len(profile) - k:]
+        return top_k[np.argsort(profile[top_k])[::-1]]
+
+    def dot(self, queries, block_size=256):
+        """
+        Inner products of every stored profile with query vectors, on the encoded values: int8
+        rows are scaled after the product and sparse rows only touch their stored nodes.
+
+        Output:
+        - numpy array (n_queries, n_rows), float32
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        products = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), block_size):
+            rows = slice(start, start + block_size)
+            if self.encoding == 'sparse':
+                ids = self.arrays['ids'][rows]
+                block = sp.csr_matrix((self.arrays['values'][rows].ravel(), ids.ravel().astype(np.int64), np.arange(0, ids.size + 1, self.top_n)), shape=(len(ids), self.shape[1]))
+                block_products = (block @ queries.T).T
+            else:
+                block_products = queries @ as_float32(self.arrays['values'][rows]).T
+                if self.encoding == 'int8':
+                    block_products *= self.arrays['scales'][rows]
+            products[:, start:start + block_products.shape[1]] = block_products
+        return products
+
+    def nearest_neighbors_batch(self, queries, metric='correlation', k=10, block_size=256, return_distances=False):
+        """
+        Exact k-NN of query vectors among the stored profiles, decoding one block of profiles at a time.
+
+        Output:
+        - numpy array (n_queries, k), int: Row indices of the k nearest profiles, closest first.
+        - numpy array (n_queries, k), float32: Their distances, if return_distances.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        best_indices = np.empty((len(queries), 0), dtype=np.int64)
+        best_distances = np.empty((len(queries), 0), dtype=np.float32)
+        for start, block in self.iter_blocks(block_size):
+            db = ExactVectorDatabase(metrics=[metric])
+            db.add_vectors(block)
+            block_indices, block_distances = db.nearest_neighbors_batch(queries, metric, k, return_distances=True)
+
+            # Merge with the best so far
+            candidates = np.concatenate([best_indices, block_indices + start], axis=1)
+            candidate_distances = np.concatenate([best_distances, block_distances], axis=1)
+            order, best_distances = top_k_smallest(candidate_distances, k)
+            best_indices = np.take_along_axis(candidates, order, axis=1)
+        return (best_indices, best_distances) if return_distances else best_indices
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Persistence
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+
+    def save(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        for part, array in self.arrays.items():
+            np.save(os.path.join(directory, f'{name}_{part}.npy'), array)
+        with open(os.path.join(directory, f'{name}.json'), 'w') as handle:
+            json.dump({'encoding': self.encoding, 'shape': list(self.shape), 'top_n': self.top_n, 'parts': sorted(self.arrays)}, handle, indent=2)
+
+    @classmethod
+    def load(cls, directory, name):
+        with open(os.path.join(directory, f'{name}.json')) as handle:
+            metadata = json.load(handle)
+        arrays = {part: np.load(os.path.join(directory, f'{name}_{part}.npy'), mmap_mode='r') for part in metadata['parts']}
+        return cls(metadata['encoding'], arrays, metadata['shape'], top_n=metadata['top_n'])
+
+
+class ProfileStoreDatabase:
+    def __init__(self, store, metrics=['correlation'], block_size=256):
+        """
+        The ExactVectorDatabase interface on a ProfileStore, without a preprocessed float32 copy
+        of the profiles: the norms each metric needs are computed once per row, and a query is
+        ProfileStore.dot on the encoded values. Manhattan distances decode one block at a time.
+
+        Input:
+        - store (ProfileStore): The profiles to search.
+        - metrics (list of str): Metrics served, from ExactVectorDatabase.METRICS.
+        """
+        for metric in metrics:
+            assert metric in ExactVectorDatabase.METRICS, f"Metric '{metric}' is not supported."
+        self.store = store
+        self.metrics = metrics
+        self.block_size = block_size
+        self.n_items, self.dimensions = store.shape
+
+        self.norms = np.empty(self.n_items, dtype=np.float32)
+        self.centered_norms = np.empty(self.n_items, dtype=np.float32)
+        for start, block in store.iter_blocks(block_size):
+            self.norms[start:start + len(block)] = np.linalg.norm(block, axis=1)
+            self.centered_norms[start:start + len(block)] = np.linalg.norm(block - block.mean(axis=1, keepdims=True), axis=1)
+        self.squared_norms = self.norms.astype(np.float64) ** 2
+
+    def distances(self, queries, metric):
+        """
+        Output:
+        - numpy array (n_queries, n_items), float32: As ExactVectorDatabase.distances on the decoded profiles.
+        """
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+        if metric == 'manhattan':
+            distances = np.empty((len(queries), self.n_items), dtype=np.float32)
+            for start, block in self.store.iter_blocks(self.block_size):
+                db = ExactVectorDatabase(metrics=[metric])
+                db.add_vectors(block)
+                distances[:, start:start + len(block)] = db.distances(queries, metric)
+            return distances
+
+        if metric == 'correlation':
+            # Centred queries sum to zero, so their product with a row equals that with the centred row
+            products = self.store.dot(normalize_rows(queries - queries.mean(axis=1, keepdims=True)), self.block_size)
+            return 1.0 - products / np.where(self.centered_norms > 0, self.centered_norms, 1.0)
+        if metric in ['cosine', 'angular']:
+            cosines = self.store.dot(normalize_rows(queries), self.block_size) / np.where(self.norms > 0, self.norms, 1.0)
+            return 1.0 - cosines if metric == 'cosine' else np.sqrt(np.maximum(2.0 - 2.0 * cosines, 0.0))
+
+        squared = self.squared_norms[None, :] - 2.0 * self.store.dot(queries, self.block_size) + np.einsum('ij,ij->i', queries, queries)[:, None]
+        return np.sqrt(np.maximum(squared, 0.0)).astype(np.float32)
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, return_distances=False):
+        indices, distances = top_k_smallest(self.distances(queries, metric), k)
+        return (indices, distances) if return_distances else indices
+
+    def nearest_neighbors(self, query, metric, k=10):
+        return self.nearest_neighbors_batch(query, metric, k)[0].tolist()
+
+
+def test_profile_store():
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    profiles = (rng.random((50, 400)) ** 8).astype(np.float32)
+    queries = (rng.random((5, 400)) ** 8).astype(np.float32)
+    exact = ExactVectorDatabase(metrics=['correlation'])
+    exact.add_vectors(profiles)
+    expected = exact.nearest_neighbors_batch(queries, 'correlation', 5)
+
+    for encoding in ENCODINGS:
+        store = ProfileStore.encode(profiles, encoding, top_n=400)
+        with tempfile.TemporaryDirectory() as directory:
+            store.save(directory, 'profiles')
+            store = ProfileStore.load(directory, 'profiles')
+
+        assert store[3].shape == (400,) and store[[1, 2]].shape == (2, 400) and np.asarray(store).shape == profiles.shape
+        assert np.allclose(store[7], profiles[7], atol=np.abs(profiles[7]).max() / 100), f"{encoding} decodes badly."
+        assert set(store.top_k_nodes(7, 10).tolist()) == set(np.argsort(profiles[7])[-10:].tolist()), f"{encoding} top-k nodes differ."
+        # Blocked k-NN over the store matches the dense exact search
+        indices = store.nearest_neighbors_batch(queries, 'correlation', 5, block_size=16)
+        assert np.mean([len(set(a) & set(b)) / 5 for a, b in zip(indices, expected)]) >= 0.8, f"{encoding} k-NN differs."
+
+        # The database interface answers exactly as an ExactVectorDatabase of the decoded profiles
+        assert np.allclose(store.dot(queries, block_size=16), queries @ np.asarray(store).T, rtol=1e-4, atol=1e-6)
+        db = ProfileStoreDatabase(store, metrics=ExactVectorDatabase.METRICS, block_size=16)
+        decoded = ExactVectorDatabase(metrics=ExactVectorDatabase.METRICS)
+        decoded.add_vectors(np.asarray(store))
+        for metric in db.metrics:
+            assert np.allclose(db.distances(queries, metric), decoded.distances(queries, metric), rtol=1e-4, atol=1e-4), f"{encoding} {metric} distances differ."
+            indices, distances = db.nearest_neighbors_batch(queries, metric, 5, return_distances=True)
+            assert np.allclose(distances, np.sort(decoded.distances(queries, metric), axis=1)[:, :5], rtol=1e-4, atol=1e-5)
+        assert db.nearest_neighbors(queries[0], 'correlation', 3) == decoded.nearest_neighbors(queries[0], 'correlation', 3)
+
+    # Keeping every value, the sparse and float32 stores are identical
+    assert np.array_equal(np.asarray(ProfileStore.encode(profiles, 'sparse', top_n=400)), profiles)
+
+    print("All tests passed.")
@@ -0,0 +1,225 @@
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from vector_database import ExactVectorDatabase, top_k_smallest
+
+
+#===================================================================
+# Precomputed top-N tables
+#===================================================================
+# For a fixed set of query rows (e.g. every indication profile) the full ranking result is small
+# and only changes between data releases, so it is computed once and stored as two .npy arrays:
+#   <name>_ids.npy     (n_rows, N) int32    ids of the N best items per row, best first
+#   <name>_scores.npy  (n_rows, N) float32  their scores (distances for k-NN tables)
+# Serving a query for row r and any k <= N is then a slice of an mmapped array.
+
+
+class TopNTable:
+    def __init__(self, ids, scores=None):
+        self.ids = ids
+        self.scores = scores
+        self.n_rows, self.top_n = ids.shape
+
+    def lookup(self, row, k):
+        """
+        Output:
+        - numpy array (k,): The k best ids of a row, best first.
+        - numpy array (k,): Their scores, or None if the table has no scores.
+        """
+        assert k <= self.top_n, f"k cannot be greater than the {self.top_n} entries stored per row"
+        return self.ids[row, :k], (self.scores[row, :k] if self.scores is not None else None)
+
+    def lookup_batch(self, rows, k):
+        assert k <= self.top_n, f"k cannot be greater than the {self.top_n} entries stored per row"
+        return self.ids[rows, :k], (self.scores[rows, :k] if self.scores is not None else None)
+
+    @classmethod
+    def load(cls, directory, name):
+        ids = np.load(os.path.join(directory, f'{name}_ids.npy'), mmap_mode='r')
+        scores_path = os.path.join(directory, f'{name}_scores.npy')
+        scores = np.load(scores_path, mmap_mode='r') if os.path.exists(scores_path) else None
+        return cls(ids, scores)
+
+
+def build_ranking_table(queries, items, metric, top_n, directory, name, block_size=256):
+    """
+    Rank every item for every query row by exact distance and store the top N per row.
+
+    Queries are processed in blocks, so memory stays at one (block_size x n_items) distance
+    matrix no matter how many rows the table has; the output is written straight to disk.
+
+    Input:
+    - queries (numpy array): One query vector per row, e.g. indication diffusion profiles.
+    - items (numpy array): The vectors to rank, e.g. drug diffusion profiles.
+    - metric (str): One of ExactVectorDatabase.METRICS.
+    - top_n (int): Number of items stored per row.
+
+    Output:
+    - TopNTable: Memory-mapped from the written files.
+    """
+    db = ExactVectorDatabase(metrics=[metric])
+    db.add_vectors(items)
+    top_n = min(top_n, db.n_items)
+
+    os.makedirs(directory, exist_ok=True)
+    ids = open_memmap(os.path.join(directory, f'{name}_ids.npy'), mode='w+', dtype=np.int32, shape=(len(queries), top_n))
+    scores = open_memmap(os.path.join(directory, f'{name}_scores.npy'), mode='w+', dtype=np.float32, shape=(len(queries), top_n))
+
+    for start in range(0, len(queries), block_size):
+        block_ids, block_scores = db.nearest_neighbors_batch(queries[start:start + block_size], metric, top_n, return_distances=True)
+        ids[start:start + len(block_ids)] = block_ids
+        scores[start:start + len(block_ids)] = block_scores
+
+    ids.flush()
+    scores.flush()
+    del ids, scores
+    return TopNTable.load(directory, name)
+
+
+# Metrics whose distances do not change when zero columns are appended to both vectors
+# (correlation centres each vector on its mean, which depends on the number of columns)
+ZERO_PADDING_INVARIANT_METRICS = ['angular', 'cosine', 'euclidean', 'manhattan']
+
+
+def update_ranking_table(base_table, queries, items, metric, top_n, changed_query_rows, changed_item_rows, directory, name, block_size=256):
+    """
+    The ranking table of queries x items, from the table of an earlier version of them that
+    differs only in the changed rows: updated ones and every row appended at the end (see delta.py).
+
+    No distance between unchanged rows changed, so a row's old top N without the changed items,
+    merged with the distances to the changed items, is exact whenever its N-th distance is no
+    worse than before: every item outside the old top N is at least that far. Other rows, and
+    changed query rows, are ranked again in full. Columns appended since must be zero in every
+    unchanged vector and the metric one of ZERO_PADDING_INVARIANT_METRICS.
+
+    Output:
+    - TopNTable: Memory-mapped from the written files.
+    """
+    top_n = min(top_n, len(items))
+    if top_n > base_table.top_n or base_table.scores is None:
+        return build_ranking_table(queries, items, metric, top_n, directory, name, block_size)
+
+    changed_items = np.asarray(changed_item_rows, dtype=np.int64)
+    rerank = np.ones(len(queries), dtype=bool)
+    rerank[:base_table.n_rows] = False
+    rerank[np.asarray(changed_query_rows, dtype=np.int64)] = True
+
+    os.makedirs(directory, exist_ok=True)
+    ids = open_memmap(os.path.join(directory, f'{name}_ids.npy'), mode='w+', dtype=np.int32, shape=(len(queries), top_n))
+    scores = open_memmap(os.path.join(directory, f'{name}_scores.npy'), mode='w+', dtype=np.float32, shape=(len(queries), top_n))
+
+    rows = np.flatnonzero(~rerank)
+    changed_db = ExactVectorDatabase(metrics=[metric])
+    changed_db.add_vectors(items[changed_items])
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        old_ids, old_scores = np.asarray(base_table.ids[block_rows, :top_n], dtype=np.int64), np.asarray(base_table.scores[block_rows, :top_n], dtype=np.float64)
+        candidate_ids = np.concatenate([old_ids, np.broadcast_to(changed_items, (len(block_rows), len(changed_items)))], axis=1)
+        candidate_scores = np.concatenate([np.where(np.isin(old_ids, changed_items), np.inf, old_scores), changed_db.distances(queries[block_rows], metric)], axis=1)
+        order = np.argsort(candidate_scores, axis=1, kind='stable')[:, :top_n]
+        ids[block_rows] = np.take_along_axis(candidate_ids, order, axis=1)
+        scores[block_rows] = np.take_along_axis(candidate_scores, order, axis=1)
+        rerank[block_rows] = np.take_along_axis(candidate_scores, order[:, -1:], axis=1)[:, 0] > old_scores[:, -1]
+
+    rows = np.flatnonzero(rerank)
+    if len(rows):
+        db = ExactVectorDatabase(metrics=[metric])
+        db.add_vectors(items)
+        for start in range(0, len(rows), block_size):
+            block_rows = rows[start:start + block_size]
+            ids[block_rows], scores[block_rows] = db.nearest_neighbors_batch(queries[block_rows], metric, top_n, return_distances=True)
+
+    ids.flush()
+    scores.flush()
+    del ids, scores
+    return TopNTable.load(directory, name)
+
+
+def build_node_rank_table(profiles, top_n, directory, name, block_size=256):
+    """
+    Store the top N nodes of every diffusion profile, highest diffusion value first.
+
+    The ids are uint32 node ids (columns of the profiles) and the scores the profile values,
+    so the top k nodes of a profile for any k <= N are a slice of the mmapped table.
+
+    Input:
+    - profiles (numpy array): One diffusion profile per row, one column per MSI node.
+    - top_n (int): Number of nodes stored per profile.
+
+    Output:
+    - TopNTable: Memory-mapped from the written files.
+    """
+    top_n = min(top_n, profiles.shape[1])
+
+    os.makedirs(directory, exist_ok=True)
+    ids = open_memmap(os.path.join(directory, f'{name}_ids.npy'), mode='w+', dtype=np.uint32, shape=(len(profiles), top_n))
+    scores = open_memmap(os.path.join(directory, f'{name}_scores.npy'), mode='w+', dtype=np.float32, shape=(len(profiles), top_n))
+
+    for start in range(0, len(profiles), block_size):
+        block_ids, block_scores = top_k_smallest(-np.asarray(profiles[start:start + block_size], dtype=np.float32), top_n)
+        ids[start:start + len(block_ids)] = block_ids
+        scores[start:start + len(block_ids)] = -block_scores
+
+    ids.flush()
+    scores.flush()
+    del ids, scores
+    return TopNTable.load(directory, name)
+
+
+def test_ranking_table():
+    import tempfile
+
+    from scipy.spatial.distance import cdist
+
+    def brute_force(queries, items, metric, top_n):
+        distances = cdist(queries, items, {'manhattan': 'cityblock'}.get(metric, metric))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :top_n]
+        return order, np.take_along_axis(distances, order, axis=1)
+
+    rng = np.random.default_rng(0)
+    queries, items, top_n = rng.random((300, 16)), rng.random((80, 16)), 10
+
+    with tempfile.TemporaryDirectory() as directory:
+        for metric in ['euclidean', 'manhattan', 'correlation']:
+            table = build_ranking_table(queries, items, metric, top_n, directory, f'base_{metric}', block_size=64)
+            expected_ids, expected_scores = brute_force(queries, items, metric, top_n)
+            assert np.array_equal(table.ids, expected_ids), metric
+            assert np.allclose(table.scores, expected_scores, rtol=1e-4, atol=1e-5), metric
+            ids, scores = table.lookup(5, 3)
+            assert np.array_equal(ids, expected_ids[5, :3]) and np.allclose(scores, expected_scores[5, :3], rtol=1e-4)
+            assert np.array_equal(table.lookup_batch([1, 7], 4)[0], expected_ids[[1, 7], :4])
+
+        # A delta: the items most often in a top N move far away, so they drop out of many rows,
+        # a few items move close to the queries, a few queries change, and rows and a column are
+        # appended (zero in every unchanged vector)
+        counts = np.bincount(build_ranking_table(queries, items, 'euclidean', top_n, directory, 'counts').ids.ravel(), minlength=len(items))
+        dropped = np.argsort(-counts)[:5]
+        new_items = np.hstack([items, np.zeros((len(items), 1))])
+        new_items[dropped] += 5.0
+        moved = np.setdiff1d(np.arange(len(items)), dropped)[:2]
+        new_items[moved, :-1] = queries[[10, 20]]
+        new_items = np.vstack([new_items, rng.random((6, 17))])
+        new_queries = np.hstack([queries, np.zeros((len(queries), 1))])
+        new_queries[[0, 50]] = rng.random((2, 17))
+        new_queries = np.vstack([new_queries, rng.random((4, 17))])
+        changed_items = np.concatenate([dropped, moved, np.arange(len(items), len(new_items))])
+
+        for metric in ['euclidean', 'manhattan']:
+            base_table = build_ranking_table(queries, items, metric, top_n, directory, f'base_{metric}')
+            table = update_ranking_table(base_table, new_queries, new_items, metric, top_n, [0, 50], changed_items, directory, f'new_{metric}', block_size=64)
+            expected_ids, expected_scores = brute_force(new_queries, new_items, metric, top_n)
+            assert np.array_equal(table.ids, expected_ids), metric
+            assert np.allclose(table.scores, expected_scores, rtol=1e-4, atol=1e-5), metric
+            # Rows really lost items to the delta
+            assert np.isin(base_table.ids, dropped).any(axis=1).sum() > 0 and not np.isin(table.ids, dropped).any()
+
+        profiles = rng.random((20, 50)).astype(np.float32)
+        table = build_node_rank_table(profiles, 8, directory, 'nodes', block_size=7)
+        expected_ids = np.argsort(-profiles, axis=1, kind='stable')[:, :8]
+        assert np.array_equal(table.ids, expected_ids)
+        assert np.array_equal(table.scores, np.take_along_axis(profiles, expected_ids, axis=1))
+        del base_table, table
+
+    print("All tests passed.")
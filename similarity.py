@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+#===================================================================
+# Symmetric drug / indication similarity engine
+#===================================================================
+# Drug and indication profiles live in the same space (one entry per MSI node), so every
+# direction is the same exact k-NN problem: disease -> drugs, drug -> diseases, drug -> drugs
+# and disease -> diseases. Each kind is indexed by its own exact database.
+
+KINDS = ['drug', 'indication']
+
+
+class SimilarityEngine:
+    def __init__(self, profiles, databases):
+        """
+        Input:
+        - profiles (dict): Kind ('drug' / 'indication') -> diffusion profiles, one row per entity.
+        - databases (dict): Kind -> ExactVectorDatabase built from those profiles, or a
+          ProfileStoreDatabase searching them as stored.
+        """
+        assert set(profiles) == set(databases) == set(KINDS), f"Both kinds {KINDS} must be indexed."
+        self.profiles = profiles
+        self.databases = databases
+        self.metrics = sorted(set.intersection(*(set(db.metrics) for db in databases.values())))
+
+    def nearest(self, source_kind, source_row, target_kind, k=10, metric='correlation'):
+        """
+        The k entities of target_kind closest to one entity of source_kind.
+        When both kinds are the same, the entity itself is left out.
+
+        Output:
+        - numpy array (k,): Row indices into the target profiles, closest first.
+        - numpy array (k,): Their distances.
+        """
+        exclude_self = source_kind == target_kind
+        indices, distances = self.nearest_to_profile(self.profiles[source_kind][source_row], target_kind, k + int(exclude_self), metric)
+
+        if exclude_self:
+            keep = indices != source_row
+            indices, distances = indices[keep][:k], distances[keep][:k]
+        return indices, distances
+
+    def nearest_to_profile(self, profile, target_kind, k=10, metric='correlation'):
+        """
+        The k entities of target_kind closest to any diffusion profile, e.g. one computed online
+        for a set of seed nodes (diffusion.SeedProfileSolver).
+
+        Output:
+        - numpy array (k,): Row indices into the target profiles, closest first.
+        - numpy array (k,): Their distances.
+        """
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        indices, distances = self.databases[target_kind].nearest_neighbors_batch(profile, metric, k, return_distances=True)
+        return indices[0], distances[0]
+
+    def iter_distance_blocks(self, source_kind, target_kind, metric='correlation', max_block_bytes=256 << 20):
+        """
+        Full source x target distance matrix, one block of source rows at a time.
+
+        Output:
+        - generator of (int, numpy array): Start row of the block and its (rows, n_targets) distances.
+        """
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        n_targets = self.databases[target_kind].n_items
+        rows = max(1, max_block_bytes // (4 * n_targets))
+        source = self.profiles[source_kind]
+        for start in range(0, len(source), rows):
+            yield start, self.databases[target_kind].distances(source[start:start + rows], metric).astype(np.float32)
+
+    def export_similarity_matrix(self, source_kind, target_kind, metric='correlation', path=None, max_block_bytes=256 << 20):
+        """
+        Compute the full distance matrix in memory-capped blocks.
+
+        Input:
+        - path (str): If given, blocks are written straight to this .npy file through a memory
+          map, so the full matrix never has to fit in RAM.
+
+        Output:
+        - numpy array (n_sources, n_targets), float32: In memory, or memory-mapped from path.
+        """
+        shape = (len(self.profiles[source_kind]), self.databases[target_kind].n_items)
+        if path is None:
+            matrix = np.empty(shape, dtype=np.float32)
+        else:
+            matrix = open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+        for start, block in self.iter_distance_blocks(source_kind, target_kind, metric, max_block_bytes):
+            matrix[start:start + len(block)] = block
+
+        if path is not None:
+            matrix.flush()
+        return matrix
+
+
+def test_similarity_engine():
+    import tempfile
+
+    from scipy.spatial.distance import cdist
+
+    from vector_database import ExactVectorDatabase
+
+    rng = np.random.default_rng(0)
+    profiles = {'drug': rng.random((40, 30)).astype(np.float32), 'indication': rng.random((25, 30)).astype(np.float32)}
+    databases = {}
+    for kind, kind_profiles in profiles.items():
+        databases[kind] = ExactVectorDatabase(metrics=['correlation', 'euclidean'])
+        databases[kind].add_vectors(kind_profiles)
+    engine = SimilarityEngine(profiles, databases)
+    assert engine.metrics == ['correlation', 'euclidean']
+
+    for metric in engine.metrics:
+        # Euclidean distances come from |a|^2 + |b|^2 - 2ab in float32, which cancels to ~1e-3 near 0
+        atol = {'euclidean': 5e-3}.get(metric, 1e-5)
+        for source_kind in KINDS:
+            for target_kind in KINDS:
+                expected = cdist(profiles[source_kind].astype(np.float64), profiles[target_kind].astype(np.float64), metric)
+                for source_row in [0, 7]:
+                    indices, distances = engine.nearest(source_kind, source_row, target_kind, 5, metric)
+                    row = expected[source_row].copy()
+                    if source_kind == target_kind:
+                        # The entity itself is left out
+                        row[source_row] = np.inf
+                    assert np.array_equal(indices, np.argsort(row, kind='stable')[:5]), (metric, source_kind, target_kind)
+                    assert np.allclose(distances, np.sort(row)[:5], rtol=1e-4, atol=atol)
+
+                # Blocks of 3 rows, written through the memory map
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, 'matrix.npy')
+                    engine.export_similarity_matrix(source_kind, target_kind, metric, path, max_block_bytes=3 * 4 * len(profiles[target_kind]))
+                    assert np.allclose(np.load(path), expected, rtol=1e-4, atol=atol)
+                assert np.allclose(engine.export_similarity_matrix(source_kind, target_kind, metric), expected, rtol=1e-4, atol=atol)
+
+        profile = rng.random(30)
+        indices, distances = engine.nearest_to_profile(profile, 'indication', 4, metric)
+        expected = cdist(profile[None], profiles['indication'].astype(np.float64), metric)[0]
+        assert np.array_equal(indices, np.argsort(expected, kind='stable')[:4])
+        assert np.allclose(distances, np.sort(expected)[:4], rtol=1e-4, atol=atol)
+
+    print("All tests passed.")
+
+
+if __name__ == '__main__':
+    # Bulk export: python similarity.py <source kind> <target kind> [metric] [output.npy] [data_path] [snapshot_root]
+    from snapshot import load_snapshot
+
+    source_kind, target_kind = sys.argv[1], sys.argv[2]
+    metric = sys.argv[3] if len(sys.argv) > 3 else 'correlation'
+    path = sys.argv[4] if len(sys.argv) > 4 else f'{source_kind}_{target_kind}_{metric}.npy'
+    data_path = sys.argv[5] if len(sys.argv) > 5 else './data/'
+    snapshot_root = sys.argv[6] if len(sys.argv) > 6 else './snapshots/'
+
+    snapshot = load_snapshot(data_path, snapshot_root=snapshot_root)
+    start = time.time()
+    matrix = snapshot.similarity_engine.export_similarity_matrix(source_kind, target_kind, metric, path)
+    print(f'Wrote {matrix.shape} {metric} distance matrix to {os.path.abspath(path)} in {time.time() - start:.1f}s')
@@ -0,0 +1,385 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from graph_core import CSRGraph
+from ingestion import EDGE_FILES, MSITables, load_msi_tables
+from instrumentation import startup_phase
+from manager import GraphManager
+from profile_store import ProfileStore, ProfileStoreDatabase
+from ranking import ZERO_PADDING_INVARIANT_METRICS, TopNTable, build_node_rank_table, build_ranking_table, update_ranking_table
+from similarity import SimilarityEngine
+from utils import load_data_dict
+from vector_database import ExactVectorDatabase, IndexMismatchError, MultiMetricDatabase, build_vector_indexes, extend_vector_indexes
+
+
+#===================================================================
+# Versioned binary startup snapshot
+#===================================================================
+# Everything a worker needs at startup, stored as flat files it can mmap:
+#
+#   snapshots/<key>/
+#       manifest.json                  key, build parameters, array shapes
+#       node_labels.npy, node_names.npy, node_types.npy          string table and node types
+#       edge_sources.npy, edge_targets.npy, edge_types.npy       ingested edge arrays
+#       msi_indptr.npy, msi_indices.npy, msi_weights.npy         CSR arrays of the MSI graph
+#       drug_profiles_*.npy, indication_profiles_*.npy (+ .json)  diffusion profiles as a ProfileStore (profile_store.py)
+#       drug_labels.npy, indication_labels.npy                    row index -> label
+#       drug_index_<metric>.ann, drug_index.json                  saved Annoy indexes and their build metadata
+#       drug_exact_<metric>.npy, indication_exact_<metric>.npy    preprocessed matrices for exact k-NN, float32 profiles only
+#       drug_ranking_<metric>_ids.npy, _scores.npy                indication -> top-N drugs (ranking.py)
+#       drug_node_ranks_ids.npy, indication_node_ranks_ids.npy    profile -> top-N MSI nodes, plus _scores.npy
+#
+# The key is a content hash of the data/ inputs and the build parameters, so a worker never
+# serves a snapshot built from different data or settings.
+#
+# <snapshot_root>/CURRENT holds the key of the snapshot to serve. load_snapshot points it at the
+# snapshot it loads and delta.py at the one it derives from a data update; serving workers poll
+# it and switch to a new snapshot without restarting (see main.py).
+
+# Bump whenever the snapshot layout or the way any of its arrays is derived changes
+SNAPSHOT_FORMAT_VERSION = 10
+
+DEFAULT_SNAPSHOT_PARAMS = {
+    'metrics': ['angular', 'euclidean', 'manhattan'],
+    'n_trees': 30,
+    # Optional reduced-dimension Annoy forests ('pca', 'svd' or 'random'), re-ranked exactly on the profiles
+    'projection': None,
+    'projection_dimensions': 128,
+    'projection_transform': None,
+    'exact_metrics': ['correlation'],
+    'ranking_metrics': ['correlation', 'manhattan'],
+    'ranking_top_n': 100,
+    'node_rank_top_n': 256,
+    # Encoding the served profiles are stored in; indexes and tables are always built from float32.
+    # Other encodings serve exact k-NN on the encoded profiles, without the float32 exact matrices
+    'profile_encoding': 'float32',
+    'profile_top_n': 1024,
+}
+
+CURRENT_FILE = 'CURRENT'
+
+PROFILE_FILES = ['compressed_diffusion_profiles.npz', 'map_drug_labels_to_indices.pickle', 'map_indication_labels_to_indices.pickle']
+
+
+def snapshot_input_files(data_path):
+    file_names = [file_name for _, file_name, _, _ in EDGE_FILES] + PROFILE_FILES
+    return [os.path.join(data_path, file_name) for file_name in file_names if os.path.exists(os.path.join(data_path, file_name))]
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_snapshot_key(data_path, params, snapshot_root=None):
+    """
+    Content hash of the data inputs and the build parameters.
+
+    File hashes are memoized in <snapshot_root>/input_hashes.json by (size, mtime), so workers
+    only re-read the inputs when a file actually changed on disk.
+
+    Output:
+    - str: 16 hex characters.
+    """
+    memo_path = os.path.join(snapshot_root, 'input_hashes.json') if snapshot_root else None
+    memo = {}
+    if memo_path and os.path.exists(memo_path):
+        with open(memo_path) as handle:
+            memo = json.load(handle)
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'format_version': SNAPSHOT_FORMAT_VERSION, 'params': params}, sort_keys=True).encode())
+
+    updated = False
+    for path in snapshot_input_files(data_path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = memo.get(os.path.abspath(path))
+        if entry is None or entry['stamp'] != stamp:
+            entry = {'stamp': stamp, 'sha256': hash_file(path)}
+            memo[os.path.abspath(path)] = entry
+            updated = True
+        digest.update(os.path.basename(path).encode())
+        digest.update(entry['sha256'].encode())
+
+    if memo_path and updated:
+        write_json_atomically(memo_path, memo)
+
+    return digest.hexdigest()[:16]
+
+
+def write_json_atomically(path, data):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as handle:
+        json.dump(data, handle, indent=2)
+    os.chmod(handle.name, 0o644)
+    os.replace(handle.name, path)
+
+
+def read_current_key(snapshot_root):
+    try:
+        with open(os.path.join(snapshot_root, CURRENT_FILE)) as handle:
+            return handle.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish_current_key(snapshot_root, key):
+    with tempfile.NamedTemporaryFile('w', dir=snapshot_root, delete=False, suffix='.tmp') as handle:
+        handle.write(key + '\n')
+    os.chmod(handle.name, 0o644)
+    os.replace(handle.name, os.path.join(snapshot_root, CURRENT_FILE))
+
+
+def labels_by_index(map_labels_to_indices):
+    labels = np.empty(len(map_labels_to_indices), dtype=object)
+    for label, index in map_labels_to_indices.items():
+        labels[index] = label
+    assert not any(label is None for label in labels), "Label -> index maps must cover a dense range of rows."
+    return labels.astype(str)
+
+
+#===================================================================
+# Build
+#===================================================================
+
+def build_snapshot(data_path, snapshot_root='./snapshots/', params=None):
+    """
+    Build the snapshot for the current data and parameters, if it does not exist yet.
+
+    Output:
+    - str: Path of the snapshot directory.
+    """
+    params = params or DEFAULT_SNAPSHOT_PARAMS
+    os.makedirs(snapshot_root, exist_ok=True)
+    key = compute_snapshot_key(data_path, params, snapshot_root)
+    snapshot_path = os.path.join(snapshot_root, key)
+    if os.path.exists(os.path.join(snapshot_path, 'manifest.json')):
+        return snapshot_path
+
+    def build(build_path):
+        start = time.time()
+        with startup_phase('tsv_load'):
+            tables = load_msi_tables(data_path)
+        with startup_phase('graph_build'):
+            graph_manager = GraphManager(tables=tables)
+
+        with startup_phase('profile_load'):
+            profiles, labels = {}, {}
+            with np.load(os.path.join(data_path, 'compressed_diffusion_profiles.npz')) as data:
+                profiles['drug'] = data['arr1'].astype(np.float32)
+                profiles['indication'] = data['arr2'].astype(np.float32)
+            for kind in ['drug', 'indication']:
+                labels[kind] = labels_by_index(load_data_dict(os.path.join(data_path, f'map_{kind}_labels_to_indices')))
+
+        write_snapshot(build_path, key, params, graph_manager, profiles, labels, started=start)
+
+    return publish_snapshot(snapshot_root, key, build)
+
+
+def write_snapshot(build_path, key, params, graph_manager, profiles, labels, base_path=None, changed_rows=None, manifest_extra=None, started=None):
+    """
+    Write every snapshot file for a graph and its diffusion profiles.
+
+    Input:
+    - profiles (dict): 'drug' / 'indication' -> float32 profiles, one row per entity.
+    - labels (dict): 'drug' / 'indication' -> label of every profile row.
+    - base_path (str): Snapshot built with the same parameters whose profiles differ from these
+      only in changed_rows (kind -> updated and appended rows; see delta.py). Its Annoy forests
+      are extended and its ranking tables updated instead of rebuilt.
+    - manifest_extra (dict): Entries added to manifest.json.
+    """
+    started = started or time.time()
+    tables = graph_manager.tables
+    arrays = {
+        'node_labels': tables.labels, 'node_names': tables.names, 'node_types': tables.node_types,
+        'edge_sources': tables.edge_sources, 'edge_targets': tables.edge_targets, 'edge_types': tables.edge_types,
+        'msi_indptr': graph_manager.MSI.indptr, 'msi_indices': graph_manager.MSI.indices, 'msi_weights': graph_manager.MSI.weights,
+        'drug_diffusion_profiles': profiles['drug'], 'indication_diffusion_profiles': profiles['indication'],
+        'drug_labels': labels['drug'], 'indication_labels': labels['indication'],
+    }
+
+    for name, array in arrays.items():
+        if not name.endswith('_diffusion_profiles'):
+            np.save(os.path.join(build_path, f'{name}.npy'), array)
+    for kind in ['drug', 'indication']:
+        ProfileStore.encode(profiles[kind], params['profile_encoding'], top_n=params['profile_top_n']).save(build_path, f'{kind}_profiles')
+
+    with startup_phase('index_build'):
+        map_drug_labels_to_indices = {label: index for index, label in enumerate(labels['drug'].tolist())}
+        index_params = {'metrics': params['metrics'], 'n_trees': params['n_trees'], 'projection': params['projection'],
+                        'projection_dimensions': params['projection_dimensions'], 'projection_transform': params['projection_transform']}
+        if base_path is None:
+            build_vector_indexes(profiles['drug'], map_drug_labels_to_indices, build_path, 'drug_index', **index_params)
+        else:
+            extend_vector_indexes(profiles['drug'], map_drug_labels_to_indices, base_path, build_path, 'drug_index', changed_rows['drug'], **index_params)
+        for kind in ['drug', 'indication']:
+            if params['profile_encoding'] == 'float32':
+                exact_db = ExactVectorDatabase(metrics=params['exact_metrics'])
+                exact_db.add_vectors(profiles[kind])
+                exact_db.save(build_path, f'{kind}_exact')
+        # Columns are only ever appended, and the profiles are zero there unless they changed
+        columns_appended = base_path is not None and len(np.load(os.path.join(base_path, 'node_labels.npy'), mmap_mode='r')) != profiles['drug'].shape[1]
+        for metric in params['ranking_metrics']:
+            if base_path is not None and (metric in ZERO_PADDING_INVARIANT_METRICS or not columns_appended):
+                update_ranking_table(TopNTable.load(base_path, f'drug_ranking_{metric}'), profiles['indication'], profiles['drug'], metric, params['ranking_top_n'],
+                                     changed_rows['indication'], changed_rows['drug'], build_path, f'drug_ranking_{metric}')
+            else:
+                build_ranking_table(profiles['indication'], profiles['drug'], metric, params['ranking_top_n'], build_path, f'drug_ranking_{metric}')
+        for kind in ['drug', 'indication']:
+            build_node_rank_table(profiles[kind], params['node_rank_top_n'], build_path, f'{kind}_node_ranks')
+
+    manifest = {
+        'key': key,
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'params': params,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'build_seconds': round(time.time() - started, 2),
+        'arrays': {name: {'shape': list(array.shape), 'dtype': str(array.dtype)} for name, array in arrays.items()},
+        **(manifest_extra or {}),
+    }
+    write_json_atomically(os.path.join(build_path, 'manifest.json'), manifest)
+
+
+def publish_snapshot(snapshot_root, key, build):
+    """
+    Run build(directory) in a temporary directory and rename it to <snapshot_root>/<key> once
+    complete, so a reader never sees a half-written snapshot.
+
+    Output:
+    - str: Path of the snapshot directory.
+    """
+    snapshot_path = os.path.join(snapshot_root, key)
+    build_path = tempfile.mkdtemp(prefix=f'.{key}-', dir=snapshot_root)
+    try:
+        build(build_path)
+
+        # mkdtemp creates the directory private to this user; workers may run as another user
+        os.chmod(build_path, 0o755)
+        try:
+            os.rename(build_path, snapshot_path)
+        except OSError:
+            # Another process finished the same snapshot first
+            shutil.rmtree(build_path, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise
+
+    return snapshot_path
+
+
+#===================================================================
+# Load
+#===================================================================
+
+class Snapshot:
+    def __init__(self, snapshot_path):
+        """
+        Memory-map a snapshot directory written by build_snapshot.
+        Arrays are read-only views on the page cache, shared by every worker on the machine.
+        """
+        with open(os.path.join(snapshot_path, 'manifest.json')) as handle:
+            self.manifest = json.load(handle)
+        assert self.manifest['format_version'] == SNAPSHOT_FORMAT_VERSION, "Snapshot format version mismatch."
+
+        self.path = snapshot_path
+        self.key = self.manifest['key']
+        self.params = self.manifest['params']
+
+        load = lambda name: np.load(os.path.join(snapshot_path, f'{name}.npy'), mmap_mode='r')
+
+        tables = MSITables(
+            labels=load('node_labels'), names=load('node_names'), node_types=load('node_types'),
+            edge_sources=load('edge_sources'), edge_targets=load('edge_targets'), edge_types=load('edge_types'),
+        )
+        MSI = CSRGraph(load('msi_indptr'), load('msi_indices'), load('msi_weights'), tables.node_types, tables.labels, tables.names)
+        self.graph_manager = GraphManager(tables=tables, MSI=MSI)
+
+        # Encoded stores decode rows on access; float32 profiles are served as the plain mmapped arrays
+        self.drug_profile_store = ProfileStore.load(snapshot_path, 'drug_profiles')
+        self.indication_profile_store = ProfileStore.load(snapshot_path, 'indication_profiles')
+        self.drug_diffusion_profiles, self.indication_diffusion_profiles = [
+            store.arrays['values'] if store.encoding == 'float32' else store for store in [self.drug_profile_store, self.indication_profile_store]]
+        self.map_drug_diffusion_labels_to_indices = {label: index for index, label in enumerate(load('drug_labels').tolist())}
+        self.map_indication_diffusion_labels_to_indices = {label: index for index, label in enumerate(load('indication_labels').tolist())}
+
+        self.drug_vector_db = MultiMetricDatabase.load(snapshot_path, 'drug_index', self.map_drug_diffusion_labels_to_indices,
+                                                       dimensions=self.drug_diffusion_profiles.shape[1], metrics=self.params['metrics'], n_trees=self.params['n_trees'],
+                                                       vectors=self.drug_diffusion_profiles)
+        # Encoded profiles are searched as they are stored, rather than through dense float32 copies
+        if self.drug_profile_store.encoding == 'float32':
+            self.drug_exact_db = ExactVectorDatabase.load(snapshot_path, 'drug_exact', metrics=self.params['exact_metrics'])
+            self.indication_exact_db = ExactVectorDatabase.load(snapshot_path, 'indication_exact', metrics=self.params['exact_metrics'])
+        else:
+            self.drug_exact_db = ProfileStoreDatabase(self.drug_profile_store, metrics=self.params['exact_metrics'])
+            self.indication_exact_db = ProfileStoreDatabase(self.indication_profile_store, metrics=self.params['exact_metrics'])
+        self.similarity_engine = SimilarityEngine(
+            profiles={'drug': self.drug_diffusion_profiles, 'indication': self.indication_diffusion_profiles},
+            databases={'drug': self.drug_exact_db, 'indication': self.indication_exact_db},
+        )
+
+        # Rows follow indication_diffusion_profiles
+        self.drug_ranking_tables = {metric: TopNTable.load(snapshot_path, f'drug_ranking_{metric}') for metric in self.params['ranking_metrics']}
+
+        # Rows follow the drug / indication diffusion profiles, so /graph top-k is a slice
+        self.graph_manager.node_rank_tables = {kind: TopNTable.load(snapshot_path, f'{kind}_node_ranks') for kind in ['drug', 'indication']}
+
+
+def load_snapshot(data_path, snapshot_root='./snapshots/', params=None):
+    """
+    Load the snapshot matching the current data and parameters, building it first if needed.
+
+    When several workers start together only one of them builds; the others wait on a file
+    lock and then mmap the finished snapshot.
+
+    Output:
+    - Snapshot
+    """
+    params = params or DEFAULT_SNAPSHOT_PARAMS
+    os.makedirs(snapshot_root, exist_ok=True)
+    key = compute_snapshot_key(data_path, params, snapshot_root)
+    snapshot_path = os.path.join(snapshot_root, key)
+
+    if not os.path.exists(os.path.join(snapshot_path, 'manifest.json')):
+        snapshot_path = build_snapshot_locked(data_path, snapshot_root, params)
+
+    try:
+        snapshot = Snapshot(snapshot_path)
+    except IndexMismatchError:
+        # The indexes on disk do not belong to this snapshot (e.g. a partial copy); rebuild once
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        snapshot = Snapshot(build_snapshot_locked(data_path, snapshot_root, params))
+
+    if read_current_key(snapshot_root) != snapshot.key:
+        publish_current_key(snapshot_root, snapshot.key)
+    return snapshot
+
+
+def build_snapshot_locked(data_path, snapshot_root, params):
+    with open(os.path.join(snapshot_root, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return build_snapshot(data_path, snapshot_root, params)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+if __name__ == '__main__':
+    data_path = sys.argv[1] if len(sys.argv) > 1 else './data/'
+    snapshot_root = sys.argv[2] if len(sys.argv) > 2 else './snapshots/'
+
+    start = time.time()
+    snapshot_path = build_snapshot(data_path, snapshot_root)
+    print(f'Snapshot {snapshot_path} ready in {time.time() - start:.1f}s')
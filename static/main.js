@@ -140,31 +140,188 @@ $(document).ready(function() {
         console.log("Slider 1 value: " + k1);
         console.log("Slider 2 value: " + k2);
 
-        // Here you can send the disease_name, drug_name, k1 and k2 to your server and get the response
-        // Example:
-        $.ajax({
-            url: 'http://127.0.0.1:8000/graph',
-            type: 'POST',
-            data: JSON.stringify({ 
-                disease_label: disease_label,
-                drug_label: drug_label,
-                k1: k1,
-                k2: k2
-            }),
-            contentType: "application/json; charset=utf-8",
-            dataType: 'json',
-            success: function(response) {
-                // Handle the response from your server
-                //console.log("Graph Response: ", JSON.stringify(response));;
-                graphData = response.MOA_network;
+        var graphRequest = { 
+            disease_label: disease_label,
+            drug_label: drug_label,
+            k1: k1,
+            k2: k2,
+            layout: true
+        };
+
+        // Large subgraphs are streamed in diffusion rank order so drawing starts immediately;
+        // small ones are fetched in one go in the compact binary format
+        if (k1 + k2 > GRAPH_STREAM_THRESHOLD) {
+            streamGraph(graphRequest);
+            return;
+        }
 
-                // Use vis-network to render the graphs
-                new vis.Network(MOA_network, graphData, {});
+        // Request the compact binary format (see graph_encoding.py) and decode it straight into vis DataSets
+        fetch('http://127.0.0.1:8000/graph', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json; charset=utf-8',
+                'Accept': GRAPH_BINARY
             },
-            error: function (request, status, error) {
-                console.error('Error occurred:', error);
+            body: JSON.stringify(graphRequest)
+        })
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.status + ' ' + response.statusText);
             }
+            return response.arrayBuffer();
+        })
+        .then(function(buffer) {
+            var graphData = decodeGraphBinary(buffer);
 
+            // Use vis-network to render the graphs. Nodes laid out by the server are drawn where
+            // they are, without running the physics simulation
+            new vis.Network(MOA_network, { nodes: graphData.nodes, edges: graphData.edges },
+                            graphData.positioned ? { physics: false } : {});
+        })
+        .catch(function(error) {
+            console.error('Error occurred:', error);
         });
     });
 });
+
+
+//============================================================================
+// Streaming /graph_stream client
+//============================================================================
+// The server sends NDJSON chunks {"nodes": [...], "edges": [...]}, highest ranked nodes first,
+// and a final {"done": true, ...}. Every chunk is added to the DataSets behind a network that is
+// created before the first byte arrives, so the graph grows on screen as it is received. With
+// layout requested, the final chunk carries positions for every node and the simulation stops.
+
+var GRAPH_STREAM_THRESHOLD = 100;
+
+function streamGraph(graphRequest) {
+    var nodes = new vis.DataSet();
+    var edges = new vis.DataSet();
+    var network = new vis.Network(MOA_network, { nodes: nodes, edges: edges }, {});
+
+    var decoder = new TextDecoder('utf-8');
+    var pending = '';
+
+    function addLine(line) {
+        if (!line) {
+            return;
+        }
+        var chunk = JSON.parse(line);
+        if (chunk.done) {
+            console.log('Streamed ' + chunk.n_nodes + ' nodes and ' + chunk.n_edges + ' edges');
+            // The server's layout of the whole subgraph replaces the simulation
+            if (chunk.positions) {
+                network.setOptions({ physics: false });
+                nodes.update(chunk.positions.id.map(function(id, i) {
+                    return { id: id, x: chunk.positions.x[i], y: chunk.positions.y[i] };
+                }));
+                network.fit();
+            }
+            return;
+        }
+        nodes.add(chunk.nodes);
+        edges.add(chunk.edges);
+    }
+
+    fetch('http://127.0.0.1:8000/graph_stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json; charset=utf-8',
+            'Accept': 'application/x-ndjson'
+        },
+        body: JSON.stringify(graphRequest)
+    })
+    .then(function(response) {
+        if (!response.ok) {
+            throw new Error(response.status + ' ' + response.statusText);
+        }
+        var reader = response.body.getReader();
+
+        function read() {
+            return reader.read().then(function(result) {
+                if (result.done) {
+                    addLine(pending + decoder.decode());
+                    return;
+                }
+                // A read may end mid-line; keep the partial line for the next one
+                var lines = (pending + decoder.decode(result.value, { stream: true })).split('\n');
+                pending = lines.pop();
+                lines.forEach(addLine);
+                return read();
+            });
+        }
+        return read();
+    })
+    .catch(function(error) {
+        console.error('Error occurred:', error);
+    });
+}
+
+
+//============================================================================
+// /graph binary format decoder
+//============================================================================
+// Layout (little endian), mirrored from graph_encoding.py:
+//   header         7 x uint32   magic 'MSIG', version, n_nodes, n_edges, n_label_bytes, n_legend_bytes, flags
+//   id             uint32[n_nodes]
+//   from, to       uint32[n_edges] each, positions in the node columns
+//   label_offsets  uint32[n_nodes + 1]
+//   xy             float32[2 * n_nodes], only with GRAPH_BINARY_HAS_POSITIONS
+//   type           uint8[n_nodes], codes into legend.node_types
+//   labels         UTF-8 bytes
+//   legend         UTF-8 JSON
+
+var GRAPH_BINARY = 'application/vnd.msi.graph+binary';
+var GRAPH_BINARY_VERSION = 2;
+var GRAPH_BINARY_HAS_POSITIONS = 1;
+
+function decodeGraphBinary(buffer) {
+    var header = new DataView(buffer, 0, 28);
+    var magic = String.fromCharCode(header.getUint8(0), header.getUint8(1), header.getUint8(2), header.getUint8(3));
+    if (magic !== 'MSIG' || header.getUint32(4, true) !== GRAPH_BINARY_VERSION) {
+        throw new Error('Unsupported graph payload');
+    }
+    var nNodes = header.getUint32(8, true);
+    var nEdges = header.getUint32(12, true);
+    var nLabelBytes = header.getUint32(16, true);
+    var nLegendBytes = header.getUint32(20, true);
+    var flags = header.getUint32(24, true);
+
+    // Every 4-byte section is 4-byte aligned, so they are viewed in place
+    var offset = 28;
+    var ids = new Uint32Array(buffer, offset, nNodes); offset += 4 * nNodes;
+    var sources = new Uint32Array(buffer, offset, nEdges); offset += 4 * nEdges;
+    var targets = new Uint32Array(buffer, offset, nEdges); offset += 4 * nEdges;
+    var labelOffsets = new Uint32Array(buffer, offset, nNodes + 1); offset += 4 * (nNodes + 1);
+    var xy = null;
+    if (flags & GRAPH_BINARY_HAS_POSITIONS) {
+        xy = new Float32Array(buffer, offset, 2 * nNodes); offset += 8 * nNodes;
+    }
+    var types = new Uint8Array(buffer, offset, nNodes); offset += nNodes;
+    var labelBytes = new Uint8Array(buffer, offset, nLabelBytes); offset += nLabelBytes;
+    var decoder = new TextDecoder('utf-8');
+    var legend = JSON.parse(decoder.decode(new Uint8Array(buffer, offset, nLegendBytes)));
+
+    var nodes = new Array(nNodes);
+    for (var i = 0; i < nNodes; i++) {
+        var style = legend.node_types[types[i]];
+        nodes[i] = {
+            id: ids[i],
+            label: decoder.decode(labelBytes.subarray(labelOffsets[i], labelOffsets[i + 1])),
+            color: style.color,
+            shape: style.shape
+        };
+        if (xy) {
+            nodes[i].x = xy[2 * i];
+            nodes[i].y = xy[2 * i + 1];
+        }
+    }
+
+    var edges = new Array(nEdges);
+    for (var j = 0; j < nEdges; j++) {
+        edges[j] = { from: ids[sources[j]], to: ids[targets[j]], arrows: legend.edge.arrows };
+    }
+
+    return { nodes: new vis.DataSet(nodes), edges: new vis.DataSet(edges), positioned: xy !== null };
+}
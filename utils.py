@@ -1,5 +1,10 @@
+import hashlib
+import json
 import pickle
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 def load_data_dict(file_name):
@@ -13,22 +18,145 @@ def save_data_dict(file_name, map_labels_to_indices):
         pickle.dump(map_labels_to_indices, handle, protocol=pickle.HIGHEST_PROTOCOL)
     pass
 
-def combine_all_vectors_and_labels(path):
-    file_list = [file for file in os.listdir(path) if file.endswith('.npy')]
-    
-    # Preallocate a list of arrays
-    arrays_list = []
-    
-    label_to_index = {}
-    
-    for index, file in enumerate(file_list):
+PROFILE_FILE_PREFIX = 'diffusion_profile_'
+ASSEMBLY_MATRIX_FILE = 'profiles.npy'
+ASSEMBLY_LABELS_FILE = 'map_labels_to_indices'
+ASSEMBLY_MANIFEST_FILE = 'manifest.json'
+
+
+def list_profile_files(path):
+    # (label, file name) of every per-entity profile in path, in sorted label order
+    files = sorted((os.path.splitext(file)[0].replace(PROFILE_FILE_PREFIX, ''), file) for file in os.listdir(path) if file.endswith('.npy'))
+    labels = [label for label, _ in files]
+    assert len(set(labels)) == len(labels), "Several profile files have the same label."
+    return files
+
+
+def row_checksum(row):
+    return hashlib.sha256(np.ascontiguousarray(row)).hexdigest()[:16]
+
+
+def write_manifest(output_path, manifest):
+    # Replaced atomically, so an interruption leaves either the previous manifest or this one
+    with tempfile.NamedTemporaryFile('w', dir=output_path, delete=False, suffix='.tmp') as handle:
+        json.dump(manifest, handle)
+    os.replace(handle.name, os.path.join(output_path, ASSEMBLY_MANIFEST_FILE))
+
+
+def combine_all_vectors_and_labels(path, output_path=None, max_workers=8, chunk_size=256):
+    """
+    Stack the per-entity profiles diffusion_profile_<label>.npy in path into one matrix, a row
+    per label in sorted label order, so the label map is the same on every machine.
+
+    Files are read by a thread pool straight into the preallocated output, so peak memory is
+    the output (memory-mapped with output_path) plus one chunk being read. With output_path,
+    the directory holds profiles.npy, map_labels_to_indices.pickle and manifest.json with the
+    checksum of every row written and of the whole matrix. The manifest is updated after every
+    chunk, so an assembly that was interrupted resumes with the rows it had not written, as
+    long as the input files are unchanged.
+
+    Input:
+    - path (str): Directory with the per-entity profiles.
+    - output_path (str): Directory to assemble into; None assembles in memory.
+    - max_workers (int): Files read concurrently.
+    - chunk_size (int): Rows between manifest updates.
+
+    Output:
+    - np.ndarray: Profiles, one row per label (a read-only memmap with output_path).
+    - dict: Label -> row index.
+    """
+    files = list_profile_files(path)
+    assert files, f"No profiles in {path}."
+    label_to_index = {label: index for index, (label, _) in enumerate(files)}
+    first = np.load(os.path.join(path, files[0][1]), mmap_mode='r')
+    shape, dtype = (len(files), first.size), first.dtype
+
+    sources = []
+    for label, file in files:
+        status = os.stat(os.path.join(path, file))
+        sources.append([label, file, status.st_size, status.st_mtime_ns])
+    manifest = {'shape': list(shape), 'dtype': dtype.str, 'sources': sources, 'row_checksums': {}, 'checksum': None}
+
+    if output_path is None:
+        combined_array = np.empty(shape, dtype=dtype)
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        matrix_path = os.path.join(output_path, ASSEMBLY_MATRIX_FILE)
+        manifest_path = os.path.join(output_path, ASSEMBLY_MANIFEST_FILE)
+        previous = None
+        if os.path.exists(manifest_path) and os.path.exists(matrix_path):
+            with open(manifest_path) as handle:
+                previous = json.load(handle)
+        if previous is not None and all(previous[key] == manifest[key] for key in ['shape', 'dtype', 'sources']):
+            combined_array = np.lib.format.open_memmap(matrix_path, mode='r+')
+            # Rows are trusted only if they still match their checksum
+            manifest['row_checksums'] = {label: checksum for label, checksum in previous['row_checksums'].items()
+                                         if row_checksum(combined_array[label_to_index[label]]) == checksum}
+        else:
+            combined_array = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=dtype, shape=shape)
+
+    def read_row(index):
+        label, file = files[index]
         array = np.load(os.path.join(path, file))
-        arrays_list.append(array)
-        # Extract the label name from the file name by removing '.npy' and add it to the dictionary
-        label_name = os.path.splitext(file)[0].replace('diffusion_profile_', '')
-        label_to_index[label_name] = index
-    
-    # Stack all arrays at once
-    combined_array = np.vstack(arrays_list)
-    
-    return combined_array, label_to_index
+        assert array.size == shape[1], f"Profile {file} has {array.size} values, expected {shape[1]}."
+        combined_array[index] = array.reshape(-1)
+        return label, row_checksum(combined_array[index])
+
+    missing = [index for index, (label, _) in enumerate(files) if label not in manifest['row_checksums']]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(missing), chunk_size):
+            manifest['row_checksums'].update(executor.map(read_row, missing[start:start + chunk_size]))
+            if output_path is not None:
+                # Rows reach the file before the manifest lists them
+                combined_array.flush()
+                write_manifest(output_path, manifest)
+
+    if output_path is None:
+        return combined_array, label_to_index
+
+    if manifest['checksum'] is None or missing:
+        manifest['checksum'] = hashlib.sha256(''.join(manifest['row_checksums'][label] for label, _ in files).encode()).hexdigest()[:16]
+        save_data_dict(os.path.join(output_path, ASSEMBLY_LABELS_FILE), label_to_index)
+        write_manifest(output_path, manifest)
+    del combined_array
+    return np.load(matrix_path, mmap_mode='r'), label_to_index
+
+
+def test_combine_all_vectors_and_labels():
+    rng = np.random.default_rng(0)
+    labels = [f'DB{index:05d}' for index in rng.permutation(50)]
+    profiles = {label: rng.random(20, dtype=np.float32) for label in labels}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'profiles')
+        os.makedirs(path)
+        for label, profile in profiles.items():
+            np.save(os.path.join(path, f'{PROFILE_FILE_PREFIX}{label}.npy'), profile)
+
+        combined_array, label_to_index = combine_all_vectors_and_labels(path, chunk_size=7)
+        assert list(label_to_index) == sorted(labels), "Rows are not in label order."
+        assert all(np.array_equal(combined_array[index], profiles[label]) for label, index in label_to_index.items())
+
+        output_path = os.path.join(directory, 'combined')
+        assembled, _ = combine_all_vectors_and_labels(path, output_path, chunk_size=7)
+        assert np.array_equal(assembled, combined_array)
+        with open(os.path.join(output_path, ASSEMBLY_MANIFEST_FILE)) as handle:
+            checksum = json.load(handle)['checksum']
+        assert load_data_dict(os.path.join(output_path, ASSEMBLY_LABELS_FILE)) == label_to_index
+
+        # Interrupted after 20 rows, with one of them lost: the rest are read on resume
+        with open(os.path.join(output_path, ASSEMBLY_MANIFEST_FILE)) as handle:
+            manifest = json.load(handle)
+        manifest['row_checksums'] = dict(list(manifest['row_checksums'].items())[:20])
+        manifest['checksum'] = None
+        write_manifest(output_path, manifest)
+        matrix = np.lib.format.open_memmap(os.path.join(output_path, ASSEMBLY_MATRIX_FILE), mode='r+')
+        matrix[5:] = 0
+        matrix.flush()
+        del matrix
+
+        resumed, _ = combine_all_vectors_and_labels(path, output_path, chunk_size=7)
+        assert np.array_equal(resumed, combined_array)
+        with open(os.path.join(output_path, ASSEMBLY_MANIFEST_FILE)) as handle:
+            assert json.load(handle)['checksum'] == checksum
+
+    print("All tests passed.")
@@ -5,6 +5,12 @@ from annoy import AnnoyIndex
 import pandas as pd
 import os
 import pickle
+import shutil
+import hashlib
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def load_data_dict(file_name):
@@ -19,35 +25,60 @@ def save_data_dict(file_name, map_labels_to_indices):
     pass
 
 
-class ANNOY_VectorDatabase:
-    def __init__(self, dimensions, map_indices_to_labels, n_trees=10):
-        self.dimensions = dimensions
-        self.n_trees = n_trees
-        self.index = AnnoyIndex(self.dimensions, 'angular')
-        self.labels_map = map_indices_to_labels  # Initialize with your existing map
+class IndexMismatchError(Exception):
+    """A saved index does not match the data or parameters it is being loaded for."""
+    pass
 
-    def add_vectors(self, vectors):
-        assert vectors.shape[1] == self.dimensions
-        for idx, vector in enumerate(vectors):
-            self.index.add_item(idx, vector.tolist())
-        self.index.build(self.n_trees)
 
-    def nearest_neighbors(self, query, k=10):
-        indices = self.index.get_nns_by_vector(query.tolist()[0], k)
-        label_indices = [self.labels_map[idx] for idx in indices]
-        return label_indices
+def label_map_checksum(map_labels_to_indices):
+    # Order independent: the same labels mapped to the same rows always give the same checksum
+    items = sorted((str(label), int(index)) for label, index in map_labels_to_indices.items())
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
 
 
 class MultiMetricDatabase:
-    def __init__(self, dimensions, metrics=['angular'], n_trees=10):
+    """
+    One Annoy forest per metric over the same vectors, identified by row index.
+
+    Forests are built (or, for a loaded database, memory-mapped) the first time a metric is
+    queried, so a deployment only pays for the metrics it actually uses. save builds every
+    configured metric.
+
+    With a projection ('pca', 'svd' or 'random', see fit_projection) the forests are built on
+    the vectors projected to projection_dimensions. A query then fetches overfetch * k
+    candidates from the forest and, when the full vectors are available, re-ranks them exactly.
+    projection_transform='sqrt' projects the element-wise square roots instead, which spreads
+    out the many small diffusion values that a projection of the raw profiles loses next to
+    the large mass at the source node.
+
+    Indexes extended by extend_vector_indexes keep the forests of an earlier build. Rows
+    updated or appended since (the overlay) are not answered by the forests: each query
+    re-ranks the forest candidates together with the overlay rows exactly.
+    """
+    # Bump when the saved layout changes
+    INDEX_FORMAT_VERSION = 2
+
+    def __init__(self, dimensions, metrics=['angular'], n_trees=10, projection=None, projection_dimensions=128, projection_transform=None, overfetch=10):
         self.dimensions = dimensions
         self.n_trees = n_trees
         self.metrics = metrics
+        self.projection = projection
+        self.index_dimensions = dimensions if projection is None else projection_dimensions
+        self.projection_transform = projection_transform
+        self.overfetch = overfetch
+        # Leading columns of the vectors the forests were built on, and rows they must not answer for
+        self.forest_dimensions = dimensions
+        self.overlay = None
+        self.projection_components = None
+        self.projection_mean = None
         self.databases = {}
-
-        for metric in metrics:
-            index = AnnoyIndex(dimensions, metric)
-            self.databases[metric] = index
+        self.metadata = None
+        self.vectors = None
+        self.index_paths = {}
+        self.lock = threading.Lock()
+        # Created on the first fused query, so no threads exist before process workers fork
+        self.executor = None
+        self.executor_lock = threading.Lock()
 
     def add_vectors(self, vectors, map_labels_to_indices):
         assert vectors.shape[1] == self.dimensions, "Vectors dimension mismatch."
@@ -57,16 +88,470 @@ class MultiMetricDatabase:
         for label, index in map_labels_to_indices.items():
             if index < len(vectors):
                 self.map_labels_to_index[label] = vectors[index]
+        self.item_ids = {label: map_labels_to_indices[label] for label in self.map_labels_to_index}
+        self.vectors = vectors
 
-        for metric, index in self.databases.items():
-            for label, vector in self.map_labels_to_index.items():
-                index.add_item(map_labels_to_indices[label], vector.tolist())
-            index.build(self.n_trees)
+        start = time.time()
+        if self.projection is not None:
+            self.projection_components, self.projection_mean = fit_projection(self.transform(vectors), self.projection, self.index_dimensions)
+        self.index_vectors = self.project(vectors)
+
+        self.metadata = {
+            'format_version': self.INDEX_FORMAT_VERSION,
+            'dimensions': self.dimensions,
+            'metrics': list(self.metrics),
+            'n_trees': self.n_trees,
+            'n_items': len(self.map_labels_to_index),
+            'label_map_checksum': label_map_checksum(self.item_ids),
+            'projection': self.projection,
+            'index_dimensions': self.index_dimensions,
+            'projection_transform': self.projection_transform,
+            'overfetch': self.overfetch,
+            'build_seconds': round(time.time() - start, 2),
+        }
+
+    def transform(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return np.sqrt(np.maximum(vectors, 0)) if self.projection_transform == 'sqrt' else vectors
+
+    def project(self, vectors):
+        # Vectors as stored in the forests: projected if a projection was fitted, else unchanged
+        if self.forest_dimensions != self.dimensions:
+            vectors = np.asarray(vectors)[..., :self.forest_dimensions]
+        if self.projection is None:
+            return vectors
+        return ((self.transform(vectors) - self.projection_mean) @ self.projection_components.T).astype(np.float32)
+
+    def get_index(self, metric):
+        """
+        The Annoy index of a metric, built from the added vectors or loaded from its saved file on first use.
+        """
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        if metric in self.databases:
+            return self.databases[metric]
+
+        with self.lock:
+            if metric in self.databases:
+                return self.databases[metric]
+
+            index = AnnoyIndex(self.index_dimensions, metric)
+            if metric in self.index_paths:
+                index.load(self.index_paths[metric])
+                n_items = self.metadata.get('forest_items', self.metadata['n_items'])
+                if index.get_n_items() != n_items:
+                    raise IndexMismatchError(f"{self.index_paths[metric]} holds {index.get_n_items()} items, expected {n_items}")
+            else:
+                assert self.metadata is not None, "Add vectors before querying."
+                start = time.time()
+                for item in self.item_ids.values():
+                    index.add_item(item, self.index_vectors[item].tolist())
+                index.build(self.n_trees)
+                self.metadata['build_seconds'] = round(self.metadata['build_seconds'] + time.time() - start, 2)
+
+            self.databases[metric] = index
+            return index
 
     def nearest_neighbors(self, query, metric, k=10):
+        if self.overlay is not None:
+            assert self.vectors is not None, "An extended index re-ranks on the full vectors; load it with them."
+            query = np.asarray(query, dtype=np.float32)
+            candidates = np.asarray(self.get_index(metric).get_nns_by_vector(self.project(query).tolist(), self.overfetch * k), dtype=np.int64)
+            candidates = np.union1d(np.setdiff1d(candidates, self.overlay), self.overlay)
+            return exact_rerank(query, self.vectors, candidates, metric, k).tolist()
+
+        if self.projection is None:
+            return self.get_index(metric).get_nns_by_vector(query, k)
+
+        candidates = self.get_index(metric).get_nns_by_vector(self.project(query).tolist(), self.overfetch * k)
+        if self.vectors is None:
+            return candidates[:k]
+        return exact_rerank(query, self.vectors, candidates, metric, k).tolist()
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Rank fusion
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Each metric's forest proposes overfetch * k candidates. The union is re-ranked exactly on
+    # the full vectors for every metric, which removes Annoy's approximation error from the
+    # ranks, and the per-metric ranks are combined with reciprocal-rank fusion:
+    #     score(item) = sum over metrics of 1 / (rrf_k + rank_metric(item))
+
+    def fused_nearest_neighbors(self, query, k=10, metrics=None, overfetch=4, rrf_k=60):
+        """
+        Input:
+        - query (numpy array): Query vector.
+        - k (int): Number of results.
+        - metrics (list of str): Metrics to fuse, default all configured metrics.
+        - overfetch (int): Candidates requested from each forest, as a multiple of k.
+        - rrf_k (int): Reciprocal-rank fusion constant; larger values flatten the rank weights.
+
+        Output:
+        - numpy array (k,), int: Row indices, best fused score first.
+        - numpy array (k,), float: Their fused scores.
+        - dict: Metric -> numpy array (k,) of each result's exact rank (1-based) among the candidates.
+        """
+        assert self.vectors is not None, "Fusion re-ranks on the full vectors; load or add them first."
+        metrics = metrics or self.metrics
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=len(self.metrics))
+
+        # Annoy releases the GIL while searching, so the forests are queried concurrently
+        query_list = np.asarray(query, dtype=np.float32).tolist()
+        futures = [self.executor.submit(self.nearest_neighbors, query_list, metric, overfetch * k) for metric in metrics]
+        candidates = np.unique(np.concatenate([np.asarray(future.result(), dtype=np.int64) for future in futures]))
+
+        exact_db = ExactVectorDatabase(metrics=metrics)
+        exact_db.add_vectors(self.vectors[candidates])
+        ranks = {}
+        scores = np.zeros(len(candidates))
+        for metric in metrics:
+            distances = exact_db.distances(query, metric)[0]
+            ranks[metric] = np.empty(len(candidates), dtype=np.int64)
+            ranks[metric][np.argsort(distances, kind='stable')] = np.arange(1, len(candidates) + 1)
+            scores += 1.0 / (rrf_k + ranks[metric])
+
+        order = np.argsort(-scores, kind='stable')[:k]
+        return candidates[order], scores[order], {metric: metric_ranks[order] for metric, metric_ranks in ranks.items()}
+
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Persistence
+    #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
+    # Building is an offline step: build once, save, and let every worker load the saved files.
+    # Annoy mmaps a loaded index, so all workers on a machine share the same page-cache pages
+    # instead of holding private copies of every forest.
+
+    def save(self, directory, name):
+        """
+        Write <name>_<metric>.ann for every metric plus <name>.json with the build metadata,
+        and the fitted projection as <name>_projection_components.npy / _mean.npy.
+        """
+        assert self.metadata is not None, "Add vectors before saving."
+        os.makedirs(directory, exist_ok=True)
+        for metric in self.metrics:
+            self.get_index(metric).save(os.path.join(directory, f'{name}_{metric}.ann'))
+        if self.projection is not None:
+            np.save(os.path.join(directory, f'{name}_projection_components.npy'), self.projection_components)
+            np.save(os.path.join(directory, f'{name}_projection_mean.npy'), self.projection_mean)
+        with open(os.path.join(directory, f'{name}.json'), 'w') as handle:
+            json.dump(self.metadata, handle, indent=2)
+
+    @classmethod
+    def load(cls, directory, name, map_labels_to_indices=None, dimensions=None, metrics=None, n_trees=None, vectors=None):
+        """
+        Check saved indexes against what the caller expects; each one is memory-mapped on first use.
+
+        Input:
+        - directory, name: Location passed to save.
+        - map_labels_to_indices (dict): If given, must be the label map the indexes were built with.
+        - dimensions, metrics, n_trees: If given, must match the build metadata.
+          metrics may be a subset of the saved metrics; only those can be queried.
+        - vectors (numpy array): The indexed vectors, needed only for fused_nearest_neighbors.
+
+        Output:
+        - MultiMetricDatabase
+
+        Raises IndexMismatchError when the saved indexes do not match.
+        """
+        metadata_path = os.path.join(directory, f'{name}.json')
+        if not os.path.exists(metadata_path):
+            raise IndexMismatchError(f"No index metadata at {metadata_path}")
+        with open(metadata_path) as handle:
+            metadata = json.load(handle)
+
+        expected = {'format_version': cls.INDEX_FORMAT_VERSION, 'dimensions': dimensions, 'n_trees': n_trees}
+        if map_labels_to_indices is not None:
+            expected['label_map_checksum'] = label_map_checksum(map_labels_to_indices)
+        for key, value in expected.items():
+            if value is not None and metadata.get(key) != value:
+                raise IndexMismatchError(f"Index {name}: {key} is {metadata.get(key)!r}, expected {value!r}")
+        if vectors is not None and tuple(vectors.shape) != (metadata['n_items'], metadata['dimensions']):
+            raise IndexMismatchError(f"Index {name} holds {metadata['n_items']} items, got vectors of shape {vectors.shape}")
+
+        metrics = metrics or metadata['metrics']
+        missing = set(metrics) - set(metadata['metrics'])
+        if missing:
+            raise IndexMismatchError(f"Index {name} was not built for metrics {sorted(missing)}")
+
+        db = MultiMetricDatabase.__new__(cls)
+        MultiMetricDatabase.__init__(db, metadata['dimensions'], metrics=metrics, n_trees=metadata['n_trees'], projection=metadata['projection'],
+                                     projection_dimensions=metadata['index_dimensions'], projection_transform=metadata['projection_transform'],
+                                     overfetch=metadata['overfetch'])
+        db.metadata = metadata
+        db.vectors = vectors
+        db.index_dimensions = metadata['index_dimensions']
+        db.forest_dimensions = metadata.get('forest_dimensions', metadata['dimensions'])
+        if metadata.get('overlay_items'):
+            db.overlay = np.load(os.path.join(directory, f'{name}_overlay.npy'))
+        if db.projection is not None:
+            db.projection_components = np.load(os.path.join(directory, f'{name}_projection_components.npy'), mmap_mode='r')
+            db.projection_mean = np.load(os.path.join(directory, f'{name}_projection_mean.npy'), mmap_mode='r')
+        for metric in metrics:
+            path = os.path.join(directory, f'{name}_{metric}.ann')
+            if not os.path.exists(path):
+                raise IndexMismatchError(f"Missing index file {path}")
+            db.index_paths[metric] = path
+        return db
+
+
+class ANNOY_VectorDatabase(MultiMetricDatabase):
+    """
+    Single angular index that returns labels instead of row indices.
+    Shares the build, save and load of MultiMetricDatabase.
+    """
+    def __init__(self, dimensions, map_indices_to_labels, n_trees=10):
+        super().__init__(dimensions, metrics=['angular'], n_trees=n_trees)
+        self.labels_map = map_indices_to_labels  # Initialize with your existing map
+
+    def add_vectors(self, vectors):
+        assert vectors.shape[1] == self.dimensions
+        super().add_vectors(vectors, {self.labels_map[idx]: idx for idx in range(len(vectors))})
+
+    def nearest_neighbors(self, query, k=10):
+        indices = self.get_index('angular').get_nns_by_vector(query.tolist()[0], k)
+        label_indices = [self.labels_map[idx] for idx in indices]
+        return label_indices
+
+    @classmethod
+    def load(cls, directory, name, map_indices_to_labels, dimensions=None, n_trees=None):
+        map_labels_to_indices = {map_indices_to_labels[idx]: idx for idx in range(len(map_indices_to_labels))}
+        db = super().load(directory, name, map_labels_to_indices, dimensions=dimensions, metrics=['angular'], n_trees=n_trees)
+        db.labels_map = map_indices_to_labels
+        return db
+
+
+class ExactVectorDatabase:
+    """
+    Exact k-NN over a dense matrix, with the same nearest_neighbors interface as MultiMetricDatabase.
+
+    For each metric the matrix is preprocessed once so that a query is a single matrix-vector
+    product (or matrix-matrix for a batch of queries):
+    - correlation: rows centered and L2-normalized, distance = 1 - <x, q>
+    - cosine / angular: rows L2-normalized; angular returns Annoy's sqrt(2 - 2 cos) distance
+    - euclidean: squared row norms cached, distance^2 = |x|^2 - 2 <x, q> + |q|^2
+    - manhattan: no GEMV form, computed in row blocks
+    """
+    METRICS = ['correlation', 'cosine', 'angular', 'euclidean', 'manhattan']
+
+    def __init__(self, metrics=['correlation'], block_size=256):
+        for metric in metrics:
+            assert metric in self.METRICS, f"Metric '{metric}' is not supported."
+        self.metrics = metrics
+        self.block_size = block_size
+        self.matrices = {}
+
+    def add_vectors(self, vectors, map_labels_to_indices=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.dimensions = vectors.shape[1]
+        self.n_items = len(vectors)
+
+        for metric in self.metrics:
+            if metric == 'correlation':
+                self.matrices[metric] = normalize_rows(vectors - vectors.mean(axis=1, keepdims=True))
+            elif metric in ['cosine', 'angular']:
+                self.matrices[metric] = normalize_rows(vectors)
+            else:
+                self.matrices[metric] = vectors
+        if 'euclidean' in self.metrics:
+            self.squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+
+    def prepare_queries(self, queries, metric):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if metric == 'correlation':
+            return normalize_rows(queries - queries.mean(axis=1, keepdims=True))
+        if metric in ['cosine', 'angular']:
+            return normalize_rows(queries)
+        return queries
+
+    def distances(self, queries, metric):
+        """
+        Input:
+        - queries (numpy array): One query (d,) or a batch (n_queries, d).
+        - metric (str): One of the configured metrics.
+
+        Output:
+        - numpy array (n_queries, n_items), float32: Distance from every query to every item.
+        """
         assert metric in self.metrics, f"Metric '{metric}' is not supported."
-        index = self.databases[metric]
-        return index.get_nns_by_vector(query, k)
+        matrix = self.matrices[metric]
+        queries = self.prepare_queries(queries, metric)
+
+        if metric == 'correlation' or metric == 'cosine':
+            return 1.0 - queries @ matrix.T
+        if metric == 'angular':
+            return np.sqrt(np.maximum(2.0 - 2.0 * (queries @ matrix.T), 0.0))
+        if metric == 'euclidean':
+            squared = self.squared_norms[None, :] - 2.0 * (queries @ matrix.T) + np.einsum('ij,ij->i', queries, queries)[:, None]
+            return np.sqrt(np.maximum(squared, 0.0))
+
+        # manhattan: the broadcast difference is (n_queries, rows, d), so cap it at ~64 MB
+        distances = np.empty((len(queries), self.n_items), dtype=np.float32)
+        rows = max(1, min(self.block_size, (1 << 24) // (len(queries) * self.dimensions)))
+        for start in range(0, self.n_items, rows):
+            block = matrix[start:start + rows]
+            distances[:, start:start + len(block)] = np.abs(queries[:, None, :] - block[None, :, :]).sum(axis=2)
+        return distances
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, return_distances=False):
+        """
+        Output:
+        - numpy array (n_queries, k), int: Row indices of the k nearest items, closest first.
+        - numpy array (n_queries, k), float32: Their distances, if return_distances.
+        """
+        distances = self.distances(queries, metric)
+        indices, top_distances = top_k_smallest(distances, k)
+        return (indices, top_distances) if return_distances else indices
+
+    def nearest_neighbors(self, query, metric, k=10):
+        return self.nearest_neighbors_batch(query, metric, k)[0].tolist()
+
+    def save(self, directory, name):
+        # Preprocessed matrices are saved so workers can mmap them instead of recomputing
+        os.makedirs(directory, exist_ok=True)
+        for metric in self.metrics:
+            np.save(os.path.join(directory, f'{name}_{metric}.npy'), self.matrices[metric])
+        if 'euclidean' in self.metrics:
+            np.save(os.path.join(directory, f'{name}_squared_norms.npy'), self.squared_norms)
+
+    @classmethod
+    def load(cls, directory, name, metrics=['correlation'], block_size=256):
+        db = cls(metrics=metrics, block_size=block_size)
+        for metric in metrics:
+            db.matrices[metric] = np.load(os.path.join(directory, f'{name}_{metric}.npy'), mmap_mode='r')
+        if 'euclidean' in metrics:
+            db.squared_norms = np.load(os.path.join(directory, f'{name}_squared_norms.npy'), mmap_mode='r')
+        db.n_items, db.dimensions = db.matrices[metrics[0]].shape
+        return db
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+
+def top_k_smallest(distances, k):
+    """
+    Row-wise top-k with argpartition, then a sort of only the k survivors. Equal distances are
+    ordered by column, lowest first, so the top k of a row is always a prefix of its top k + 1.
+
+    Output:
+    - numpy array (n_rows, k): Column indices, smallest distance first.
+    - numpy array (n_rows, k): The distances.
+    """
+    k = min(k, distances.shape[1])
+    candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+    # argpartition keeps arbitrary columns among those tied with the k-th distance; redo those rows
+    kth = candidate_distances.max(axis=1, keepdims=True)
+    for row in np.flatnonzero((distances == kth).sum(axis=1) > (candidate_distances == kth).sum(axis=1)):
+        below = np.flatnonzero(distances[row] < kth[row])
+        candidates[row] = np.concatenate([below, np.flatnonzero(distances[row] == kth[row])[:k - len(below)]])
+        candidate_distances[row] = distances[row, candidates[row]]
+    order = np.lexsort((candidates, candidate_distances), axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_distances, order, axis=1)
+
+
+def fit_projection(vectors, method, n_components, seed=0):
+    """
+    Fit a linear projection to n_components dimensions; projected = (x - mean) @ components.T.
+    scikit-learn is only needed when a projection is fitted.
+
+    Input:
+    - method (str): 'pca' (centered), 'svd' (truncated SVD, uncentered) or 'random' (sparse random projection).
+
+    Output:
+    - numpy array (n_components, dimensions), float32: components.
+    - numpy array (dimensions,), float32: mean subtracted before projecting.
+    """
+    from sklearn.decomposition import PCA, TruncatedSVD
+    from sklearn.random_projection import SparseRandomProjection
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    mean = np.zeros(vectors.shape[1], dtype=np.float32)
+    if method == 'pca':
+        model = PCA(n_components=n_components, svd_solver='randomized', random_state=seed).fit(vectors)
+        mean = model.mean_
+    elif method == 'svd':
+        model = TruncatedSVD(n_components=n_components, algorithm='randomized', random_state=seed).fit(vectors)
+    elif method == 'random':
+        model = SparseRandomProjection(n_components=n_components, random_state=seed).fit(vectors)
+    else:
+        raise ValueError(f"Unknown projection '{method}'")
+
+    components = model.components_
+    components = components.toarray() if hasattr(components, 'toarray') else components
+    return np.asarray(components, dtype=np.float32), np.asarray(mean, dtype=np.float32)
+
+
+def exact_rerank(query, vectors, candidates, metric, k):
+    """
+    Order candidate rows by their exact distance to the query and keep the k closest.
+
+    Output:
+    - numpy array of int: The k closest candidates, closest first.
+    """
+    candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+    db = ExactVectorDatabase(metrics=[metric])
+    db.add_vectors(vectors[candidates])
+    return candidates[db.nearest_neighbors_batch(query, metric, k)[0]]
+
+
+def build_vector_indexes(vectors, map_labels_to_indices, directory, name, metrics=['angular', 'euclidean', 'manhattan'], n_trees=30,
+                         projection=None, projection_dimensions=128, projection_transform=None):
+    """
+    Offline step: build the Annoy indexes for a set of vectors and save them for workers to load.
+    """
+    db = MultiMetricDatabase(dimensions=vectors.shape[1], metrics=metrics, n_trees=n_trees, projection=projection,
+                             projection_dimensions=projection_dimensions, projection_transform=projection_transform)
+    db.add_vectors(vectors, map_labels_to_indices)
+    db.save(directory, name)
+    return db
+
+
+def extend_vector_indexes(vectors, map_labels_to_indices, base_directory, directory, name, changed_rows, max_overlay_fraction=0.05, **build_params):
+    """
+    Offline step: indexes for vectors that differ from the ones saved in base_directory only in
+    changed_rows (updated, or appended at the end, possibly with extra trailing columns).
+
+    The forests are linked from base_directory instead of rebuilt; the changed rows and those of
+    earlier extensions form the overlay that queries rank exactly. Once the overlay grows beyond
+    max_overlay_fraction of the items, everything is rebuilt with build_vector_indexes.
+
+    Output:
+    - MultiMetricDatabase: Loaded from directory.
+    """
+    with open(os.path.join(base_directory, f'{name}.json')) as handle:
+        metadata = json.load(handle)
+    forest_items = metadata.get('forest_items', metadata['n_items'])
+    overlay = np.union1d(np.asarray(changed_rows, dtype=np.int64), np.arange(forest_items, len(vectors)))
+    if metadata.get('overlay_items'):
+        overlay = np.union1d(overlay, np.load(os.path.join(base_directory, f'{name}_overlay.npy')))
+    if len(overlay) > max_overlay_fraction * len(vectors):
+        build_vector_indexes(vectors, map_labels_to_indices, directory, name, **build_params)
+        return MultiMetricDatabase.load(directory, name, vectors=vectors)
+
+    os.makedirs(directory, exist_ok=True)
+    file_names = [f'{name}_{metric}.ann' for metric in metadata['metrics']]
+    if metadata['projection'] is not None:
+        file_names += [f'{name}_projection_components.npy', f'{name}_projection_mean.npy']
+    for file_name in file_names:
+        try:
+            # Forests are read-only once saved, so the snapshots can share them
+            os.link(os.path.join(base_directory, file_name), os.path.join(directory, file_name))
+        except OSError:
+            shutil.copy2(os.path.join(base_directory, file_name), os.path.join(directory, file_name))
+
+    np.save(os.path.join(directory, f'{name}_overlay.npy'), overlay)
+    metadata.update({
+        'dimensions': vectors.shape[1],
+        'n_items': len(vectors),
+        'label_map_checksum': label_map_checksum(map_labels_to_indices),
+        'forest_items': forest_items,
+        'forest_dimensions': metadata.get('forest_dimensions', metadata['dimensions']),
+        'overlay_items': len(overlay),
+    })
+    with open(os.path.join(directory, f'{name}.json'), 'w') as handle:
+        json.dump(metadata, handle, indent=2)
+    return MultiMetricDatabase.load(directory, name, vectors=vectors)
 
 
 def test_multimetricdatabase():
@@ -106,3 +591,131 @@ def test_multimetricdatabase():
     print("All tests passed.")
 
 
+def test_multimetricdatabase_save_load():
+    import tempfile
+
+    dimensions = 10
+    vectors = np.random.rand(200, dimensions).astype('float32')
+    map_labels_to_indices = {f'drug_{i}': i for i in range(len(vectors))}
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = build_vector_indexes(vectors, map_labels_to_indices, directory, 'drug_index', metrics=['angular', 'manhattan'], n_trees=5)
+        loaded = MultiMetricDatabase.load(directory, 'drug_index', map_labels_to_indices, dimensions=dimensions, metrics=['manhattan'])
+
+        # A loaded index answers exactly like the one it was saved from
+        query = np.random.rand(dimensions).astype('float32')
+        assert loaded.nearest_neighbors(query, 'manhattan', 10) == db.nearest_neighbors(query, 'manhattan', 10), "Loaded index returned different neighbours."
+
+        # Loading against a different label map or dimensionality is refused
+        for kwargs in [{'map_labels_to_indices': {'other': 0}}, {'dimensions': dimensions + 1}, {'metrics': ['euclidean']}]:
+            try:
+                MultiMetricDatabase.load(directory, 'drug_index', **kwargs)
+            except IndexMismatchError:
+                pass
+            else:
+                raise AssertionError(f"Mismatched load was not detected: {kwargs}")
+
+    print("All tests passed.")
+
+
+def test_extend_vector_indexes():
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    vectors = rng.random((200, 10)).astype('float32')
+    # Row 3 updated, five rows and two columns appended
+    extended = np.zeros((205, 12), dtype='float32')
+    extended[:200, :10] = vectors
+    extended[[3, 200, 201, 202, 203, 204]] = rng.random((6, 12)).astype('float32')
+    map_labels_to_indices = {f'drug_{i}': i for i in range(len(extended))}
+
+    with tempfile.TemporaryDirectory() as directory:
+        build_vector_indexes(vectors, {f'drug_{i}': i for i in range(len(vectors))}, os.path.join(directory, 'base'), 'drug_index', metrics=['manhattan'], n_trees=5)
+        db = extend_vector_indexes(extended, map_labels_to_indices, os.path.join(directory, 'base'), os.path.join(directory, 'next'), 'drug_index', [3],
+                                   max_overlay_fraction=0.1, metrics=['manhattan'], n_trees=5)
+
+        # The forest is reused; updated and appended rows are answered exactly
+        assert db.get_index('manhattan').f == 10 and db.get_index('manhattan').get_n_items() == 200
+        assert db.nearest_neighbors(extended[3], 'manhattan', 1) == [3] and db.nearest_neighbors(extended[204], 'manhattan', 1) == [204]
+        assert db.nearest_neighbors(np.append(vectors[3], [0, 0]), 'manhattan', 1) != [3], "The forest answered for an updated row."
+
+        # Beyond the overlay bound the forests are rebuilt
+        db = extend_vector_indexes(extended, map_labels_to_indices, os.path.join(directory, 'next'), os.path.join(directory, 'rebuilt'), 'drug_index', [],
+                                   max_overlay_fraction=0.01, metrics=['manhattan'], n_trees=5)
+        assert db.overlay is None and db.get_index('manhattan').get_n_items() == 205
+
+    print("All tests passed.")
+
+
+def test_multimetricdatabase_fusion():
+    vectors = np.random.rand(500, 16).astype('float32')
+    query = np.random.rand(16).astype('float32')
+    db = MultiMetricDatabase(dimensions=16, metrics=['angular', 'euclidean', 'manhattan'], n_trees=10)
+    db.add_vectors(vectors, {f'drug_{i}': i for i in range(len(vectors))})
+
+    # Forests are only built for metrics that are queried
+    db.nearest_neighbors(query, 'manhattan', 10)
+    assert set(db.databases) == {'manhattan'}, "Unqueried metrics were built."
+
+    indices, scores, ranks = db.fused_nearest_neighbors(query, k=10)
+    assert len(indices) == 10 and set(db.databases) == set(db.metrics)
+    assert np.all(np.diff(scores) <= 0), "Fused results are not sorted by score."
+    expected = sum(1.0 / (60 + ranks[metric]) for metric in db.metrics)
+    assert np.allclose(scores, expected), "Scores do not match the reported ranks."
+
+    # Fusing one metric is its exact top-k over the candidates
+    exact_top = np.argsort(np.abs(vectors - query).sum(axis=1))[:10]
+    indices, _, ranks = db.fused_nearest_neighbors(query, k=10, metrics=['manhattan'], overfetch=50)
+    assert np.array_equal(indices, exact_top) and np.array_equal(ranks['manhattan'], np.arange(1, 11))
+
+    print("All tests passed.")
+
+
+def test_multimetricdatabase_projection():
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    vectors = (rng.random((400, 60)) @ rng.random((60, 300))).astype('float32')  # rank 60
+    query = vectors[7] + 0.01 * rng.random(300).astype('float32')
+    map_labels_to_indices = {f'drug_{i}': i for i in range(len(vectors))}
+    exact_top = np.argsort(np.abs(vectors - query).sum(axis=1))[:10]
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = build_vector_indexes(vectors, map_labels_to_indices, directory, 'drug_index', metrics=['manhattan'], n_trees=10,
+                                  projection='pca', projection_dimensions=60)
+        loaded = MultiMetricDatabase.load(directory, 'drug_index', map_labels_to_indices, dimensions=300, vectors=vectors)
+
+        # Forests hold the projected vectors; results are re-ranked exactly on the full vectors
+        assert loaded.get_index('manhattan').f == 60, "Forest was not built on the projected vectors."
+        assert np.allclose(loaded.project(vectors[:5]), db.index_vectors[:5], atol=1e-3)
+        result = loaded.nearest_neighbors(query, 'manhattan', 10)
+        assert result[0] == 7 and len(set(result) & set(exact_top.tolist())) >= 8, "Re-ranked neighbours differ from exact search."
+
+    print("All tests passed.")
+
+
+def test_exactvectordatabase():
+    vectors = np.random.rand(300, 20).astype('float32')
+    queries = np.random.rand(5, 20).astype('float32')
+    db = ExactVectorDatabase(metrics=ExactVectorDatabase.METRICS, block_size=64)
+    db.add_vectors(vectors)
+
+    # Brute-force reference distances
+    centered_vectors = vectors - vectors.mean(axis=1, keepdims=True)
+    centered_queries = queries - queries.mean(axis=1, keepdims=True)
+    cosine = (queries @ vectors.T) / np.outer(np.linalg.norm(queries, axis=1), np.linalg.norm(vectors, axis=1))
+    reference = {
+        'correlation': 1 - (centered_queries @ centered_vectors.T) / np.outer(np.linalg.norm(centered_queries, axis=1), np.linalg.norm(centered_vectors, axis=1)),
+        'cosine': 1 - cosine,
+        'angular': np.sqrt(2 - 2 * cosine),
+        'euclidean': np.linalg.norm(queries[:, None, :] - vectors[None, :, :], axis=2),
+        'manhattan': np.abs(queries[:, None, :] - vectors[None, :, :]).sum(axis=2),
+    }
+
+    for metric, expected in reference.items():
+        indices, distances = db.nearest_neighbors_batch(queries, metric, k=10, return_distances=True)
+        assert np.array_equal(indices, np.argsort(expected, axis=1)[:, :10]), f"Wrong neighbours for metric '{metric}'."
+        assert np.allclose(distances, np.sort(expected, axis=1)[:, :10], atol=1e-4), f"Wrong distances for metric '{metric}'."
+        assert db.nearest_neighbors(queries[0], metric, 10) == indices[0].tolist(), f"Single query differs from batch for metric '{metric}'."
+
+    print("All tests passed.")